@@ -0,0 +1,105 @@
+import os
+import math
+import queue
+import threading
+
+import torch
+
+from utils import atomic_write
+
+
+def state_dict_snapshot(model):
+    # detached CPU copy that stays valid while training continues
+    return {name: tensor.detach().to('cpu', copy=True)
+            for name, tensor in model.state_dict().items()}
+
+
+class CheckpointManager(object):
+    """Keep the `max_keep` best checkpoints of a run by a validation metric.
+
+    `save` snapshots the model's state_dict and hands it to a background
+    thread, which writes it to `step_path` and removes the checkpoints that
+    dropped out of the best `max_keep`. Whenever the metric improves, the
+    snapshot is also written to `path`, where the evaluators look for the
+    trained model. Use the manager as a context, or call `close`, to wait for
+    the pending writes.
+    """
+
+    def __init__(self, path=None, max_keep=1, mode='min', step_path=None, max_pending=2):
+        if mode not in ('min', 'max'):
+            raise ValueError("Specify min or max")
+        if step_path is None:
+            root, ext = os.path.splitext(path)
+            step_path = root + '-step{step:04d}' + ext
+
+        self.path = path
+        self.step_path = step_path
+        self.max_keep = max(int(max_keep), 1)
+        self.sign = 1. if mode == 'min' else -1.
+        # (signed metric, step) of the kept checkpoints, best first
+        self.kept = []
+        self.error = None
+
+        self.jobs = queue.Queue(maxsize=max_pending)
+        self.worker = threading.Thread(target=self._write_loop, daemon=True)
+        self.worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def best(self):
+        return self.sign * self.kept[0][0] if self.kept else None
+
+    def save(self, model, metric, step):
+        """Checkpoint `model` if `metric` is among the best `max_keep` seen so
+        far. Returns True when it is the new best one."""
+        self._raise_error()
+        score = self.sign * float(metric)
+        if math.isnan(score):
+            return False
+        if len(self.kept) >= self.max_keep and score >= self.kept[-1][0]:
+            return False
+
+        is_best = len(self.kept) == 0 or score < self.kept[0][0]
+        paths = [self.step_path.format(step=step)]
+        if is_best and self.path is not None:
+            paths.append(self.path)
+
+        # stable sort: on ties the older checkpoint ranks first
+        self.kept = sorted(self.kept + [(score, step)], key=lambda kept: kept[0])
+        removed = [self.step_path.format(step=step) for _, step in self.kept[self.max_keep:]]
+        self.kept = self.kept[:self.max_keep]
+
+        # blocks only while `max_pending` snapshots are already queued
+        self.jobs.put((state_dict_snapshot(model), paths, removed))
+        return is_best
+
+    def close(self):
+        if self.worker.is_alive():
+            self.jobs.put(None)
+            self.worker.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _write_loop(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            state, paths, removed = job
+            try:
+                for path in paths:
+                    atomic_write(path, lambda f: torch.save(state, f))
+                for path in removed:
+                    if os.path.exists(path):
+                        os.remove(path)
+            except Exception as error:
+                self.error = error
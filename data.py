@@ -1,10 +1,12 @@
 import os
+import json
+import tempfile
 from typing import cast
 
 import numpy as np
 import pandas as pd
 
-from utils import allexists
+from utils import allexists, atomic_write, file_lock
 
 DATASETPATH = 'dataset/'
 
@@ -141,31 +143,87 @@ def load_credit():
     return feat, labels, sensitive
 
 
+DONOR_CHUNKSIZE = 100000
+
+DONOR_FEATURE_COLS = [
+    'projectid',
+    # 'school_city',
+    'school_state',
+    'school_charter',
+    'school_magnet',
+    'school_year_round',
+    'school_nlns',
+    'school_kipp',
+    'school_charter_ready_promise',
+    'teacher_prefix',
+    'teacher_teach_for_america',
+    'teacher_ny_teaching_fellow',
+    'primary_focus_subject',
+    'primary_focus_area',
+    'secondary_focus_subject',
+    'secondary_focus_area',
+    'resource_type',
+    'poverty_level',
+    'grade_level',
+    'fulfillment_labor_materials',
+    'total_price_excluding_optional_support',
+    'total_price_including_optional_support',
+    'students_reached',
+    'eligible_double_your_impact_match',
+    'eligible_almost_home_match'
+]
+
+DONOR_LABEL_COLS = [
+    'fully_funded',
+    'at_least_1_teacher_referred_donor',
+    # 'great_chat',
+    'at_least_1_green_donation',
+    # 'three_or_more_non_teacher_referred_donors',
+    # 'one_non_teacher_referred_donor_giving_100_plus',
+    'donation_from_thoughtful_donor',
+]
+
+DONOR_CATEGORICAL_FEATURES = [
+    'school_state',
+    'teacher_prefix',
+    'primary_focus_subject',
+    'primary_focus_area',
+    'secondary_focus_subject',
+    'secondary_focus_area',
+    'resource_type',
+    'poverty_level',
+    'grade_level',
+]
+
+DONOR_BINARY_FEATURES = [
+    'school_charter',
+    'school_magnet',
+    'school_year_round',
+    'school_nlns',
+    'school_kipp',
+    'school_charter_ready_promise',
+    'teacher_teach_for_america',
+    'teacher_ny_teaching_fellow',
+    'eligible_double_your_impact_match',
+    'eligible_almost_home_match',
+]
+
+DONOR_NORMALIZED_FEATURES = [
+    'total_price_excluding_optional_support',
+    'total_price_including_optional_support',
+    'students_reached'
+]
+
+DONOR_SENSITIVE = ['poverty_level', 'teacher_prefix']
+
+
 def _load_donor_label(subset=None):
-    label_cols = [
-        'projectid',
-        'fully_funded',
-        'at_least_1_teacher_referred_donor',
-        # 'great_chat',
-        'at_least_1_green_donation',
-        # 'three_or_more_non_teacher_referred_donors',
-        # 'one_non_teacher_referred_donor_giving_100_plus',
-        'donation_from_thoughtful_donor',
-    ]
     df = pd.read_csv(DATASETPATH + 'donor/outcomes.csv')
-    labels = df[label_cols]
-    if subset:
+    labels = df[['projectid'] + DONOR_LABEL_COLS]
+    if subset is not None:
         labels = pd.merge(labels, subset, how='inner', on='projectid')
 
-    for binary_feat in [
-        'fully_funded',
-        'at_least_1_teacher_referred_donor',
-        # 'great_chat',
-        'at_least_1_green_donation',
-        # 'three_or_more_non_teacher_referred_donors',
-        # 'one_non_teacher_referred_donor_giving_100_plus',
-        'donation_from_thoughtful_donor'
-    ]:
+    for binary_feat in DONOR_LABEL_COLS:
         labels[binary_feat] = (labels[binary_feat] == 't')
 
     return labels
@@ -175,68 +233,36 @@ def _load_test_projectid():
     return pd.read_csv(DATASETPATH + 'donor/sampleSubmission.csv')[['projectid']]
 
 
-def _load_donor_resource_cost(subset=None):
-    resource = pd.read_csv(DATASETPATH + 'donor/resources.csv')
-    if subset:
-        resource = pd.merge(resource, subset, how='inner', on='projectid')
-    resource = resource[0 <= resource['item_unit_price'] <= 1e-5]
-    resource['item_cost'] = resource['item_unit_price'] * \
-        resource['item_quantity']
-    resource = resource.groupby('projectid').agg(
-        {'item_cost': np.sum}).reset_index()
-    resource = resource.rename(columns={'item_cost': 'resource_cost'})
+def _load_donor_resource_cost(subset=None, chunksize=DONOR_CHUNKSIZE):
+    # resources.csv is several GB: aggregate the item costs chunk by chunk
+    resource_cost = pd.Series(dtype=np.float64)
+    for resource in pd.read_csv(
+            DATASETPATH + 'donor/resources.csv', chunksize=chunksize,
+            usecols=['projectid', 'item_unit_price', 'item_quantity'],
+            dtype={'projectid': str, 'item_unit_price': np.float64, 'item_quantity': np.float64}):
+        if subset is not None:
+            resource = resource[resource['projectid'].isin(subset['projectid'])]
+        price = resource['item_unit_price']
+        resource = resource[(0 <= price) & (price <= 1e-5)]
+        item_cost = resource['item_unit_price'] * resource['item_quantity']
+        resource_cost = resource_cost.add(
+            item_cost.groupby(resource['projectid']).sum(), fill_value=0)
+
+    resource = resource_cost.rename('resource_cost').rename_axis(
+        'projectid').reset_index()
 
     return resource
 
 
 def _load_donor_projects(subset=None):
-    feat_cols = [
-        'projectid',
-        # 'school_city',
-        'school_state',
-        'school_charter',
-        'school_magnet',
-        'school_year_round',
-        'school_nlns',
-        'school_kipp',
-        'school_charter_ready_promise',
-        'teacher_prefix',
-        'teacher_teach_for_america',
-        'teacher_ny_teaching_fellow',
-        'primary_focus_subject',
-        'primary_focus_area',
-        'secondary_focus_subject',
-        'secondary_focus_area',
-        'resource_type',
-        'poverty_level',
-        'grade_level',
-        'fulfillment_labor_materials',
-        'total_price_excluding_optional_support',
-        'total_price_including_optional_support',
-        'students_reached',
-        'eligible_double_your_impact_match',
-        'eligible_almost_home_match'
-    ]
-
-    feat = pd.read_csv(DATASETPATH + 'donor/projects.csv')[feat_cols]
-    if subset:
+    feat = pd.read_csv(DATASETPATH + 'donor/projects.csv')[DONOR_FEATURE_COLS]
+    if subset is not None:
         feat = pd.merge(feat, subset, how='inner', on='projectid')
 
-    for binary_feat in [
-        'school_charter',
-        'school_magnet',
-        'school_year_round',
-        'school_nlns',
-        'school_kipp',
-        'school_charter_ready_promise',
-        'teacher_teach_for_america',
-        'teacher_ny_teaching_fellow',
-        'eligible_double_your_impact_match',
-        'eligible_almost_home_match',
-    ]:
+    for binary_feat in DONOR_BINARY_FEATURES:
         feat[binary_feat] = (feat[binary_feat] == 't')
 
-    sensitive = ['poverty_level', 'teacher_prefix']
+    sensitive = list(DONOR_SENSITIVE)
     return feat, sensitive
 
 
@@ -261,34 +287,219 @@ def load_donor(subset=None):
     feat = feat.fillna(0)
     labels = labels.fillna(0)
 
-    for normalize in [
-        'total_price_excluding_optional_support',
-        'total_price_including_optional_support',
-        'students_reached'
-    ]:
+    for normalize in DONOR_NORMALIZED_FEATURES:
         feat[normalize] = (feat[normalize] - feat[normalize].min()) / \
                           (feat[normalize].max() - feat[normalize].min())
 
     return feat, labels, sensitive
 
 
-def preprocess(df, categorical_encode, show_categorcial_idx=False):
-    df = np.array(df)
+def _stream_donor_labels(chunksize=DONOR_CHUNKSIZE):
+    labels = []
+    for chunk in pd.read_csv(
+            DATASETPATH + 'donor/outcomes.csv', chunksize=chunksize,
+            usecols=['projectid'] + DONOR_LABEL_COLS, dtype=str):
+        chunk = chunk.set_index('projectid')[DONOR_LABEL_COLS]
+        labels.append(chunk == 't')
+
+    return pd.concat(labels)
+
+
+def _stream_donor_projects(projectids, chunksize=DONOR_CHUNKSIZE):
+    dtype = {col: str for col in
+             ['projectid'] + DONOR_CATEGORICAL_FEATURES + DONOR_BINARY_FEATURES}
+    for chunk in pd.read_csv(
+            DATASETPATH + 'donor/projects.csv', chunksize=chunksize,
+            usecols=DONOR_FEATURE_COLS, dtype=dtype):
+        # keep the column order of `_load_donor_projects`
+        chunk = chunk[DONOR_FEATURE_COLS]
+        chunk = chunk[chunk['projectid'].isin(projectids)].copy()
+        for binary_feat in DONOR_BINARY_FEATURES:
+            chunk[binary_feat] = (chunk[binary_feat] == 't')
+        chunk[DONOR_CATEGORICAL_FEATURES] = chunk[DONOR_CATEGORICAL_FEATURES].fillna(
+            '0')
+        chunk = chunk.fillna(0)
+        yield chunk
+
+
+def stream_donor_to_cache(categorical_encode, chunksize=DONOR_CHUNKSIZE, with_resource_cost=False):
+    """Build the donor dataset cache without loading the Kaggle CSVs at once.
+
+    Labels are joined to `projects.csv` by `projectid` chunk by chunk. A first
+    pass collects the category vocabularies, the min/max used for
+    normalisation and the number of joined rows. A second pass encodes every
+    chunk and writes it straight into the memory-mapped cache arrays, so peak
+    memory is bounded by `chunksize` and the size of the label table.
+    """
+    if categorical_encode not in ['onehot', 'categorical']:
+        raise ValueError('can only stream donor with a categorical_encode')
+
+    print('prepare dataset: donor (streaming)...')
+    labels = _stream_donor_labels(chunksize)
+    projectids = labels.index
+    if with_resource_cost:
+        resource_cost = _load_donor_resource_cost(chunksize=chunksize)
+        resource_cost = resource_cost.set_index('projectid')['resource_cost']
+        projectids = projectids.intersection(resource_cost.index)
+
+    # first pass: vocabularies, normalisation statistics and row count
+    n_rows = 0
+    categories = {col: set() for col in DONOR_CATEGORICAL_FEATURES}
+    minimum = {col: np.inf for col in DONOR_NORMALIZED_FEATURES}
+    maximum = {col: -np.inf for col in DONOR_NORMALIZED_FEATURES}
+    for chunk in _stream_donor_projects(projectids, chunksize):
+        n_rows += len(chunk)
+        for col in DONOR_CATEGORICAL_FEATURES:
+            categories[col].update(chunk[col].astype(str).unique())
+        for col in DONOR_NORMALIZED_FEATURES:
+            minimum[col] = min(minimum[col], chunk[col].min())
+            maximum[col] = max(maximum[col], chunk[col].max())
+
+    feat_cols = [col for col in DONOR_FEATURE_COLS if col != 'projectid']
+    if with_resource_cost:
+        feat_cols.append('resource_cost')
+    nonsensitive_cols = [col for col in feat_cols if col not in DONOR_SENSITIVE]
+    vocabulary = {col: np.array(sorted(categories[col]))
+                  if col in categories else None for col in feat_cols}
+    nonsensitive_vocab = [vocabulary[col] for col in nonsensitive_cols]
+    sensitive_vocab = [vocabulary[col] for col in DONOR_SENSITIVE]
+
+    def encoded_width(vocab):
+        if categorical_encode == 'categorical':
+            return len(vocab)
+        return sum(1 if v is None else len(v) for v in vocab)
+
+    # second pass: encode and write every chunk in place
+    cachepath = os.path.join(DATASETPATH + 'donor', 'cache')
+    os.makedirs(cachepath, exist_ok=True)
+    blocks = {}
+    tmp_paths = []
+    try:
+        for name, width in [('nonsensitive', encoded_width(nonsensitive_vocab)),
+                            ('sensitive', encoded_width(sensitive_vocab)),
+                            ('label', len(DONOR_LABEL_COLS))]:
+            fd, tmp_path = tempfile.mkstemp(dir=cachepath, suffix='.tmp')
+            os.close(fd)
+            tmp_paths.append(tmp_path)
+            blocks[name] = (tmp_path, np.lib.format.open_memmap(
+                tmp_path, mode='w+', dtype=np.float32, shape=(n_rows, width)))
+
+        start = 0
+        for chunk in _stream_donor_projects(projectids, chunksize):
+            end = start + len(chunk)
+            for col in DONOR_NORMALIZED_FEATURES:
+                chunk[col] = (chunk[col] - minimum[col]) / \
+                             (maximum[col] - minimum[col])
+            if with_resource_cost:
+                chunk['resource_cost'] = resource_cost.loc[chunk['projectid']].to_numpy()
+
+            blocks['nonsensitive'][1][start:end] = preprocess(
+                chunk[nonsensitive_cols], categorical_encode, vocabulary=nonsensitive_vocab)
+            blocks['sensitive'][1][start:end] = preprocess(
+                chunk[DONOR_SENSITIVE], categorical_encode, vocabulary=sensitive_vocab)
+            blocks['label'][1][start:end] = labels.loc[
+                chunk['projectid']].to_numpy(dtype=np.float32)
+            start = end
+
+        groups = {}
+        for name, (tmp_path, block) in blocks.items():
+            block.flush()
+            filename = f'{name}_{categorical_encode}.npy'
+            os.replace(tmp_path, os.path.join(cachepath, filename))
+            groups[name] = {'layout': 'matrix', 'file': filename,
+                            'dtype': block.dtype.str, 'shape': list(block.shape)}
+        blocks.clear()
+    except BaseException:
+        # a failed stream must not leave full-size arrays behind, as in
+        # `utils.atomic_write`
+        blocks.clear()
+        for tmp_path in tmp_paths:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        raise
+
+    _write_dataset_manifest('donor', categorical_encode, n_rows, groups)
+
+
+def preprocess(df, categorical_encode, show_categorcial_idx=False, vocabulary=None, return_vocabulary=False):
+    """Encode a DataFrame (or 2-d array) column by column.
+
+    String columns are one-hot or categorically encoded, other columns are
+    cast to float32. `vocabulary` holds the sorted categories of every
+    column (None for numeric ones); pass the one returned with
+    `return_vocabulary=True` to encode new data the same way, in which case
+    unseen categories are encoded as all zeros (onehot) or -1 (categorical).
+    """
     if categorical_encode not in ['onehot', 'categorical', None]:
         raise ValueError('Unrecognized categorical_encode')
+    if categorical_encode is None:
+        if vocabulary is not None or return_vocabulary:
+            raise ValueError('vocabulary requires a categorical_encode')
+        return _preprocess_raw(df, show_categorcial_idx)
+
+    if not isinstance(df, pd.DataFrame):
+        df = pd.DataFrame(np.asarray(df))
+    columns = [df.iloc[:, i] for i in range(df.shape[1])]
+
+    npy_str_idx = []
+    codes = []
+    if vocabulary is None:
+        vocabulary = []
+        for i, col in enumerate(columns):
+            if isinstance(col.iloc[0], str):
+                npy_str_idx.append(i)
+                unique_val, code = np.unique(
+                    col.to_numpy().astype(str), return_inverse=True)
+                vocabulary.append(unique_val)
+                codes.append(code.reshape(-1))
+            else:
+                vocabulary.append(None)
+                codes.append(None)
+    else:
+        if len(vocabulary) != len(columns):
+            raise ValueError('vocabulary does not match the number of columns')
+        for i, (col, unique_val) in enumerate(zip(columns, vocabulary)):
+            if unique_val is not None:
+                npy_str_idx.append(i)
+                val = col.to_numpy().astype(str)
+                code = np.searchsorted(unique_val, val)
+                code_clip = np.minimum(code, len(unique_val) - 1)
+                codes.append(np.where(unique_val[code_clip] == val, code, -1))
+            else:
+                codes.append(None)
+
+    widths = [len(unique_val) if unique_val is not None and categorical_encode == 'onehot' else 1
+              for unique_val in vocabulary]
+    npy = np.zeros((len(df), sum(widths)), dtype=np.float32)
+    rows = np.arange(len(df))
+    offset = 0
+    for col, code, width in zip(columns, codes, widths):
+        if code is None:
+            npy[:, offset] = col.to_numpy(dtype=np.float32)
+        elif categorical_encode == 'onehot':
+            known = code >= 0
+            npy[rows[known], offset + code[known]] = 1.
+        else:
+            npy[:, offset] = code
+        offset += width
+
+    outputs = [npy]
+    if show_categorcial_idx:
+        outputs.append(npy_str_idx)
+    if return_vocabulary:
+        outputs.append(vocabulary)
+    return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+
+def _preprocess_raw(df, show_categorcial_idx=False):
+    # categorical_encode=None: keep strings, cast the other columns to float32
+    df = np.array(df)
 
     npy_cast = []
     npy_str_idx = []
     for i in range(df.shape[1]):
         col = df[:, i]
-        if isinstance(col[0], str):
-            if categorical_encode:
-                npy_str_idx.append(i)
-                if categorical_encode == 'onehot':
-                    col = onehot(col)
-                else:
-                    col = categroical(col)
-        else:
+        if not isinstance(col[0], str):
             col = col.astype(np.float32)
 
         if len(col.shape) == 1:
@@ -320,13 +531,7 @@ def cast_to_float(df):
     return df
 
 
-def load_data(dataset, mode, separate_sensitive=False, categorical_encode='onehot'):
-    if categorical_encode not in ['onehot', 'categorical', None]:
-        raise ValueError('Unrecognized categorical_encode')
-
-    if dataset not in ['adult', 'donor', 'credit']:
-        raise NotImplementedError()
-
+def _legacy_dataset_files(dataset, categorical_encode):
     datapath = DATASETPATH + dataset
     sensitive_featfile = os.path.join(
         datapath, f'sensitive_{categorical_encode}.npy')
@@ -334,43 +539,195 @@ def load_data(dataset, mode, separate_sensitive=False, categorical_encode='oneho
         datapath, f'nonsensitive_{categorical_encode}.npy')
     labelfile = os.path.join(
         datapath, f'label_{categorical_encode}.npy')
+    return sensitive_featfile, nonsensitive_featfile, labelfile
 
-    if not allexists(sensitive_featfile, nonsensitive_featfile, labelfile):
-        print(f'prepare dataset: {dataset}...')
-        if dataset == 'adult':
-            feat, labels, sensitive = load_adult()
-        elif dataset == 'donor':
-            feat, labels, sensitive = load_donor()
-        elif dataset == 'credit':
-            feat, labels, sensitive = load_credit()
-        else:
-            raise NotImplementedError()
-
-        sensitive_feat = feat[sensitive]
-        nonsensitive_feat = feat.drop(sensitive, axis=1)
 
-        nonsensitive_feat = preprocess(
-            nonsensitive_feat, categorical_encode)
-        sensitive_feat = preprocess(
-            sensitive_feat, categorical_encode)
-        labels = preprocess(
-            labels, categorical_encode)
-
-        np.save(open(sensitive_featfile, 'wb'), sensitive_feat)
-        np.save(open(nonsensitive_featfile, 'wb'), nonsensitive_feat)
-        np.save(open(labelfile, 'wb'), labels)
-    else:
-        print(f'load existing dataset: {dataset}...')
+def _prepare_dataset(dataset, categorical_encode):
+    sensitive_featfile, nonsensitive_featfile, labelfile = _legacy_dataset_files(
+        dataset, categorical_encode)
 
+    if allexists(sensitive_featfile, nonsensitive_featfile, labelfile):
+        # convert datasets prepared in the old pickled `.npy` format
+        print(f'convert existing dataset: {dataset}...')
         sensitive_feat = np.load(
             open(sensitive_featfile, 'rb'), allow_pickle=True)
         nonsensitive_feat = np.load(
             open(nonsensitive_featfile, 'rb'), allow_pickle=True)
         labels = np.load(open(labelfile, 'rb'), allow_pickle=True)
+        return nonsensitive_feat, sensitive_feat, labels
+
+    print(f'prepare dataset: {dataset}...')
+    if dataset == 'adult':
+        feat, labels, sensitive = load_adult()
+    elif dataset == 'donor':
+        feat, labels, sensitive = load_donor()
+    elif dataset == 'credit':
+        feat, labels, sensitive = load_credit()
+    else:
+        raise NotImplementedError()
+
+    sensitive_feat = feat[sensitive]
+    nonsensitive_feat = feat.drop(sensitive, axis=1)
+
+    nonsensitive_feat = preprocess(
+        nonsensitive_feat, categorical_encode)
+    sensitive_feat = preprocess(
+        sensitive_feat, categorical_encode)
+    labels = preprocess(
+        labels, categorical_encode)
+
+    return nonsensitive_feat, sensitive_feat, labels
+
+
+def _dataset_cache_manifest(dataset, categorical_encode):
+    return os.path.join(
+        DATASETPATH + dataset, 'cache', f'manifest_{categorical_encode}.json')
+
+
+def _typed_column(col):
+    # infer a fixed dtype for one column of an object array
+    col = np.array(col.tolist())
+    if col.dtype == np.float64:
+        col = col.astype(np.float32)
+    elif col.dtype == object:
+        col = col.astype(str)
+    return col
+
+
+def save_dataset_cache(dataset, categorical_encode, nonsensitive_feat, sensitive_feat, labels):
+    """Write a dataset as typed `.npy` arrays plus a JSON manifest.
+
+    Numeric blocks are stored as one float32 matrix each. Object blocks
+    (`categorical_encode=None`) are stored column by column with a fixed
+    dtype per column. Nothing is pickled, so every array can be memory-mapped.
+    The manifest is written last and marks a complete cache.
+    """
+    cachepath = os.path.join(DATASETPATH + dataset, 'cache')
+    os.makedirs(cachepath, exist_ok=True)
+
+    n_rows = len(nonsensitive_feat)
+    groups = {}
+    for name, block in [('nonsensitive', nonsensitive_feat),
+                        ('sensitive', sensitive_feat),
+                        ('label', labels)]:
+        block = np.asarray(block)
+        if len(block) != n_rows:
+            raise ValueError(f'Inconsistent row count of {name}: '
+                             f'expected {n_rows}, observed {len(block)}')
+
+        if block.dtype != object:
+            block = np.ascontiguousarray(cast_to_float(block))
+            filename = f'{name}_{categorical_encode}.npy'
+            atomic_write(os.path.join(cachepath, filename),
+                         lambda f: np.save(f, block, allow_pickle=False))
+            groups[name] = {'layout': 'matrix', 'file': filename,
+                            'dtype': block.dtype.str, 'shape': list(block.shape)}
+        else:
+            columns = []
+            for j in range(block.shape[1]):
+                col = _typed_column(block[:, j])
+                filename = f'{name}_{categorical_encode}-{j:03d}.npy'
+                atomic_write(os.path.join(cachepath, filename),
+                             lambda f: np.save(f, col, allow_pickle=False))
+                columns.append({'file': filename, 'dtype': col.dtype.str})
+            groups[name] = {'layout': 'columns', 'columns': columns,
+                            'shape': list(block.shape)}
+
+    _write_dataset_manifest(dataset, categorical_encode, n_rows, groups)
+
+
+def _write_dataset_manifest(dataset, categorical_encode, n_rows, groups):
+    manifest = {'dataset': dataset, 'categorical_encode': categorical_encode,
+                'n_rows': n_rows, 'groups': groups}
+    atomic_write(_dataset_cache_manifest(dataset, categorical_encode),
+                 lambda f: f.write(json.dumps(manifest, indent=2).encode('utf-8')))
+
+
+def load_dataset_cache(dataset, categorical_encode):
+    """Memory-map a dataset written by `save_dataset_cache`, None on a miss.
+
+    Numeric blocks are returned as read-only memory maps shared through the
+    page cache by concurrent processes. Column-stored blocks are assembled
+    into an object array as the old format returned them.
+    """
+    manifest_path = _dataset_cache_manifest(dataset, categorical_encode)
+    if not os.path.exists(manifest_path):
+        return None
+    cachepath = os.path.dirname(manifest_path)
+    manifest = json.load(open(manifest_path, 'r'))
+
+    blocks = []
+    for name in ['nonsensitive', 'sensitive', 'label']:
+        group = manifest['groups'][name]
+        if group['layout'] == 'matrix':
+            block = np.load(os.path.join(cachepath, group['file']),
+                            mmap_mode='r', allow_pickle=False)
+        else:
+            block = np.empty(group['shape'], dtype=object)
+            for j, column in enumerate(group['columns']):
+                block[:, j] = np.load(os.path.join(cachepath, column['file']),
+                                      mmap_mode='r', allow_pickle=False)
+        if tuple(block.shape) != tuple(group['shape']) or len(block) != manifest['n_rows']:
+            raise ValueError(f'Corrupted dataset cache {manifest_path}: '
+                             f'unexpected shape of {name} {block.shape}')
+        blocks.append(block)
+
+    return tuple(blocks)
+
+
+# (dataset, categorical_encode) -> float blocks kept in memory by `preload_data`
+_PRELOADED = {}
+
+
+def _load_blocks(dataset, categorical_encode):
+    datapath = DATASETPATH + dataset
+    cached = load_dataset_cache(dataset, categorical_encode)
+    if cached is None:
+        os.makedirs(os.path.join(datapath, 'cache'), exist_ok=True)
+        with file_lock(_dataset_cache_manifest(dataset, categorical_encode) + '.lock'):
+            cached = load_dataset_cache(dataset, categorical_encode)
+            if cached is None and dataset == 'donor' and categorical_encode is not None and \
+                    not allexists(*_legacy_dataset_files(dataset, categorical_encode)):
+                stream_donor_to_cache(categorical_encode)
+                cached = load_dataset_cache(dataset, categorical_encode)
+            if cached is None:
+                nonsensitive_feat, sensitive_feat, labels = _prepare_dataset(
+                    dataset, categorical_encode)
+                save_dataset_cache(
+                    dataset, categorical_encode,
+                    nonsensitive_feat, sensitive_feat, labels)
+                cached = load_dataset_cache(dataset, categorical_encode)
+    else:
+        print(f'load existing dataset: {dataset}...')
+    nonsensitive_feat, sensitive_feat, labels = cached
 
     sensitive_feat = cast_to_float(sensitive_feat)
     nonsensitive_feat = cast_to_float(nonsensitive_feat)
     labels = cast_to_float(labels)
+    return nonsensitive_feat, sensitive_feat, labels
+
+
+def preload_data(dataset, categorical_encode='onehot'):
+    """Keep `dataset` in this process's memory for later `load_data` calls.
+
+    A parent that preloads before forking workers hands them the arrays
+    copy-on-write, so the workers skip the cache reads and float casts.
+    """
+    if (dataset, categorical_encode) not in _PRELOADED:
+        _PRELOADED[dataset, categorical_encode] = _load_blocks(dataset, categorical_encode)
+
+
+def load_data(dataset, mode, separate_sensitive=False, categorical_encode='onehot'):
+    if categorical_encode not in ['onehot', 'categorical', None]:
+        raise ValueError('Unrecognized categorical_encode')
+
+    if dataset not in ['adult', 'donor', 'credit']:
+        raise NotImplementedError()
+
+    if (dataset, categorical_encode) in _PRELOADED:
+        nonsensitive_feat, sensitive_feat, labels = _PRELOADED[dataset, categorical_encode]
+    else:
+        nonsensitive_feat, sensitive_feat, labels = _load_blocks(dataset, categorical_encode)
 
     train_val_cnt = int(0.9 * len(nonsensitive_feat))
 
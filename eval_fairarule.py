@@ -87,23 +87,8 @@ def evaluate_mpvae(model, data, eval_fairness=True, eval_train=True, eval_valid=
                 c_loss = train_c_loss / len(data.train_idx)
                 total_loss = train_total_loss / len(data.train_idx)
 
-                best_val_metrics = None
-                for threshold in THRESHOLDS:
-                    val_metrics = evals.compute_metrics(
-                        train_indiv_prob, train_label, threshold, all_metrics=True)
-
-                    if best_val_metrics is None:
-                        best_val_metrics = {}
-                        for metric in METRICS:
-                            best_val_metrics[metric] = val_metrics[metric]
-                    else:
-                        for metric in METRICS:
-                            if 'FDR' in metric:
-                                best_val_metrics[metric] = min(
-                                    best_val_metrics[metric], val_metrics[metric])
-                            else:
-                                best_val_metrics[metric] = max(
-                                    best_val_metrics[metric], val_metrics[metric])
+                best_val_metrics = evals.best_threshold_metrics(
+                    train_indiv_prob, train_label, THRESHOLDS, METRICS)
 
                 acc, ha, ebf1, maf1, mif1 = best_val_metrics['ACC'], best_val_metrics['HA'], \
                     best_val_metrics['ebF1'], best_val_metrics['maF1'], \
@@ -208,23 +193,8 @@ def evaluate_mpvae(model, data, eval_fairness=True, eval_train=True, eval_valid=
                 c_loss = valid_c_loss / len(data.valid_idx)
                 total_loss = valid_total_loss / len(data.valid_idx)
 
-                best_val_metrics = None
-                for threshold in THRESHOLDS:
-                    val_metrics = evals.compute_metrics(
-                        valid_indiv_prob, valid_label, threshold, all_metrics=True)
-
-                    if best_val_metrics is None:
-                        best_val_metrics = {}
-                        for metric in METRICS:
-                            best_val_metrics[metric] = val_metrics[metric]
-                    else:
-                        for metric in METRICS:
-                            if 'FDR' in metric:
-                                best_val_metrics[metric] = min(
-                                    best_val_metrics[metric], val_metrics[metric])
-                            else:
-                                best_val_metrics[metric] = max(
-                                    best_val_metrics[metric], val_metrics[metric])
+                best_val_metrics = evals.best_threshold_metrics(
+                    valid_indiv_prob, valid_label, THRESHOLDS, METRICS)
 
                 acc, ha, ebf1, maf1, mif1 = best_val_metrics['ACC'], best_val_metrics['HA'], \
                     best_val_metrics['ebF1'], best_val_metrics['maF1'], \
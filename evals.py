@@ -1,9 +1,5 @@
 import sys
-from sklearn import metrics
-import math
 import os
-from sklearn.metrics import auc
-from copy import deepcopy
 import numpy as np
 import warnings
 import time
@@ -126,80 +122,152 @@ def f1_score(true_targets, predictions, average='micro', axis=0):
     return f1
 
 
-def compute_fdr(all_targets, all_predictions, fdr_cutoff=0.5):
-    fdr_array = []
-    for i in range(all_targets.shape[1]):
-        try:
-            precision, recall, thresholds = metrics.precision_recall_curve(all_targets[:, i], all_predictions[:, i], pos_label=1)
-            fdr = 1- precision
-            cutoff_index = next(i for i, x in enumerate(fdr) if x <= fdr_cutoff)
-            fdr_at_cutoff = recall[cutoff_index]
-            if not math.isnan(fdr_at_cutoff):
-                fdr_array.append(np.nan_to_num(fdr_at_cutoff))
-        except: 
-            pass
-    
-    fdr_array = np.array(fdr_array)
+def label_curves(all_targets, all_predictions):
+    """Cumulative TP/FP counts of every label column, sorted once.
+
+    Row k holds the counts when the k+1 highest scores of a column are
+    predicted positive. Rows inside a run of tied scores carry the counts
+    at the end of the run, so ties become single steps of the ROC and PR
+    curves as in sklearn. Returns (tps, fps, finite), where `finite` marks
+    the columns without NaN or infinite scores.
+    """
+    all_targets = np.asarray(all_targets)
+    all_predictions = np.asarray(all_predictions, dtype=np.float64)
+    n_sample = len(all_predictions)
+    finite = np.isfinite(all_predictions).all(axis=0)
+
+    order = np.argsort(-all_predictions, axis=0, kind='mergesort')
+    scores = np.take_along_axis(all_predictions, order, axis=0)
+    positive = np.take_along_axis(all_targets == 1, order, axis=0)
+    tps = np.cumsum(positive, axis=0, dtype=np.float64)
+    fps = np.arange(1, n_sample + 1, dtype=np.float64)[:, None] - tps
+
+    # index of the last row of each run of equal scores
+    tie_end = np.ones(scores.shape, dtype=bool)
+    tie_end[:-1] = scores[1:] != scores[:-1]
+    run_end = np.where(tie_end, np.arange(n_sample)[:, None], n_sample)
+    run_end = np.minimum.accumulate(run_end[::-1], axis=0)[::-1]
+    tps = np.take_along_axis(tps, run_end, axis=0)
+    fps = np.take_along_axis(fps, run_end, axis=0)
+    return tps, fps, finite
+
+
+def _trapezoid(x, y, x0, y0):
+    # area under the curve starting at (x0, y0), one column per label
+    x = np.vstack([np.full((1, x.shape[1]), x0), x])
+    y = np.vstack([np.full((1, y.shape[1]), y0), y])
+    return np.sum(np.diff(x, axis=0) * (y[1:] + y[:-1]) / 2, axis=0)
+
+
+def _precision_recall(tps, fps):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = tps / (tps + fps)
+        # recall is undefined (nan) for a label without positives
+        recall = tps / tps[-1]
+    return precision, recall
+
+
+def compute_fdr(all_targets, all_predictions, fdr_cutoff=0.5, curves=None):
+    """Recall at the lowest threshold whose false discovery rate is at most
+    `fdr_cutoff`, per label. Labels with non-finite scores or an undefined
+    recall are skipped."""
+    tps, fps, finite = label_curves(all_targets, all_predictions) \
+        if curves is None else curves
+    precision, recall = _precision_recall(tps, fps)
+
+    satisfied = (1 - precision) <= fdr_cutoff
+    lowest = len(satisfied) - 1 - np.argmax(satisfied[::-1], axis=0)
+    fdr_array = np.take_along_axis(recall, lowest[None], axis=0)[0]
+    # otherwise only the curve's end point (precision 1, recall 0) is left
+    fallback = 0. if fdr_cutoff >= 0 else np.nan
+    fdr_array = np.where(satisfied.any(axis=0), fdr_array, fallback)
+    fdr_array = fdr_array[finite & ~np.isnan(fdr_array)]
+
     mean_fdr = np.mean(fdr_array)
     median_fdr = np.median(fdr_array)
     var_fdr = np.var(fdr_array)
     return mean_fdr, median_fdr, var_fdr, fdr_array
 
 
-def compute_aupr(all_targets, all_predictions):
-    aupr_array = []
-    for i in range(all_targets.shape[1]):
-        precision, recall, thresholds = metrics.precision_recall_curve(all_targets[:, i], all_predictions[:, i], pos_label=1)
-        auPR = metrics.auc(recall, precision)
-        if not math.isnan(auPR):
-            aupr_array.append(np.nan_to_num(auPR))
-    aupr_array = np.array(aupr_array)
+def compute_aupr(all_targets, all_predictions, curves=None):
+    """Area under the precision-recall curve, per label. Labels without
+    positives are skipped; non-finite scores raise a ValueError."""
+    tps, fps, finite = label_curves(all_targets, all_predictions) \
+        if curves is None else curves
+    if not finite.all():
+        raise ValueError('Input contains NaN or infinity.')
+    precision, recall = _precision_recall(tps, fps)
+
+    aupr_array = _trapezoid(recall, precision, 0., 1.)
+    aupr_array = aupr_array[~np.isnan(aupr_array)]
     mean_aupr = np.mean(aupr_array)
     median_aupr = np.median(aupr_array)
     var_aupr = np.var(aupr_array)
     return mean_aupr, median_aupr, var_aupr, aupr_array
 
 
-def compute_auc(all_targets, all_predictions):
-    auc_array = []
-    for i in range(all_targets.shape[1]):
-        try:  
-            auROC = metrics.roc_auc_score(all_targets[:, i], all_predictions[:, i])
-            auc_array.append(auROC)
-        except ValueError:
-            pass
-    auc_array = np.array(auc_array)
+def compute_auc(all_targets, all_predictions, curves=None):
+    """Area under the ROC curve, per label. Labels with a single class or
+    non-finite scores are skipped."""
+    tps, fps, finite = label_curves(all_targets, all_predictions) \
+        if curves is None else curves
+    n_pos, n_neg = tps[-1], fps[-1]
+    defined = finite & (n_pos > 0) & (n_neg > 0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        auc_array = _trapezoid(fps / n_neg, tps / n_pos, 0., 0.)
+    auc_array = auc_array[defined]
     mean_auc = np.mean(auc_array)
     median_auc = np.median(auc_array)
     var_auc = np.var(auc_array)
     return mean_auc, median_auc, var_auc, auc_array
 
 
-def compute_metrics(predictions, targets, threshold, all_metrics=True):
-    all_targets = deepcopy(targets)
-    all_predictions = deepcopy(predictions)
+def ranking_metrics(predictions, targets, all_metrics=True):
+    """Threshold-independent metrics: AUC, AUPR, FDR and precision at k."""
+    all_targets = np.asarray(targets)
+    all_predictions = np.asarray(predictions)
 
     if all_metrics:
-        meanAUC, medianAUC, varAUC, allAUC = compute_auc(all_targets, all_predictions)
-        meanAUPR, medianAUPR, varAUPR, allAUPR = compute_aupr(all_targets, all_predictions)
-        meanFDR, medianFDR, varFDR, allFDR = compute_fdr(all_targets, all_predictions)
+        curves = label_curves(all_targets, all_predictions)
+        meanAUC, medianAUC, varAUC, allAUC = compute_auc(all_targets, all_predictions, curves)
+        meanAUPR, medianAUPR, varAUPR, allAUPR = compute_aupr(all_targets, all_predictions, curves)
+        meanFDR, medianFDR, varFDR, allFDR = compute_fdr(all_targets, all_predictions, curves=curves)
     else:
         meanAUC, medianAUC, varAUC, allAUC = 0, 0, 0, 0
         meanAUPR, medianAUPR, varAUPR, allAUPR = 0, 0, 0, 0
         meanFDR, medianFDR, varFDR, allFDR = 0, 0, 0, 0
 
-    p_at_1 = 0.
-    p_at_3 = 0.
-    p_at_5 = 0.
-    
     p_at_1 = ranking_precision_score(Y_true=all_targets, Y_score=all_predictions, k=1)
     p_at_3 = ranking_precision_score(Y_true=all_targets, Y_score=all_predictions, k=3)
     p_at_5 = ranking_precision_score(Y_true=all_targets, Y_score=all_predictions, k=5)
-    
+
+    metrics_dict = {}
+    metrics_dict['meanAUC'] = meanAUC
+    metrics_dict['medianAUC'] = medianAUC
+    metrics_dict['varAUC'] = varAUC
+    metrics_dict['allAUC'] = allAUC
+    metrics_dict['meanAUPR'] = meanAUPR
+    metrics_dict['medianAUPR'] = medianAUPR
+    metrics_dict['varAUPR'] = varAUPR
+    metrics_dict['allAUPR'] = allAUPR
+    metrics_dict['meanFDR'] = meanFDR
+    metrics_dict['medianFDR'] = medianFDR
+    metrics_dict['varFDR'] = varFDR
+    metrics_dict['allFDR'] = allFDR
+    metrics_dict['p_at_1'] = p_at_1
+    metrics_dict['p_at_3'] = p_at_3
+    metrics_dict['p_at_5'] = p_at_5
+    return metrics_dict
+
+
+def compute_metrics(predictions, targets, threshold, all_metrics=True):
+    all_targets = np.asarray(targets)
+    all_predictions = np.asarray(predictions)
+
     optimal_threshold = threshold
     
-    all_predictions[all_predictions < optimal_threshold] = 0
-    all_predictions[all_predictions >= optimal_threshold] = 1
+    all_predictions = (all_predictions >= optimal_threshold).astype(all_predictions.dtype)
 
     
     acc_ = list(subset_accuracy(all_targets, all_predictions, axis=1, per_sample=True))
@@ -220,21 +288,138 @@ def compute_metrics(predictions, targets, threshold, all_metrics=True):
     metrics_dict['ebF1'] = ebF1
     metrics_dict['miF1'] = miF1
     metrics_dict['maF1'] = maF1
-    metrics_dict['meanAUC'] = meanAUC
-    metrics_dict['medianAUC'] = medianAUC
-    metrics_dict['varAUC'] = varAUC
-    metrics_dict['allAUC'] = allAUC
-    metrics_dict['meanAUPR'] = meanAUPR
-    metrics_dict['medianAUPR'] = medianAUPR
-    metrics_dict['varAUPR'] = varAUPR
-    metrics_dict['allAUPR'] = allAUPR
-    metrics_dict['meanFDR'] = meanFDR
-    metrics_dict['medianFDR'] = medianFDR
-    metrics_dict['varFDR'] = varFDR
-    metrics_dict['allFDR'] = allFDR
-    metrics_dict['p_at_1'] = p_at_1
-    metrics_dict['p_at_3'] = p_at_3
-    metrics_dict['p_at_5'] = p_at_5
+    metrics_dict.update(ranking_metrics(predictions, targets, all_metrics))
 
     return metrics_dict
 
+
+def _count_above(group, level, positive, n_group, n_level):
+    # counts[g, k]: positive / negative entries of group g kept at threshold k
+    counts = []
+    for mask in (positive, ~positive):
+        flat = (group * (n_level + 1) + level)[mask]
+        count = np.bincount(flat, minlength=n_group * (n_level + 1))
+        count = count.reshape(n_group, n_level + 1)
+        counts.append(np.cumsum(count[:, ::-1], axis=1)[:, ::-1][:, 1:])
+    return counts
+
+
+def threshold_sweep(predictions, targets, thresholds):
+    """ACC/HA/ebF1/miF1/maF1 at every threshold, from one sorted pass.
+
+    Each prediction is located once among the sorted thresholds, which gives
+    the number of thresholds it passes. Per-label and per-sample TP/FP counts
+    for the whole grid are then histograms of that number. Returns a dict of
+    arrays aligned with `thresholds`.
+    """
+    all_targets = np.asarray(targets)
+    all_predictions = np.asarray(predictions)
+    n_sample, n_label = all_predictions.shape
+
+    order = np.argsort(thresholds)
+    sorted_thresholds = np.asarray(thresholds, dtype=all_predictions.dtype)[order]
+    n_level = len(sorted_thresholds)
+    # prediction >= threshold for the first `level` sorted thresholds
+    level = np.searchsorted(sorted_thresholds, all_predictions, side='right')
+    positive = all_targets == 1
+
+    label = np.broadcast_to(np.arange(n_label), level.shape)
+    tp, fp = _count_above(label, level, positive, n_label, n_level)
+    fn = positive.sum(0)[:, None] - tp
+
+    sample = np.broadcast_to(np.arange(n_sample)[:, None], level.shape)
+    sample_tp, sample_fp = _count_above(sample, level, positive, n_sample, n_level)
+    sample_fn = positive.sum(1)[:, None] - sample_tp
+    mismatch = sample_fp + sample_fn
+    denominator = 2 * sample_tp + mismatch
+
+    sweep = {'ACC': np.mean(mismatch == 0, axis=0),
+             'HA': 1 - np.mean(mismatch / float(n_label), axis=0),
+             'ebF1': np.array([
+                 np.mean(2 * t[d > 0] / d[d > 0].astype('float32'))
+                 for t, d in zip(sample_tp.T, denominator.T)]),
+             'miF1': np.array([
+                 f1_score_from_stats(*stats, average='micro')
+                 for stats in zip(tp.T, fp.T, fn.T)]),
+             'maF1': np.array([
+                 f1_score_from_stats(*stats, average='macro')
+                 for stats in zip(tp.T, fp.T, fn.T)])}
+
+    # back to the caller's threshold order
+    rank = np.empty_like(order)
+    rank[order] = np.arange(n_level)
+    return {metric: values[rank] for metric, values in sweep.items()}
+
+
+def best_threshold_metrics(predictions, targets, thresholds, metrics, all_metrics=True):
+    """Best value of every metric in `metrics` over `thresholds`.
+
+    Same as taking the max (the min for FDR) of `compute_metrics` over the
+    grid, but the threshold-independent metrics are computed once.
+    """
+    best_metrics = ranking_metrics(predictions, targets, all_metrics)
+    for metric, values in threshold_sweep(predictions, targets, thresholds).items():
+        best_metrics[metric] = max(values)
+    return {metric: best_metrics[metric] for metric in metrics}
+
+
+
+class MetricAccumulator(object):
+    """Running ACC/HA/ebF1/miF1/maF1 over batches of torch tensors.
+
+    `update` binarises the predictions at `threshold` and adds the batch's
+    tp/fp/fn counts, subset-accuracy, Hamming and example-F1 sums to
+    tensors kept on the predictions' device, without copying or syncing
+    with the host. `compute` reads them back once, e.g. per epoch.
+    """
+
+    def __init__(self, threshold=0.5):
+        self.threshold = threshold
+        self.reset()
+
+    def reset(self):
+        self.n_sample = 0
+        self.tp = self.fp = self.fn = None
+        self.sum_acc = self.sum_hamming = self.sum_ebf1 = self.n_ebf1 = None
+
+    def update(self, predictions, targets):
+        predictions = predictions.detach() >= self.threshold
+        targets = targets.detach() > 0.5
+        if self.tp is None:
+            import torch
+            self.tp, self.fp, self.fn = [
+                predictions.new_zeros(predictions.shape[1:], dtype=torch.long)
+                for _ in range(3)]
+            self.sum_acc, self.sum_hamming, self.sum_ebf1, self.n_ebf1 = [
+                predictions.new_zeros((), dtype=torch.float) for _ in range(4)]
+
+        hit = predictions & targets
+        self.tp += hit.sum(0)
+        self.fp += (predictions & ~targets).sum(0)
+        self.fn += (~predictions & targets).sum(0)
+
+        mismatch = predictions != targets
+        self.sum_acc += (~mismatch).all(1).sum()
+        self.sum_hamming += mismatch.sum(1).sum() / float(mismatch.shape[1])
+
+        # example-based F1 over the rows with a non-empty label or prediction
+        denominator = targets.sum(1) + predictions.sum(1)
+        valid = denominator > 0
+        self.sum_ebf1 += (2 * hit.sum(1) / denominator.clamp(min=1) * valid).sum()
+        self.n_ebf1 += valid.sum()
+        self.n_sample += len(predictions)
+
+    def compute(self):
+        if self.tp is None:
+            raise ValueError('no batch has been accumulated')
+        tp, fp, fn = [x.cpu().numpy().astype('float32')
+                      for x in (self.tp, self.fp, self.fn)]
+        n_ebf1 = self.n_ebf1.item()
+        return {
+            'ACC': self.sum_acc.item() / self.n_sample,
+            'HA': 1 - self.sum_hamming.item() / self.n_sample,
+            'ebF1': self.sum_ebf1.item() / n_ebf1 if n_ebf1 else np.nan,
+            'miF1': f1_score_from_stats(tp, fp, fn, average='micro'),
+            'maF1': f1_score_from_stats(tp, fp, fn, average='macro'),
+        }
+
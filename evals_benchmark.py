@@ -0,0 +1,100 @@
+import math
+import time
+import argparse
+
+import numpy as np
+from sklearn import metrics
+
+import evals
+
+
+def sklearn_fdr(all_targets, all_predictions, fdr_cutoff=0.5):
+    fdr_array = []
+    for i in range(all_targets.shape[1]):
+        try:
+            precision, recall, thresholds = metrics.precision_recall_curve(all_targets[:, i], all_predictions[:, i], pos_label=1)
+            fdr = 1 - precision
+            cutoff_index = next(i for i, x in enumerate(fdr) if x <= fdr_cutoff)
+            fdr_at_cutoff = recall[cutoff_index]
+            if not math.isnan(fdr_at_cutoff):
+                fdr_array.append(np.nan_to_num(fdr_at_cutoff))
+        except:
+            pass
+    return np.array(fdr_array)
+
+
+def sklearn_aupr(all_targets, all_predictions):
+    aupr_array = []
+    for i in range(all_targets.shape[1]):
+        precision, recall, thresholds = metrics.precision_recall_curve(all_targets[:, i], all_predictions[:, i], pos_label=1)
+        auPR = metrics.auc(recall, precision)
+        if not math.isnan(auPR):
+            aupr_array.append(np.nan_to_num(auPR))
+    return np.array(aupr_array)
+
+
+def sklearn_auc(all_targets, all_predictions):
+    auc_array = []
+    for i in range(all_targets.shape[1]):
+        try:
+            auc_array.append(metrics.roc_auc_score(all_targets[:, i], all_predictions[:, i]))
+        except ValueError:
+            pass
+    return np.array(auc_array)
+
+
+def vectorized(all_targets, all_predictions):
+    curves = evals.label_curves(all_targets, all_predictions)
+    return (evals.compute_auc(all_targets, all_predictions, curves)[-1],
+            evals.compute_aupr(all_targets, all_predictions, curves)[-1],
+            evals.compute_fdr(all_targets, all_predictions, curves=curves)[-1])
+
+
+def reference(all_targets, all_predictions):
+    return (sklearn_auc(all_targets, all_predictions),
+            sklearn_aupr(all_targets, all_predictions),
+            sklearn_fdr(all_targets, all_predictions))
+
+
+def make_data(n_sample, label_dim, decimals, rng):
+    targets = (rng.rand(n_sample, label_dim) < rng.uniform(0.01, 0.5, label_dim)).astype(np.float32)
+    # every label keeps a positive: newer sklearn reports recall 1, not nan,
+    # for labels without one, so their AUPR would not be comparable
+    targets[rng.randint(n_sample, size=label_dim), np.arange(label_dim)] = 1
+    # a single-class label, skipped by the AUC
+    targets[:, 0] = 1
+    predictions = np.clip(targets * 0.3 + rng.rand(n_sample, label_dim) * 0.7, 0, 1)
+    # rounding produces tied scores
+    predictions = np.round(predictions, decimals).astype(np.float32)
+    return targets, predictions
+
+
+def timeit(fn, repeat, *inputs):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.time()
+        outputs = fn(*inputs)
+        best = min(best, time.time() - start)
+    return best, outputs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n_sample', type=int, default=20000)
+    parser.add_argument('-label_dim', type=int, default=100)
+    parser.add_argument('-decimals', type=int, default=3)
+    parser.add_argument('-repeat', type=int, default=3)
+    parser.add_argument('-seed', type=int, default=1)
+    args = parser.parse_args()
+
+    targets, predictions = make_data(
+        args.n_sample, args.label_dim, args.decimals, np.random.RandomState(args.seed))
+
+    sklearn_time, expected = timeit(reference, args.repeat, targets, predictions)
+    numpy_time, actual = timeit(vectorized, args.repeat, targets, predictions)
+
+    for name, x, y in zip(['AUC', 'AUPR', 'FDR'], expected, actual):
+        assert x.shape == y.shape, f'{name}: {x.shape} labels != {y.shape} labels'
+        print(f'{name}: {len(x)} labels, max abs diff {np.max(np.abs(x - y)):.2e}')
+    print(f'sklearn: {sklearn_time:.3f}s, vectorized: {numpy_time:.3f}s, '
+          f'speedup: {sklearn_time / numpy_time:.1f}x')
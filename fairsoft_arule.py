@@ -12,9 +12,12 @@ from utils import build_path
 from mpvae import VAE
 from data import load_data, load_data_masked
 from label_distance import apriori_similarity
+from label_distance_obs import LabelSimilarity
+from similarity_cache import cached_similarity_table, export_similarity_table
+from checkpoint import CheckpointManager
 
 from main import THRESHOLDS, METRICS
-from fairsoft_train import train_mpvae_softfair_one_epoch
+from fairsoft_train import train_mpvae_softfair_one_epoch, validate_mpvae_softfair
 
 
 def train_fair_through_regularize(args):
@@ -25,11 +28,12 @@ def train_fair_through_regularize(args):
     label_dist_path = os.path.join(
         args.model_dir, f'label_dist-{hparams}.npy')
 
-    if args.train_new == 0 and os.path.exists(label_dist_path):
-        label_dist = pickle.load(open(label_dist_path, 'rb'))
-    else:
-        label_dist = apriori_similarity(args, args.dist_gamma)
-        pickle.dump(label_dist, open(label_dist_path, 'wb'))
+    label_dist = cached_similarity_table(
+        lambda: LabelSimilarity.from_dict(
+            apriori_similarity(args, args.dist_gamma)),
+        dataset=args.dataset, encoding='onehot', metric='arule', gamma=args.dist_gamma,
+        min_support=args.min_support, min_confidence=args.min_confidence)
+    export_similarity_table(label_dist, label_dist_path)
 
     np.random.seed(args.seed)
     if args.mask_target_label:
@@ -71,16 +75,22 @@ def train_fair_through_regularize(args):
             optimizer, one_epoch_iter * (args.max_epoch / args.lr_decay_times), args.lr_decay_ratio)
 
         print('start training fair mpvae...')
-        for _ in range(args.max_epoch):
-            train_mpvae_softfair_one_epoch(
-                data, fair_vae, optimizer, scheduler,
-                penalize_unfair=args.penalize_unfair,
-                target_fair_labels=target_fair_labels,
-                label_distances=label_dist,
-                eval_after_one_epoch=True,
-                args=args)
-
-        torch.save(fair_vae.cpu().state_dict(), fair_vae_checkpoint_path)
+        with CheckpointManager(fair_vae_checkpoint_path, args.max_keep) as checkpoints:
+            for epoch in range(args.max_epoch):
+                train_mpvae_softfair_one_epoch(
+                    data, fair_vae, optimizer, scheduler,
+                    penalize_unfair=args.penalize_unfair,
+                    target_fair_labels=target_fair_labels,
+                    label_distances=label_dist,
+                    eval_after_one_epoch=True,
+                    args=args)
+                eval_total_loss = validate_mpvae_softfair(
+                    data, fair_vae,
+                    penalize_unfair=args.penalize_unfair,
+                    target_fair_labels=target_fair_labels,
+                    label_distances=label_dist,
+                    args=args)
+                checkpoints.save(fair_vae, eval_total_loss, epoch)
 
 
 if __name__ == '__main__':
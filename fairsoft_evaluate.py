@@ -1,5 +1,3 @@
-from joblib.logger import Logger
-from copy import deepcopy
 import os
 import types
 import pickle
@@ -7,120 +5,53 @@ import pickle
 import torch
 
 import numpy as np
-from tqdm import tqdm
 
 import evals
-from mpvae import VAE, compute_loss
 from data import load_data, load_data_masked
 from utils import search_files
+from fairsoft_utils import label_distance_weights, sensitive_group_index, group_mean_gaps
+from fairsoft_inference import run_inference, subset_indices, target_label_strings
+from prediction_cache import cached_inference, checkpoint_loader
 from logger import Logger
+from label_distance_obs import LabelSimilarity, as_label_similarity
 from fairsoft_trial import IMPLEMENTED_METHODS
 
 
-def evaluate_mpvae(model, data, target_fair_labels, label_distances, args, subset='train', eval_fairness=True, eval_train=True, eval_valid=True, logger=Logger()):
+def evaluate_mpvae(model, data, target_fair_labels, label_distances, args, subset='train', eval_fairness=True, eval_train=True, eval_valid=True, logger=Logger(), predictions=None):
+    """Fairness gap and F1 scores of `model` on a split of `data`.
+
+    `predictions` may hold the `run_inference` outputs `y_probs` and
+    `y_reals` of this split, so that several fairness definitions can be
+    evaluated from a single model pass.
+    """
     if eval_fairness and target_fair_labels is None:
         target_fair_labels = list(label_distances.keys())
         raise NotImplementedError('Have not supported smooth-OD yet.')
 
-    print(next(model.parameters()).device)
-    if subset == 'train':
-        subset_idx = data.train_idx
-    elif subset == 'valid':
-        subset_idx = data.valid_idx
-    else:
-        subset_idx = data.test_idx
+    if predictions is None:
+        predictions = run_inference(
+            model, data, args, subset, outputs=('y_probs', 'y_reals'))
+    indiv_prob = predictions['y_probs']
+    labels = predictions['y_reals']
 
-    target_fair_labels_str = []
-    for target_fair_label in target_fair_labels:
-        if isinstance(target_fair_label, np.ndarray):
-            target_fair_label = ''.join(target_fair_label.astype(str))
-        target_fair_labels_str.append(target_fair_label)
-    target_fair_labels = target_fair_labels_str
+    miF1 = evals.f1_score(labels, indiv_prob, 'micro')
+    maF1 = evals.f1_score(labels, indiv_prob, 'macro')
 
-    with torch.no_grad():
-        model.eval()
+    mean_diffs = None
+    if eval_fairness:
+        subset_idx = subset_indices(data, subset)
+        assert indiv_prob.shape[0] == len(subset_idx) and \
+            indiv_prob.shape[1] == data.labels.shape[1]
 
-        train_nll_loss = 0
-        train_c_loss = 0
-        train_total_loss = 0
+        weights = label_distance_weights(
+            labels, target_label_strings(target_fair_labels), label_distances)
+        group, n_group = sensitive_group_index(data.sensitive_feat)
+        mean_diffs = np.sqrt(group_mean_gaps(
+            indiv_prob, weights, group[subset_idx], n_group))
 
-        train_indiv_prob = []
-        train_label = []
+        mean_diffs = np.mean(mean_diffs)
 
-        if eval_fairness:
-            train_feat_z = []
-            train_sensitive = data.sensitive_feat[subset_idx]
-        else:
-            mean_diffs = None
-        with tqdm(
-                range(int(len(subset_idx) / float(data.batch_size)) + 1),
-                desc=f'Evaluate on {subset} set') as t:
-
-            for i in t:
-                start = i * data.batch_size
-                end = min(data.batch_size * (i + 1), len(subset_idx))
-                idx = subset_idx[start:end]
-
-                input_feat = torch.from_numpy(
-                    data.input_feat[idx]).to(args.device)
-
-                input_label = torch.from_numpy(data.labels[idx])
-                input_label = deepcopy(input_label).float().to(args.device)
-
-                label_out, label_mu, label_logvar, feat_out, feat_mu, feat_logvar = model(
-                    input_label, input_feat)
-                total_loss, nll_loss, nll_loss_x, c_loss, c_loss_x, kl_loss, indiv_prob, _ = compute_loss(
-                    input_label, label_out, label_mu, label_logvar, feat_out, feat_mu,
-                    feat_logvar, model.r_sqrt_sigma, args)
-
-                train_indiv_prob.append(indiv_prob.cpu().data.numpy())
-                train_label.append(input_label.cpu().data.numpy())
-
-                if eval_fairness:
-                    feat_z = indiv_prob
-                    train_feat_z.append(feat_z.cpu().data.numpy())
-
-            train_indiv_prob = np.concatenate(train_indiv_prob)
-            train_label = np.concatenate(train_label)
-
-            miF1 = evals.f1_score(train_label, train_indiv_prob, 'micro')
-            maF1 = evals.f1_score(train_label, train_indiv_prob, 'macro')
-            if eval_fairness:
-                train_feat_z = np.concatenate(train_feat_z)
-                assert train_feat_z.shape[0] == len(subset_idx) and \
-                    train_feat_z.shape[1] == data.labels.shape[1]
-
-                sensitive_centroid = np.unique(train_sensitive, axis=0)
-                idxs = np.arange(len(subset_idx))
-
-                mean_diffs = []
-                for target_fair_label in target_fair_labels:
-                    target_label_dist = label_distances[target_fair_label]
-                    weights = []
-                    for label in data.labels[idxs]:
-                        label = label.astype(int)
-                        distance = target_label_dist.get(
-                            ''.join(label.astype(str)), 0.)
-                        weights.append(distance)
-                    weights = np.array(weights).reshape(-1, 1)
-                    if weights.sum() > 0:
-                        feat_z_weighted = np.sum(
-                            train_feat_z * weights, axis=0) / weights.sum()
-
-                        for sensitive in sensitive_centroid:
-                            target_sensitive = np.all(
-                                np.equal(train_sensitive, sensitive), axis=1)
-                            feat_z_sensitive = train_feat_z[idxs[target_sensitive]]
-                            weights_sensitive = weights[idxs[target_sensitive]]
-                            if weights_sensitive.sum() > 0:
-                                unfair_feat_z_sen = np.sum(
-                                    feat_z_sensitive * weights_sensitive, 0) / weights_sensitive.sum()
-                                mean_diffs.append(
-                                    np.sqrt(np.sum(np.power(unfair_feat_z_sen - feat_z_weighted, 2))))
-
-                mean_diffs = np.mean(mean_diffs)
-                
-        return {'fair_mean_diff': mean_diffs, 'miF1': miF1, 'maF1': maF1}
+    return {'fair_mean_diff': mean_diffs, 'miF1': miF1, 'maF1': maF1}
 
 
 def evaluate_over_labels(target_fair_labels, args, logger=Logger()):
@@ -152,6 +83,11 @@ def evaluate_over_labels(target_fair_labels, args, logger=Logger()):
     logger.logging('\n' * 5)
     logger.logging(f"""Fairness definitions: {label_dist_metric_paths}""")
 
+    # ensemble replicas share the data split of `args.seed` but are saved
+    # under their own `model_seed`
+    model_seed = getattr(args, 'model_seed', None)
+    if model_seed is None:
+        model_seed = args.seed
     model_paths = []
     for model_prior in IMPLEMENTED_METHODS:
         if model_prior != 'unfair':
@@ -159,7 +95,7 @@ def evaluate_over_labels(target_fair_labels, args, logger=Logger()):
         if args.mask_target_label:
             model_prior += '_masked'
         model_files = search_files(os.path.join(
-            args.model_dir,  model_prior), postfix=f'-{args.fair_coeff:.2f}_{args.seed:04d}.pkl')
+            args.model_dir,  model_prior), postfix=f'-{args.fair_coeff:.2f}_{model_seed:04d}.pkl')
         if len(model_files):
             model_paths += [os.path.join(
                 args.model_dir, model_prior, model_file) for
@@ -167,26 +103,38 @@ def evaluate_over_labels(target_fair_labels, args, logger=Logger()):
     logger.logging('\n' * 5)
     logger.logging(f"""Fair Models: {model_paths}""")
 
+    # one model pass per checkpoint and split, shared by every fairness definition
+    model_predictions = {}
+
+    def predictions_of(model_stat):
+        if model_stat not in model_predictions:
+            print(f'Fair model: {model_stat}')
+            load_model = checkpoint_loader(model_stat, args)
+            model_predictions[model_stat] = {
+                subset: cached_inference(model_stat, load_model, data, args, subset,
+                                         outputs=('y_probs', 'y_reals'))
+                for subset in ['train', 'valid', 'test']}
+        return model_predictions[model_stat]
+
     fair_results = {}
     perform_result = {}
     for dist_metric in label_dist_metric_paths:
         logger.logging(f'Evaluate fairness definition: {dist_metric}...')
         logger.logging('\n' * 3)
-        label_dist = pickle.load(open(dist_metric, 'rb'))
+        label_dist = as_label_similarity(pickle.load(open(dist_metric, 'rb')))
 
         dist_metric = dist_metric.replace(
             '.npy', '').split('/')[-1].split('-')[1]
         fair_results[dist_metric] = {}
 
         for model_stat in model_paths:
-            print(f'Fair model: {model_stat}')
-            model = VAE(args).to(args.device)
-            model.load_state_dict(torch.load(model_stat))
+            predictions = predictions_of(model_stat)
 
             results = []
             for subset in ['train', 'valid', 'test']:
                 results.append(evaluate_mpvae(
-                    model, data, target_fair_labels, label_dist, args, subset=subset, logger=logger))
+                    None, data, target_fair_labels, label_dist, args, subset=subset, logger=logger,
+                    predictions=predictions[subset]))
 
             if 'unfair' in model_stat:
                 model_trained = 'unfair'
@@ -237,6 +185,8 @@ def evaluate_nearest_neighbor_labels(args, logger=Logger()):
         label_dist_file = label_dist_files[0]
         label_dist = pickle.load(open(os.path.join(
             args.model_dir, 'arule', label_dist_file), 'rb'))
+        if isinstance(label_dist, LabelSimilarity):
+            label_dist = label_dist.to_dict()
         target_fair_labels = retrieve_nearest_neighbor_labels(
             target_fair_label, 5, label_dist)
         if target_fair_labels == []:
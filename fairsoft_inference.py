@@ -0,0 +1,105 @@
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from fairsoft_utils import sensitive_group_index, label_distance_weights, device_data
+
+# artefacts computed by `run_inference`; the first three need a model pass
+MODEL_OUTPUTS = ('y_probs', 'latent_mean', 'latent_sample')
+INFERENCE_OUTPUTS = MODEL_OUTPUTS + (
+    'y_reals', 'group', 'sensitive_idx', 'is_target_label', 'weights')
+
+
+def subset_indices(data, subset):
+    if subset == 'train':
+        return data.train_idx
+    elif subset == 'valid':
+        return data.valid_idx
+    else:
+        return data.test_idx
+
+
+def target_label_strings(target_fair_labels):
+    target_fair_labels_str = []
+    for target_fair_label in target_fair_labels:
+        if isinstance(target_fair_label, np.ndarray):
+            target_fair_label = ''.join(target_fair_label.astype(int).astype(str))
+        target_fair_labels_str.append(target_fair_label)
+    return target_fair_labels_str
+
+
+def run_inference(model, data, args, subset='train', outputs=('y_probs', 'y_reals'),
+                  target_fair_labels=None, label_distances=None):
+    """Run the feature branch of `model` once over a split of `data`.
+
+    Only the feature encoder/decoder is evaluated (labels are never fed to
+    the model) and `indiv_prob` is computed without any loss term. Returns a
+    dict holding the requested `outputs`, each concatenated over the split:
+
+    y_probs: predicted per-label probabilities, latent_mean / latent_sample:
+    `feat_mu` / `feat_out` of the feature branch, y_reals: labels,
+    group: sensitive group ids, sensitive_idx: one-hot group membership,
+    is_target_label: whether the label equals one of `target_fair_labels`,
+    weights: similarity of each label to `target_fair_labels` under
+    `label_distances` (n * n_target).
+    """
+    unknown = set(outputs).difference(INFERENCE_OUTPUTS)
+    if unknown:
+        raise ValueError(f'Unrecognized inference outputs: {sorted(unknown)}')
+    if target_fair_labels is None and (
+            'is_target_label' in outputs or 'weights' in outputs):
+        raise ValueError('`target_fair_labels` is required for target outputs')
+    if label_distances is None and 'weights' in outputs:
+        raise ValueError('`label_distances` is required for `weights`')
+
+    subset_idx = subset_indices(data, subset)
+    results = {}
+
+    model_outputs = [name for name in MODEL_OUTPUTS if name in outputs]
+    if model_outputs:
+        n_sample = args.n_train_sample if args.mode == "train" else args.n_test_sample
+        batches = {name: [] for name in model_outputs}
+        tensors = device_data(data, args.device)
+        subset_idx_t = tensors.index(subset_idx)
+        with torch.no_grad():
+            model.eval()
+            for start in tqdm(range(0, len(subset_idx), data.batch_size),
+                              desc=f'Inference on {subset} set'):
+                input_feat = tensors.input_feat.index_select(
+                    0, subset_idx_t[start:start + data.batch_size])
+
+                indiv_prob, feat_mu, feat_out = model.predict(
+                    input_feat, n_sample=n_sample, return_latent=True)
+                if 'y_probs' in batches:
+                    batches['y_probs'].append(indiv_prob.cpu().numpy())
+                if 'latent_mean' in batches:
+                    batches['latent_mean'].append(feat_mu.cpu().numpy())
+                if 'latent_sample' in batches:
+                    batches['latent_sample'].append(feat_out.cpu().numpy())
+
+        for name, batch in batches.items():
+            results[name] = np.concatenate(batch)
+
+    labels = np.asarray(data.labels[subset_idx])
+    if 'y_reals' in outputs:
+        results['y_reals'] = labels
+
+    if 'group' in outputs or 'sensitive_idx' in outputs:
+        group, n_group = sensitive_group_index(data.sensitive_feat)
+        group = group[subset_idx]
+        if 'group' in outputs:
+            results['group'] = group
+        if 'sensitive_idx' in outputs:
+            results['sensitive_idx'] = np.eye(n_group, dtype=bool)[group]
+
+    if 'is_target_label' in outputs:
+        targets = np.array([[int(c) for c in target_fair_label] for target_fair_label in
+                            target_label_strings(target_fair_labels)])
+        results['is_target_label'] = np.any(np.all(
+            labels[:, np.newaxis] == targets[np.newaxis], axis=2), axis=1)
+
+    if 'weights' in outputs:
+        results['weights'] = label_distance_weights(
+            labels, target_label_strings(target_fair_labels), label_distances)
+
+    return results
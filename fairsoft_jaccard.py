@@ -1,5 +1,4 @@
 import sys
-from copy import deepcopy
 import os
 import pickle
 import types
@@ -12,10 +11,13 @@ import numpy as np
 from utils import build_path
 from mpvae import VAE
 from data import load_data, load_data_masked
-from label_distance_obs import jaccard_similarity
+from label_distance_obs import jaccard_similarity_table
+from similarity_cache import cached_similarity_table, export_similarity_table
+from checkpoint import CheckpointManager
 
 from main import THRESHOLDS, METRICS
-from fairsoft_train import train_mpvae_softfair_one_epoch, validate_mpvae_softfair
+from fairsoft_train import train_mpvae_softfair_one_epoch, validate_mpvae_softfair, train_mpvae_softfair_ensemble, \
+    train_mpvae_softfair_continuation
 
 
 def train_fair_through_regularize(args):
@@ -23,11 +25,10 @@ def train_fair_through_regularize(args):
     label_dist_path = os.path.join(
         args.model_dir, f'label_dist-{hparams}.npy')
 
-    if args.train_new == 0 and os.path.exists(label_dist_path):
-        label_dist = pickle.load(open(label_dist_path, 'rb'))
-    else:
-        label_dist = jaccard_similarity(args)
-        pickle.dump(label_dist, open(label_dist_path, 'wb'))
+    label_dist = cached_similarity_table(
+        lambda: jaccard_similarity_table(args),
+        dataset=args.dataset, encoding='onehot', metric='jaccard', gamma=args.dist_gamma)
+    export_similarity_table(label_dist, label_dist_path)
 
     np.random.seed(args.seed)
     if args.mask_target_label:
@@ -51,11 +52,32 @@ def train_fair_through_regularize(args):
     args.feature_dim = data.input_feat.shape[1]
     args.label_dim = data.labels.shape[1]
 
+    def checkpoint_path(seed):
+        return os.path.join(
+            args.model_dir, f'fair_vae_prior-{hparams}-{args.fair_coeff:.2f}_{seed:04d}.pkl')
+
+    if getattr(args, 'ensemble_seeds', None):
+        train_mpvae_softfair_ensemble(
+            data, args.ensemble_seeds, [checkpoint_path(seed) for seed in args.ensemble_seeds],
+            penalize_unfair=args.penalize_unfair,
+            target_fair_labels=target_fair_labels,
+            label_distances=label_dist,
+            args=args)
+        return
+
+    if getattr(args, 'continuation_coeffs', None):
+        train_mpvae_softfair_continuation(
+            data, args.continuation_coeffs, checkpoint_path,
+            penalize_unfair=args.penalize_unfair,
+            target_fair_labels=target_fair_labels,
+            label_distances=label_dist,
+            args=args)
+        return
+
     fair_vae = VAE(args).to(args.device)
     fair_vae.train()
 
-    fair_vae_checkpoint_path = os.path.join(
-        args.model_dir, f'fair_vae_prior-{hparams}-{args.fair_coeff:.2f}_{args.seed:04d}.pkl')
+    fair_vae_checkpoint_path = checkpoint_path(args.seed)
     if args.train_new == 0 and os.path.exists(fair_vae_checkpoint_path):
         print(f'find trained mpvae: {fair_vae_checkpoint_path}...')
     else:
@@ -68,27 +90,22 @@ def train_fair_through_regularize(args):
             optimizer, one_epoch_iter * (args.max_epoch / args.lr_decay_times), args.lr_decay_ratio)
 
         print('start training fair mpvae...')
-        best_total_loss = np.inf
-        for _ in range(args.max_epoch):
-            train_mpvae_softfair_one_epoch(
-                data, fair_vae, optimizer, scheduler,
-                penalize_unfair=args.penalize_unfair,
-                target_fair_labels=target_fair_labels,
-                label_distances=label_dist,
-                eval_after_one_epoch=False,
-                args=args)
-            eval_total_loss = validate_mpvae_softfair(
-                data, fair_vae,
-                penalize_unfair=args.penalize_unfair,
-                target_fair_labels=target_fair_labels,
-                label_distances=label_dist,
-                args=args)
-
-            if eval_total_loss < best_total_loss:
-                # best_total_loss = eval_total_loss
-                checkpoint = deepcopy(fair_vae)
-                torch.save(checkpoint.cpu().state_dict(),
-                           fair_vae_checkpoint_path)
+        with CheckpointManager(fair_vae_checkpoint_path, args.max_keep) as checkpoints:
+            for epoch in range(args.max_epoch):
+                train_mpvae_softfair_one_epoch(
+                    data, fair_vae, optimizer, scheduler,
+                    penalize_unfair=args.penalize_unfair,
+                    target_fair_labels=target_fair_labels,
+                    label_distances=label_dist,
+                    eval_after_one_epoch=False,
+                    args=args)
+                eval_total_loss = validate_mpvae_softfair(
+                    data, fair_vae,
+                    penalize_unfair=args.penalize_unfair,
+                    target_fair_labels=target_fair_labels,
+                    label_distances=label_dist,
+                    args=args)
+                checkpoints.save(fair_vae, eval_total_loss, epoch)
 
 
 if __name__ == '__main__':
@@ -11,13 +11,16 @@ import torch
 import numpy as np
 
 from utils import search_files, build_path
-from mpvae import VAE
 from data import load_data
 from logger import Logger
 
-from label_distance_obs import indication_similarity, constant_similarity, jaccard_similarity, hamming_similarity
-from fairsoft_evaluate import IMPLEMENTED_METHODS, evaluate_mpvae
-from fairsoft_utils import retrieve_target_label_idx
+from label_distance_obs import indication_similarity, constant_similarity, jaccard_similarity, hamming_similarity, \
+    jaccard_similarity_tables, hamming_similarity_tables
+from fairsoft_evaluate import IMPLEMENTED_METHODS
+from fairsoft_utils import retrieve_target_label_idx, label_distance_weights, sensitive_group_index, \
+    stacked_mean_diffs
+from fairsoft_inference import subset_indices, target_label_strings
+from prediction_cache import cached_inference, checkpoint_loader
 
 from main import THRESHOLDS, METRICS
 
@@ -66,84 +69,76 @@ def evaluate_models_over_label_distances(args):
     logger.logging('\n' * 5)
     logger.logging(f"""Fair Models to evaluate: {model_paths}""")
 
-    results = {}
-    for model_stat in model_paths:
-        print(f'Fair model: {model_stat}')
-        model = VAE(args).to(args.device)
-        model.load_state_dict(torch.load(model_stat))
-
-        model_trained = model_stat.replace(
-            '.pkl', '').split('/')[-1]
-        if 'unfair' in model_trained:
-            model_trained = 'unfair'
-        else:
-            model_trained = '-'.join(model_trained.split('-')[1:])
-        results[model_trained] = {}
-        print(model_trained)
-
-        for dist_gamma in [.01, 0.05, .1, .5, 1., 1.5,  2., 5., 10.]:
-            args.dist_gamma = dist_gamma
-            dist_metric = f'{hparam_distance}_{args.dist_gamma}'
-            label_dist_path = os.path.join(
-                args.model_dir, 'sim_evaluation',
-                f'label_dist-{dist_metric}.npy')
-
-            if args.train_new == 0 and os.path.exists(label_dist_path):
-                label_dist = pickle.load(open(label_dist_path, 'rb'))
-            else:
-                label_dist = similarity(args)
-                pickle.dump(label_dist, open(label_dist_path, 'wb'))
-
-            subset_results = []
-            # for subset in ['train', 'valid', 'test']:
-            for subset in ['valid']:
-                subset_results.append(evaluate_mpvae(
-                    model, data, target_fair_labels, label_dist, args, subset=subset, logger=logger))
-            fair_loss = [
-                f"{result['fair_mean_diff']:.5f}" for result in subset_results]
-            results[model_trained][dist_metric] = '(' + \
-                ')('.join(fair_loss) + ')'
-
-        # run two baseline methods: EO and DP.
-        dist_metric = f'indication_function'
+    # the fairness definitions do not depend on the model: load them once
+    fair_definitions = {}
+    dist_gammas = [.01, 0.05, .1, .5, 1., 1.5,  2., 5., 10.]
+    label_dist_tables = None
+    for dist_gamma in dist_gammas:
+        args.dist_gamma = dist_gamma
+        dist_metric = f'{hparam_distance}_{args.dist_gamma}'
         label_dist_path = os.path.join(
             args.model_dir, 'sim_evaluation',
             f'label_dist-{dist_metric}.npy')
+
         if args.train_new == 0 and os.path.exists(label_dist_path):
             label_dist = pickle.load(open(label_dist_path, 'rb'))
         else:
-            label_dist = indication_similarity(args)
+            if label_dist_tables is None:
+                label_dist_tables = similarity_tables(args, dist_gammas)
+            label_dist = label_dist_tables[dist_gamma].to_dict()
             pickle.dump(label_dist, open(label_dist_path, 'wb'))
+        fair_definitions[dist_metric] = label_dist
 
-        subset_results = []
-        # for subset in ['train', 'valid', 'test']:
-        for subset in ['valid']:
-            subset_results.append(evaluate_mpvae(
-                model, data, target_fair_labels, label_dist, args, subset=subset, logger=logger))
-        fair_loss = [
-            f"{result['fair_mean_diff']:.5f}" for result in subset_results]
-        results[model_trained][dist_metric] = '(' + \
-            ')('.join(fair_loss) + ')'
-
-        dist_metric = f'constant_function'
+    # two baseline definitions: EO and DP.
+    for dist_metric, baseline_similarity in [('indication_function', indication_similarity),
+                                             ('constant_function', constant_similarity)]:
         label_dist_path = os.path.join(
             args.model_dir, 'sim_evaluation',
             f'label_dist-{dist_metric}.npy')
         if args.train_new == 0 and os.path.exists(label_dist_path):
             label_dist = pickle.load(open(label_dist_path, 'rb'))
         else:
-            label_dist = constant_similarity(args)
+            label_dist = baseline_similarity(args)
             pickle.dump(label_dist, open(label_dist_path, 'wb'))
+        fair_definitions[dist_metric] = label_dist
+
+    # per-definition weights of every subset, shared by all models
+    subsets = ['valid']  # ['train', 'valid', 'test']
+    group, n_group = sensitive_group_index(data.sensitive_feat)
+    target_fair_labels_str = target_label_strings(target_fair_labels)
+    subset_weights = {}
+    for subset in subsets:
+        subset_labels = data.labels[subset_indices(data, subset)]
+        subset_weights[subset] = [
+            label_distance_weights(subset_labels, target_fair_labels_str, label_dist)
+            for label_dist in fair_definitions.values()]
+
+    results = {}
+    for model_stat in model_paths:
+        print(f'Fair model: {model_stat}')
+        load_model = checkpoint_loader(model_stat, args)
+
+        model_trained = model_stat.replace(
+            '.pkl', '').split('/')[-1]
+        if 'unfair' in model_trained:
+            model_trained = 'unfair'
+        else:
+            model_trained = '-'.join(model_trained.split('-')[1:])
+        print(model_trained)
+
+        # at most one model pass (none once cached) and a single reduction over
+        # the stacked weights of every fairness definition
+        fair_loss = {dist_metric: [] for dist_metric in fair_definitions}
+        for subset in subsets:
+            y_probs = cached_inference(
+                model_stat, load_model, data, args, subset, outputs=('y_probs',))['y_probs']
+            mean_diffs = stacked_mean_diffs(
+                y_probs, subset_weights[subset], group[subset_indices(data, subset)], n_group)
+            for dist_metric, mean_diff in zip(fair_definitions, mean_diffs):
+                fair_loss[dist_metric].append(f"{mean_diff:.5f}")
 
-        subset_results = []
-        # for subset in ['train', 'valid', 'test']:
-        for subset in ['valid']:
-            subset_results.append(evaluate_mpvae(
-                model, data, target_fair_labels, label_dist, args, subset=subset, logger=logger))
-        fair_loss = [
-            f"{result['fair_mean_diff']:.5f}" for result in subset_results]
-        results[model_trained][dist_metric] = '(' + \
-            ')('.join(fair_loss) + ')'
+        results[model_trained] = {
+            dist_metric: '(' + ')('.join(losses) + ')' for dist_metric, losses in fair_loss.items()}
 
     eval_result_path = os.path.join(
         args.model_dir, 'sim_evaluation',
@@ -197,10 +192,12 @@ if __name__ == '__main__':
 
     if args.eval_distance in ['ham', 'hamming']:
         similarity = hamming_similarity
+        similarity_tables = hamming_similarity_tables
         hparam_distance = 'hamming'
 
     elif args.eval_distance in ['jac', 'jaccard']:
         similarity = jaccard_similarity
+        similarity_tables = jaccard_similarity_tables
         hparam_distance = 'jaccard'
 
     else:
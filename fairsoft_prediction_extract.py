@@ -1,8 +1,3 @@
-from distutils.command.build import build
-from multiprocessing.sharedctypes import Value
-from joblib.logger import Logger
-from faircluster_train import parser
-from copy import deepcopy
 import os
 import types
 import pickle
@@ -10,12 +5,9 @@ import pickle
 import torch
 
 import numpy as np
-from tqdm import tqdm
 
-import evals
-from mpvae import VAE, compute_loss
-from data import load_data, load_data_masked
-from faircluster_train import THRESHOLDS, METRICS
+from data import load_data
+from prediction_cache import cached_inference, checkpoint_loader
 from utils import search_files, build_path
 from logger import Logger
 from fairsoft_trial import IMPLEMENTED_METHODS
@@ -23,78 +15,17 @@ from fairsoft_trial import IMPLEMENTED_METHODS
 rood_dir = os.path.dirname(__file__)
 
 
-def extract_prediction_mpvae(model, data, target_fair_labels, args, subset='train', eval_fairness=True, logger=Logger()):
-    if subset == 'train':
-        subset_idx = data.train_idx
-    elif subset == 'valid':
-        subset_idx = data.valid_idx
-    else:
-        subset_idx = data.test_idx
-
-    with torch.no_grad():
-        model.eval()
-
-        sensitive_idx = []
-        y_probs = []
-        y_reals = []
-        latent_sample = []
-        is_target_label = []
-
-        sen_centroids = np.unique(data.sensitive_feat, axis=0)
-        sen_centroids = torch.from_numpy(sen_centroids).to(args.device)
-
-        with tqdm(
-                range(int(len(subset_idx) / float(data.batch_size)) + 1),
-                desc=f'Evaluate on {subset} set') as t:
-
-            for i in t:
-                start = i * data.batch_size
-                end = min(data.batch_size * (i + 1), len(subset_idx))
-                idx = subset_idx[start:end]
-
-                input_feat = torch.from_numpy(
-                    data.input_feat[idx]).to(args.device)
-
-                input_label = data.labels[idx]
-                input_label_ = torch.from_numpy(
-                    input_label).float().to(args.device)
-
-                label_out, label_mu, label_logvar, feat_out, feat_mu, feat_logvar = model(
-                    input_label_, input_feat)
-
-                total_loss, nll_loss, nll_loss_x, c_loss, c_loss_x, kl_loss, indiv_prob, _ = compute_loss(
-                    input_label_, label_out, label_mu, label_logvar, feat_out, feat_mu,
-                    feat_logvar, model.r_sqrt_sigma, args)
-
-                y_probs.append(indiv_prob.cpu().data.numpy())
-                y_reals.append(input_label)
-
-                is_target_label_ = []
-                for target_fair_label in target_fair_labels:
-                    is_target_label_.append(np.all(
-                        np.equal(input_label, target_fair_label), axis=1))
-                is_target_label_ = np.any(np.array(is_target_label_), axis=0)
-                if len(is_target_label_) != len(feat_out):
-                    raise ValueError(f'Incorrect shape of is_target_label,'
-                                     f'expected length: {len(feat_out)}, observed length: {len(is_target_label_)}')
-                is_target_label.append(is_target_label_)
-
-                sensitive_feat = torch.from_numpy(
-                    data.sensitive_feat[idx]).to(args.device)
-                sen_belong = torch.all(
-                    torch.eq(sensitive_feat.unsqueeze(1), sen_centroids), dim=2)
-                if len(sen_belong) != len(feat_out):
-                    raise ValueError(f'Incorrect shape of sen_belong,'
-                                     f'expected length: {len(feat_out)}, observed length: {len(sen_belong)}')
-                sensitive_idx.append(sen_belong.cpu().data.numpy())
-            
-            y_probs = np.concatenate(y_probs)
-            
-            y_reals = np.concatenate(y_reals)
-
-            print(y_probs.shape, y_reals.shape)
-
-        return y_probs, y_reals, sensitive_idx, is_target_label
+def extract_prediction_mpvae(model_stat, load_model, data, target_fair_labels, args, subset='train', eval_fairness=True, logger=Logger()):
+    results = cached_inference(
+        model_stat, load_model, data, args, subset, outputs=('y_probs', 'y_reals', 'sensitive_idx', 'is_target_label'),
+        target_fair_labels=target_fair_labels)
+    # stored as lists of batches, as read by the analysis notebooks
+    for key in ['sensitive_idx', 'is_target_label']:
+        results[key] = [results[key]]
+    # plain arrays rather than views of the memory-mapped prediction cache
+    results['y_probs'] = np.asarray(results['y_probs'])
+
+    return results['y_probs'], results['y_reals'], results['sensitive_idx'], results['is_target_label']
 
 
 def extract_over_labels(target_fair_labels, args, logger=Logger()):
@@ -133,12 +64,11 @@ def extract_over_labels(target_fair_labels, args, logger=Logger()):
     logger.logging(f"""Fair Models: {model_paths}""")
 
     for result_path, model_stat in zip(result_paths, model_paths):
-        model = VAE(args).to(args.device)
-        model.load_state_dict(torch.load(model_stat))
+        load_model = checkpoint_loader(model_stat, args)
         results = {}
         for subset in ['train', 'valid', 'test']:
             y_probs, y_reals, sensitive_idx, is_target_label = extract_prediction_mpvae(
-                model, data, target_fair_labels, args, subset=subset, logger=logger)
+                model_stat, load_model, data, target_fair_labels, args, subset=subset, logger=logger)
             results[subset] = {'y_probs': y_probs,
                                'y_reals': y_reals,
                                'sensitive_idx': sensitive_idx,
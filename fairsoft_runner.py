@@ -14,6 +14,8 @@ my_dir = os.path.dirname(__file__)
 parser = argparse.ArgumentParser()
 parser.add_argument('-mask_target_label', type=int, default=0)
 parser.add_argument('-cuda', type=int, default=0)
+parser.add_argument('-ensemble', type=int, default=0,
+                    help='train all seeds of a setting in one process')
 
 
 def generate_script_call_args(**kwargs):
@@ -60,13 +62,33 @@ def run_parallel_setting(dataset, mask_target_label, batch_size, epochs, fair_co
     )
 
 
+def run_ensemble_setting(dataset, mask_target_label, batch_size, epochs, fair_coeff, debug=False):
+    # different seed, same fair coeff, trained side by side in one process
+    seeds = list(range(1, 11))
+    args = generate_script_call_args(dataset=dataset,
+                                     latent_dim=8,
+                                     target_label_idx=0,
+                                     mask_target_label=mask_target_label,
+                                     seed=seeds[0],
+                                     epoch=epochs,
+                                     bs=batch_size,
+                                     fair_coeff=fair_coeff)
+    args += ['-ensemble_seeds'] + [str(seed) for seed in seeds]
+    if debug:
+        kwargs = {'stderr': subprocess.STDOUT}
+    else:
+        kwargs = {'stdout': subprocess.DEVNULL, 'stderr': subprocess.STDOUT}
+    subprocess.run(args, check=True, **kwargs)
+
+
 if __name__ == '__main__':
 
     args = parser.parse_args()
     os.environ["CUDA_VISIBLE_DEVICES"] = f"{args.cuda}"
 
+    run_setting = run_ensemble_setting if args.ensemble else run_parallel_setting
     for fair_coeff in [0.1, 1., 10., 100., 500., 1000., 5000]:
-        run_parallel_setting(
+        run_setting(
             dataset='credit',
             mask_target_label=args.mask_target_label,
             batch_size=32,
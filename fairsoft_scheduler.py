@@ -0,0 +1,401 @@
+import os
+import sys
+import json
+import time
+import signal
+import hashlib
+import argparse
+import itertools
+import traceback
+import subprocess
+from functools import partial
+
+from utils import atomic_write
+
+my_dir = os.path.dirname(__file__)
+
+# per-dataset training settings of the sweeps
+DATASET_SETTINGS = {
+    'credit': dict(epoch=500, bs=32),
+    'adult': dict(epoch=20, bs=128),
+}
+FAIR_COEFFS = [0.1, 1., 10., 100., 500., 1000., 5000.]
+SEEDS = list(range(1, 11))
+
+PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+
+# environment variable naming the file a job writes its exit code to
+EXIT_PATH_ENV = 'FAIRSOFT_EXIT_PATH'
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-manifest', type=str, default='sweeps/fairsoft_trial.json')
+parser.add_argument('-workers', type=int, default=10)
+parser.add_argument('-gpus', type=int, nargs='*', default=None,
+                    help='cuda devices handed to the workers round-robin')
+parser.add_argument('-dataset', type=str, nargs='+', default=['credit'])
+parser.add_argument('-mask_target_label', type=int, nargs='+', default=[0, 1])
+parser.add_argument('-fair_coeff', type=float, nargs='+', default=FAIR_COEFFS)
+parser.add_argument('-seed', type=int, nargs='+', default=SEEDS)
+parser.add_argument('-retry_failed', type=int, default=0)
+parser.add_argument('-poll_interval', type=float, default=1.)
+parser.add_argument('-fork', type=int, default=0,
+                    help='fork jobs from a parent that preloaded data and imports')
+
+
+def sweep_configs(datasets, mask_target_labels, fair_coeffs, seeds, **fixed):
+    # fairsoft_trial.py arguments of every job, slowest-varying first
+    configs = []
+    for dataset, mask_target_label, fair_coeff, seed in itertools.product(
+            datasets, mask_target_labels, fair_coeffs, seeds):
+        config = dict(dataset=dataset, latent_dim=8, target_label_idx=0,
+                      mask_target_label=mask_target_label, seed=seed,
+                      **DATASET_SETTINGS[dataset], fair_coeff=fair_coeff)
+        config.update(fixed)
+        configs.append(config)
+    return configs
+
+
+def job_key(config):
+    content = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()[:12]
+
+
+def trial_command(config):
+    return [
+        sys.executable,
+        os.path.join(my_dir, 'fairsoft_trial.py')
+    ] + list(itertools.chain(*[(f'-{k}', str(v)) for k, v in config.items()]))
+
+
+def exit_status_path(log_path):
+    return os.path.splitext(log_path)[0] + '.exit'
+
+
+def read_exit_status(path):
+    try:
+        with open(path) as f:
+            return int(f.read())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def trial_outputs_exist(config):
+    # evaluation results that `fairsoft_trial.eval_fairsoft_allmodels` writes last
+    eval_dir = f'evaluation-{config["target_label_idx"]}'
+    if config.get('mask_target_label'):
+        eval_dir += '_masked'
+    eval_dir = os.path.join('fair_through_distance/model', config['dataset'], eval_dir)
+    suffix = f'lambda={float(config["fair_coeff"]):.2f}_{int(config["seed"]):04d}.pkl'
+    return all(os.path.exists(os.path.join(eval_dir, f'{kind}_eval_{suffix}'))
+               for kind in ('fair', 'perform'))
+
+
+def run_recording_exit(run, exit_path):
+    """Call `run` and write its exit code to `exit_path`, where a scheduler
+    restarted while the job was running reads it back."""
+    returncode = 1
+    try:
+        run()
+        returncode = 0
+    except SystemExit as error:
+        if error.code is None:
+            returncode = 0
+        else:
+            returncode = error.code if isinstance(error.code, int) else 1
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        atomic_write(exit_path, lambda f: f.write(str(returncode).encode('utf-8')))
+    return returncode
+
+
+def pid_alive(pid):
+    if pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # the pid exists but belongs to another user
+        return True
+    return True
+
+
+class OrphanTrial(object):
+    """`subprocess.Popen`-like handle of a job started by an earlier scheduler.
+
+    It is not our child, so its exit status is read from the file the job
+    writes through `run_recording_exit`. Without that file (e.g. a job
+    started by an older scheduler) the job counts as successful when its
+    evaluation results exist, and reports -1, i.e. failed, otherwise.
+    """
+
+    def __init__(self, pid, exit_path, config):
+        self.pid = pid
+        self.exit_path = exit_path
+        self.config = config
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            returncode = read_exit_status(self.exit_path)
+            if returncode is not None:
+                self.returncode = returncode
+            elif not pid_alive(self.pid):
+                # the job may have written its status right before exiting
+                returncode = read_exit_status(self.exit_path)
+                if returncode is None:
+                    returncode = 0 if trial_outputs_exist(self.config) else -1
+                self.returncode = returncode
+        return self.returncode
+
+    def wait(self):
+        while self.poll() is None:
+            time.sleep(1.)
+        return self.returncode
+
+    def terminate(self):
+        if self.returncode is None:
+            os.kill(self.pid, signal.SIGTERM)
+
+
+class SweepManifest(object):
+    """Job table of a sweep, persisted as JSON after every status change.
+
+    Jobs are keyed by a hash of their configuration, so adding a sweep twice
+    does not duplicate work. Jobs still marked `running` when the manifest
+    is loaded belong to a scheduler that died. Those whose process is gone
+    are queued again and, having been attempted before, rerun with
+    `-train_new 1` so a partially trained checkpoint is not mistaken for a
+    finished one; those whose process outlived the scheduler are left
+    `running` and returned by `orphans`, so they are not started twice.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.jobs = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.jobs = json.load(f)['jobs']
+            for job in self.jobs.values():
+                if job['status'] == RUNNING and not pid_alive(job.get('pid')):
+                    job['status'] = PENDING
+
+    def orphans(self):
+        return [key for key, job in self.jobs.items() if job['status'] == RUNNING]
+
+    def add(self, configs):
+        for config in configs:
+            key = job_key(config)
+            if key not in self.jobs:
+                self.jobs[key] = {'config': config, 'status': PENDING, 'attempts': 0}
+        self.save()
+
+    def retry_failed(self):
+        for job in self.jobs.values():
+            if job['status'] == FAILED:
+                job['status'] = PENDING
+        self.save()
+
+    def pending(self):
+        return [key for key, job in self.jobs.items() if job['status'] == PENDING]
+
+    def update(self, key, **fields):
+        self.jobs[key].update(fields)
+        self.save()
+
+    def summary(self):
+        counts = {status: 0 for status in (PENDING, RUNNING, DONE, FAILED)}
+        for job in self.jobs.values():
+            counts[job['status']] += 1
+        return ', '.join(f'{count} {status}' for status, count in counts.items())
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        content = json.dumps({'jobs': self.jobs}, indent=1, default=str)
+        atomic_write(self.path, lambda f: f.write(content.encode('utf-8')))
+
+
+def worker_slots(n_workers, gpus=None):
+    """Split the cores this process may use into `n_workers` disjoint sets.
+
+    Each worker's jobs are pinned to its set and get as many torch/OpenMP
+    threads as it has cores, so concurrent jobs do not oversubscribe them.
+    """
+    cores = sorted(os.sched_getaffinity(0))
+    per_worker = max(len(cores) // n_workers, 1)
+    slots = []
+    for k in range(n_workers):
+        slot_cores = cores[k * per_worker:(k + 1) * per_worker] or [cores[k % len(cores)]]
+        slots.append({'cores': slot_cores,
+                      'gpu': gpus[k % len(gpus)] if gpus else None})
+    return slots
+
+
+def trial_config(job, slot):
+    config = dict(job['config'])
+    if job['attempts'] > 0:
+        config['train_new'] = 1
+    if slot['gpu'] is not None:
+        config['cuda'] = slot['gpu']
+    return config
+
+
+def spawn_trial(job, slot, log_path):
+    threads = str(len(slot['cores']))
+    env = dict(os.environ, OMP_NUM_THREADS=threads, MKL_NUM_THREADS=threads,
+               **{EXIT_PATH_ENV: exit_status_path(log_path)})
+    with open(log_path, 'ab') as log:
+        return subprocess.Popen(
+            trial_command(trial_config(job, slot)), stdout=log, stderr=subprocess.STDOUT,
+            env=env, preexec_fn=lambda: os.sched_setaffinity(0, slot['cores']))
+
+
+class ForkedTrial(object):
+    """`subprocess.Popen`-like handle of a trial running in a forked child."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid != 0:
+                self.returncode = os.waitstatus_to_exitcode(status)
+        return self.returncode
+
+    def wait(self):
+        if self.returncode is None:
+            _, status = os.waitpid(self.pid, 0)
+            self.returncode = os.waitstatus_to_exitcode(status)
+        return self.returncode
+
+    def terminate(self):
+        if self.returncode is None:
+            os.kill(self.pid, signal.SIGTERM)
+
+
+def fork_trial(job, slot, log_path, trial_parser):
+    """Run `fairsoft_trial.run_trial` for `job` in a child forked from this
+    process, which shares its imports and preloaded data copy-on-write.
+
+    The parent must not have initialised CUDA: a forked child cannot use it.
+    """
+    from fairsoft_trial import run_trial
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid:
+        return ForkedTrial(pid)
+
+    def run():
+        log = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        os.dup2(log, sys.stdout.fileno())
+        os.dup2(log, sys.stderr.fileno())
+        os.sched_setaffinity(0, slot['cores'])
+
+        import torch
+        torch.set_num_threads(len(slot['cores']))
+        run_trial(trial_parser.parse_args(trial_command(trial_config(job, slot))[2:]))
+
+    returncode = 1
+    try:
+        returncode = run_recording_exit(run, exit_status_path(log_path))
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(returncode)
+
+
+def preload_trials(manifest):
+    """Import fairsoft_trial's dependencies and load the data of every
+    dataset with pending jobs, before any worker is forked."""
+    from fairsoft_trial import trial_parser, preload_trial
+
+    trial_arg_parser = trial_parser()
+    datasets = {manifest.jobs[key]['config']['dataset'] for key in manifest.pending()}
+    for dataset in sorted(datasets):
+        print(f'preload {dataset}...')
+        preload_trial(trial_arg_parser.parse_args(['-dataset', dataset]))
+    return trial_arg_parser
+
+
+def raise_on_sigterm(signum, frame):
+    # lets `run_sweep` terminate and requeue its jobs when it is killed
+    raise SystemExit(128 + signum)
+
+
+def run_sweep(manifest, slots, log_dir, poll_interval=1., launch=spawn_trial):
+    """Stream the manifest's pending jobs into free worker slots.
+
+    A slot takes the next pending job as soon as its previous one exits, so
+    one slow seed never holds back the rest of the sweep. `launch` starts a
+    job and returns a `subprocess.Popen`-like handle. Jobs still running from
+    an earlier scheduler hold a slot until they exit. On an interrupt, or a
+    SIGTERM, the running jobs are terminated and put back to pending.
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    pending = manifest.pending()
+    running = {}  # slot index -> (job key, process)
+    # orphans beyond the number of slots get indices that no slot uses
+    for k, key in enumerate(manifest.orphans()):
+        job = manifest.jobs[key]
+        running[k] = (key, OrphanTrial(
+            job['pid'], exit_status_path(os.path.join(log_dir, f'{key}.log')), job['config']))
+        print(f'wait for {key} (pid {manifest.jobs[key]["pid"]}) from an earlier scheduler')
+    try:
+        while pending or running:
+            for k, slot in enumerate(slots):
+                if k in running or not pending:
+                    continue
+                key = pending.pop(0)
+                job = manifest.jobs[key]
+                log_path = os.path.join(log_dir, f'{key}.log')
+                # the status of an earlier attempt must not be read for this one
+                if os.path.exists(exit_status_path(log_path)):
+                    os.remove(exit_status_path(log_path))
+                process = launch(job, slot, log_path)
+                running[k] = (key, process)
+                manifest.update(key, status=RUNNING, attempts=job['attempts'] + 1,
+                                pid=process.pid, cores=slot['cores'], started=time.time())
+                print(f'[{manifest.summary()}] start {key}: {job["config"]}')
+
+            time.sleep(poll_interval)
+            for k, (key, process) in list(running.items()):
+                returncode = process.poll()
+                if returncode is None:
+                    continue
+                del running[k]
+                manifest.update(key, status=DONE if returncode == 0 else FAILED,
+                                returncode=returncode, finished=time.time())
+                print(f'[{manifest.summary()}] {key} exited with {returncode}')
+    except BaseException:
+        for key, process in running.values():
+            process.terminate()
+            process.wait()
+            manifest.update(key, status=PENDING)
+        raise
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    signal.signal(signal.SIGTERM, raise_on_sigterm)
+
+    manifest = SweepManifest(args.manifest)
+    manifest.add(sweep_configs(
+        args.dataset, args.mask_target_label, args.fair_coeff, args.seed))
+    if args.retry_failed:
+        manifest.retry_failed()
+    print(f'{args.manifest}: {manifest.summary()}')
+
+    launch = spawn_trial
+    if args.fork:
+        launch = partial(fork_trial, trial_parser=preload_trials(manifest))
+    run_sweep(manifest, worker_slots(args.workers, args.gpus),
+              os.path.splitext(args.manifest)[0] + '-logs', args.poll_interval, launch)
+
+# python fairsoft_scheduler.py -manifest sweeps/credit.json -workers 10 -dataset credit -mask_target_label 0 1 -fork 1
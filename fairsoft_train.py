@@ -1,18 +1,83 @@
-from fairsoft_utils import has_finite_grad
+from fairsoft_utils import has_finite_grad, prepare_fair_regularizer, fair_regularizer, device_data
 from mpvae import VAE, compute_loss
+from checkpoint import CheckpointManager, state_dict_snapshot
+from utils import atomic_write
 import evals
 import numpy as np
 import torch.nn as nn
 import torch
+from torch.func import stack_module_state, functional_call, vmap
 from main import THRESHOLDS, METRICS
 from tqdm import tqdm
 
+import os
 import sys
+import copy
 import datetime
-from copy import deepcopy
+import contextlib
 sys.path.append('./')
 
 
+def random_r_sqrt_sigma(args, size=()):
+    # `residue_sigma == "random"`: a fresh residual factor for every batch
+    return torch.from_numpy(
+        np.random.uniform(
+            -np.sqrt(6.0 / (args.label_dim + args.z_dim)),
+            np.sqrt(6.0 / (args.label_dim + args.z_dim)),
+            tuple(size) + (args.label_dim, args.z_dim))).to(
+        args.device)
+
+
+def softfair_loss(model, input_feat, input_label, fair_state, args):
+    """MPVAE loss of one batch plus the fairness regularizer.
+
+    fair_state: None, or (batch_idx, fair_weights, sensitive_group, n_group)
+    as given by `prepare_fair_regularizer` and the batch indices.
+    """
+    if args.residue_sigma == "random":
+        r_sqrt_sigma = random_r_sqrt_sigma(args)
+    else:
+        r_sqrt_sigma = model.r_sqrt_sigma
+    losses = softfair_objective(
+        model(input_label, input_feat), input_label, r_sqrt_sigma, fair_state, args)
+
+    contributed = 0
+    if fair_state is not None:
+        batch_idx, fair_weights = fair_state[:2]
+        contributed = int(torch.count_nonzero(
+            fair_weights.index_select(0, batch_idx) > 0).item())
+
+    return losses + (contributed,)
+
+
+def softfair_objective(model_outputs, input_label, r_sqrt_sigma, fair_state, args):
+    # the model-dependent part of `softfair_loss`, free of host syncs so that
+    # it can run under `vmap`
+    label_out, label_mu, label_logvar, feat_out, feat_mu, feat_logvar = model_outputs
+    total_loss, nll_loss, nll_loss_x, c_loss, c_loss_x, kl_loss, indiv_prob, indiv_prob_label = compute_loss(
+        input_label, label_out, label_mu, label_logvar, feat_out, feat_mu, feat_logvar,
+        r_sqrt_sigma, args)
+
+    fairloss = None
+    if fair_state is not None:
+        batch_idx, fair_weights, sensitive_group, n_sensitive_group = fair_state
+        weights = fair_weights.index_select(0, batch_idx)
+        group = sensitive_group.index_select(0, batch_idx)
+
+        reg_label_z_unfair = fair_regularizer(
+            indiv_prob_label, weights, group, n_sensitive_group,
+            args.fairness_loss_norm)
+        reg_feat_z_unfair = fair_regularizer(
+            indiv_prob, weights, group, n_sensitive_group,
+            args.fairness_loss_norm)
+
+        fairloss = args.fair_coeff * \
+            (reg_label_z_unfair + reg_feat_z_unfair)
+        total_loss = total_loss + fairloss
+
+    return total_loss, nll_loss, nll_loss_x, c_loss, c_loss_x, kl_loss, indiv_prob, fairloss
+
+
 def train_mpvae_softfair_one_epoch(
         data, model, optimizer, scheduler, penalize_unfair, target_fair_labels, label_distances, eval_after_one_epoch, args):
     model.train()
@@ -27,7 +92,13 @@ def train_mpvae_softfair_one_epoch(
         target_fair_labels_str.append(target_fair_label)
     target_fair_labels = target_fair_labels_str
 
+    if penalize_unfair:
+        fair_weights, sensitive_group, n_sensitive_group = prepare_fair_regularizer(
+            data, target_fair_labels, label_distances, args.device)
+
     np.random.shuffle(data.train_idx)
+    tensors = device_data(data, args.device)
+    train_idx = tensors.index(data.train_idx)
 
     smooth_nll_loss = 0.0  # label encoder decoder cross entropy loss
     smooth_nll_loss_x = 0.0  # feature encoder decoder cross entropy loss
@@ -35,8 +106,7 @@ def train_mpvae_softfair_one_epoch(
     smooth_c_loss_x = 0.0  # feature encoder decoder ranking loss
     smooth_kl_loss = 0.0  # kl divergence
     smooth_total_loss = 0.0  # total loss
-    smooth_macro_f1 = 0.0  # macro_f1 score
-    smooth_micro_f1 = 0.0  # micro_f1 score
+    train_metrics = evals.MetricAccumulator(0.5)  # maF1 / miF1
     smooth_reg_fair = 0.
 
     contributed_reg_fair_sample = 0
@@ -47,95 +117,18 @@ def train_mpvae_softfair_one_epoch(
             optimizer.zero_grad()
             start = i * data.batch_size
             end = min(data.batch_size * (i + 1), len(data.train_idx))
-            idx = data.train_idx[start:end]
-
-            input_feat = torch.from_numpy(
-                data.input_feat[idx]).float().to(args.device)
-
-            input_label = torch.from_numpy(
-                data.labels[idx]).float().to(args.device)
-            label_out, label_mu, label_logvar, feat_out, feat_mu, feat_logvar = model(
-                input_label, input_feat)
-
-            if args.residue_sigma == "random":
-                r_sqrt_sigma = torch.from_numpy(
-                    np.random.uniform(
-                        -np.sqrt(6.0 / (args.label_dim + args.z_dim)),
-                        np.sqrt(6.0 / (args.label_dim + args.z_dim)),
-                        (args.label_dim, args.z_dim))).to(
-                    args.device)
-                total_loss, nll_loss, nll_loss_x, c_loss, c_loss_x, kl_loss, indiv_prob, indiv_prob_label = compute_loss(
-                    input_label, label_out, label_mu, label_logvar, feat_out, feat_mu, feat_logvar,
-                    r_sqrt_sigma, args)
-            else:
-                total_loss, nll_loss, nll_loss_x, c_loss, c_loss_x, kl_loss, indiv_prob, indiv_prob_label = compute_loss(
-                    input_label, label_out, label_mu, label_logvar, feat_out, feat_mu, feat_logvar,
-                    model.r_sqrt_sigma, args)
+            batch_idx = train_idx[start:end]
+
+            input_feat, input_label = tensors.batch(batch_idx)
+            fair_state = (batch_idx, fair_weights, sensitive_group,
+                          n_sensitive_group) if penalize_unfair else None
+
+            total_loss, nll_loss, nll_loss_x, c_loss, c_loss_x, kl_loss, indiv_prob, fairloss, contributed = softfair_loss(
+                model, input_feat, input_label, fair_state, args)
 
             if penalize_unfair:
-                label_z = indiv_prob_label
-                feat_z = indiv_prob
-
-                sensitive_feat = torch.from_numpy(
-                    data.sensitive_feat[idx]).to(args.device)
-                sensitive_centroids = torch.unique(sensitive_feat, dim=0)
-                idx_tensor = torch.arange(sensitive_feat.shape[0])
-
-                reg_label_z_unfair = 0.
-                reg_feat_z_unfair = 0.
-
-                for target_fair_label in target_fair_labels:
-                    target_label_dist = label_distances[target_fair_label]
-                    weights = []
-                    for label in data.labels[idx]:
-                        label = label.astype(int)
-                        distance = target_label_dist.get(
-                            ''.join(label.astype(str)), 0.)
-                        weights.append(distance)
-                        if distance > 0:
-                            contributed_reg_fair_sample += 1
-                    weights = torch.tensor(weights).to(
-                        args.device).reshape(-1, 1)
-
-                    if weights.sum() > 0:
-                        label_z_weighted = torch.sum(
-                            label_z * weights, axis=0) / weights.sum()
-                        feat_z_weighted = torch.sum(
-                            feat_z * weights, axis=0) / weights.sum()
-
-                        for sensitive in sensitive_centroids:
-                            target_sensitive = torch.all(
-                                torch.eq(sensitive_feat, sensitive), dim=1)
-                            label_z_sensitive = label_z[idx_tensor[target_sensitive]]
-                            feat_z_sensitive = feat_z[idx_tensor[target_sensitive]]
-                            weight_sensitive = weights[idx_tensor[target_sensitive]]
-
-                            if weight_sensitive.sum() > 0:
-                                if args.fairness_loss_norm == 'l1':
-                                    reg_label_z_sen = torch.sum(
-                                        label_z_sensitive * weight_sensitive, 0) / weight_sensitive.sum()
-                                    reg_feat_z_sen = torch.sum(
-                                        feat_z_sensitive * weight_sensitive, 0) / weight_sensitive.sum()
-                                    reg_label_z_unfair += torch.sum(
-                                        torch.absolute(reg_label_z_sen - label_z_weighted))
-                                    reg_feat_z_unfair += torch.sum(
-                                        torch.absolute(reg_feat_z_sen - feat_z_weighted))
-                                elif args.fairness_loss_norm == 'l2':
-                                    reg_label_z_sen = torch.sum(
-                                    label_z_sensitive * weight_sensitive, 0) / weight_sensitive.sum()
-                                    reg_feat_z_sen = torch.sum(
-                                        feat_z_sensitive * weight_sensitive, 0) / weight_sensitive.sum()
-                                    reg_label_z_unfair += torch.sum(
-                                        torch.pow(reg_label_z_sen - label_z_weighted, 2))
-                                    reg_feat_z_unfair += torch.sum(
-                                        torch.pow(reg_feat_z_sen - feat_z_weighted, 2))
-
-                fairloss = args.fair_coeff * \
-                    (reg_label_z_unfair + reg_feat_z_unfair)
-                
-                if not isinstance(fairloss, float):
-                    total_loss += fairloss
-                    smooth_reg_fair += fairloss.item()
+                contributed_reg_fair_sample += contributed
+                smooth_reg_fair += fairloss.item()
 
             total_loss.backward()
             nn.utils.clip_grad_norm_(model.parameters(), 10.)
@@ -146,10 +139,7 @@ def train_mpvae_softfair_one_epoch(
                 succses_updates += 1
 
             # evaluation
-            train_metrics = evals.compute_metrics(
-                indiv_prob.cpu().data.numpy(), input_label.cpu().data.numpy(), 0.5,
-                all_metrics=False)
-            macro_f1, micro_f1 = train_metrics['maF1'], train_metrics['miF1']
+            train_metrics.update(indiv_prob, input_label)
 
             smooth_nll_loss += nll_loss.item()
             smooth_nll_loss_x += nll_loss_x.item()
@@ -158,8 +148,6 @@ def train_mpvae_softfair_one_epoch(
             smooth_c_loss_x += c_loss_x.item()
             smooth_kl_loss += kl_loss.item()
             smooth_total_loss += total_loss.item()
-            smooth_macro_f1 += macro_f1.item()
-            smooth_micro_f1 += micro_f1.item()
 
             # log the labels
 
@@ -182,8 +170,8 @@ def train_mpvae_softfair_one_epoch(
         c_loss_x = smooth_c_loss_x / float(i + 1)
         kl_loss = smooth_kl_loss / float(i + 1)
         total_loss = smooth_total_loss / float(i + 1)
-        macro_f1 = smooth_macro_f1 / float(i + 1)
-        micro_f1 = smooth_micro_f1 / float(i + 1)
+        epoch_metrics = train_metrics.compute()
+        macro_f1, micro_f1 = epoch_metrics['maF1'], epoch_metrics['miF1']
 
         # temp_indiv_prob = np.array(temp_indiv_prob).reshape(-1)
         # temp_label = np.array(temp_label).reshape(-1)
@@ -194,8 +182,7 @@ def train_mpvae_softfair_one_epoch(
                 macro_f1, micro_f1, nll_loss * args.nll_coeff, nll_loss_x * args.nll_coeff,
                 c_loss * args.c_coeff, c_loss_x * args.c_coeff, kl_loss, total_loss))
 
-        current_loss, val_metrics = validate_mpvae(
-            model, data.input_feat, data.labels, data.valid_idx, args)
+        current_loss, val_metrics = validate_mpvae(model, data, args)
 
 
 def validate_mpvae_softfair(
@@ -217,14 +204,19 @@ def validate_mpvae_softfair(
         np.random.shuffle(data.train_idx)
         args.device = next(model.parameters()).device
 
+        if penalize_unfair:
+            fair_weights, sensitive_group, n_sensitive_group = prepare_fair_regularizer(
+                data, target_fair_labels, label_distances, args.device)
+        tensors = device_data(data, args.device)
+        valid_idx = tensors.index(data.valid_idx)
+
         smooth_nll_loss = 0.0  # label encoder decoder cross entropy loss
         smooth_nll_loss_x = 0.0  # feature encoder decoder cross entropy loss
         smooth_c_loss = 0.0  # label encoder decoder ranking loss
         smooth_c_loss_x = 0.0  # feature encoder decoder ranking loss
         smooth_kl_loss = 0.0  # kl divergence
         smooth_total_loss = 0.0  # total loss
-        smooth_macro_f1 = 0.0  # macro_f1 score
-        smooth_micro_f1 = 0.0  # micro_f1 score
+        train_metrics = evals.MetricAccumulator(0.5)  # maF1 / miF1
         smooth_reg_fair = 0.
 
         contributed_reg_fair_sample = 0
@@ -234,13 +226,9 @@ def validate_mpvae_softfair(
             for i in t:
                 start = i * data.batch_size
                 end = min(data.batch_size * (i + 1), len(data.valid_idx))
-                idx = data.valid_idx[start:end]
+                batch_idx = valid_idx[start:end]
 
-                input_feat = torch.from_numpy(
-                    data.input_feat[idx]).float().to(args.device)
-
-                input_label = torch.from_numpy(
-                    data.labels[idx]).float().to(args.device)
+                input_feat, input_label = tensors.batch(batch_idx)
                 label_out, label_mu, label_logvar, feat_out, feat_mu, feat_logvar = model(
                     input_label, input_feat)
 
@@ -260,65 +248,23 @@ def validate_mpvae_softfair(
                         model.r_sqrt_sigma, args)
 
                 if penalize_unfair:
-                    label_z = indiv_prob_label
-                    feat_z = indiv_prob
-
-                    sensitive_feat = torch.from_numpy(
-                        data.sensitive_feat[idx]).to(args.device)
-                    sensitive_centroids = torch.unique(sensitive_feat, dim=0)
-                    idx_tensor = torch.arange(sensitive_feat.shape[0])
-
-                    reg_label_z_unfair = 0.
-                    reg_feat_z_unfair = 0.
-
-                    for target_fair_label in target_fair_labels:
-                        target_label_dist = label_distances[target_fair_label]
-                        weights = []
-                        for label in data.labels[idx]:
-                            label = label.astype(int)
-                            distance = target_label_dist.get(
-                                ''.join(label.astype(str)), 0.)
-                            weights.append(distance)
-                            if distance > 0:
-                                contributed_reg_fair_sample += 1
-                        weights = torch.tensor(weights).to(
-                            args.device).reshape(-1, 1)
-
-                        if weights.sum() > 0:
-                            label_z_weighted = torch.sum(
-                                label_z * weights, axis=0) / weights.sum()
-                            feat_z_weighted = torch.sum(
-                                feat_z * weights, axis=0) / weights.sum()
-
-                            for sensitive in sensitive_centroids:
-                                target_sensitive = torch.all(
-                                    torch.eq(sensitive_feat, sensitive), dim=1)
-                                label_z_sensitive = label_z[idx_tensor[target_sensitive]]
-                                feat_z_sensitive = feat_z[idx_tensor[target_sensitive]]
-                                weight_sensitive = weights[idx_tensor[target_sensitive]]
-
-                                if weight_sensitive.sum() > 0:
-                                    reg_label_z_sen = torch.sum(
-                                        label_z_sensitive * weight_sensitive, 0) / weight_sensitive.sum()
-                                    reg_feat_z_sen = torch.sum(
-                                        feat_z_sensitive * weight_sensitive, 0) / weight_sensitive.sum()
-                                    reg_label_z_unfair += torch.sum(
-                                        torch.pow(reg_label_z_sen - label_z_weighted, 2))
-                                    reg_feat_z_unfair += torch.sum(
-                                        torch.pow(reg_feat_z_sen - feat_z_weighted, 2))
+                    weights = fair_weights.index_select(0, batch_idx)
+                    group = sensitive_group.index_select(0, batch_idx)
+                    contributed_reg_fair_sample += int(
+                        torch.count_nonzero(weights > 0).item())
+
+                    reg_label_z_unfair = fair_regularizer(
+                        indiv_prob_label, weights, group, n_sensitive_group, 'l2')
+                    reg_feat_z_unfair = fair_regularizer(
+                        indiv_prob, weights, group, n_sensitive_group, 'l2')
 
                     fairloss = args.fair_coeff * \
                         (reg_label_z_unfair + reg_feat_z_unfair)
-
-                    if not isinstance(fairloss, float):
-                        total_loss += fairloss
-                        smooth_reg_fair += fairloss.item()
+                    total_loss += fairloss
+                    smooth_reg_fair += fairloss.item()
 
                 # evaluation
-                train_metrics = evals.compute_metrics(
-                    indiv_prob.cpu().data.numpy(), input_label.cpu().data.numpy(), 0.5,
-                    all_metrics=False)
-                macro_f1, micro_f1 = train_metrics['maF1'], train_metrics['miF1']
+                train_metrics.update(indiv_prob, input_label)
 
                 smooth_nll_loss += nll_loss.item()
                 smooth_nll_loss_x += nll_loss_x.item()
@@ -327,8 +273,6 @@ def validate_mpvae_softfair(
                 smooth_c_loss_x += c_loss_x.item()
                 smooth_kl_loss += kl_loss.item()
                 smooth_total_loss += total_loss.item()
-                smooth_macro_f1 += macro_f1.item()
-                smooth_micro_f1 += micro_f1.item()
 
                 # log the labels
 
@@ -345,8 +289,231 @@ def validate_mpvae_softfair(
     return smooth_total_loss / float(i + 1)
 
 
-def validate_mpvae(model, feat, labels, valid_idx, args):
+def masked_optimizer_step(optimizer, params, update):
+    """`optimizer.step()` over stacked parameters for the replicas whose
+    `update` is True; the others keep their parameters and optimizer moments.
+
+    Returns whether any replica was updated.
+    """
+    skip = torch.logical_not(update)
+    if not bool(update.any()):
+        return False
+    if not bool(skip.any()):
+        optimizer.step()
+        return True
+
+    saved = []
+    for param in params:
+        state = optimizer.state.get(param, {})
+        saved.append((param, param.detach()[skip].clone(),
+                      {key: value[skip].clone() for key, value in state.items()
+                       if torch.is_tensor(value) and value.shape == param.shape}))
+    optimizer.step()
+    with torch.no_grad():
+        for param, param_skipped, state_skipped in saved:
+            param[skip] = param_skipped
+            for key, value in optimizer.state[param].items():
+                if torch.is_tensor(value) and value.shape == param.shape:
+                    # moments created by this step start from zero
+                    value[skip] = state_skipped.get(key, torch.zeros_like(value[skip]))
+    return True
+
+
+def train_mpvae_softfair_ensemble(
+        data, seeds, checkpoint_paths, penalize_unfair, target_fair_labels, label_distances, args):
+    """Train one `VAE` per seed as a single stacked model over shared batches.
+
+    Every replica is initialised under its own seed. Their parameters are
+    stacked along a leading replica axis and one `vmap`ed forward and backward
+    pass serves them all, with independent dropout and sampling noise
+    (`randomness='different'`). Gradient clipping and the finite-gradient
+    skip are applied per replica. Adam is elementwise, so its moments stay
+    per replica; its step count and the learning-rate schedule are shared.
+    After every epoch each replica is validated, and its best checkpoints by
+    validation loss are kept through a `CheckpointManager`.
+    """
+    one_epoch_iter = np.ceil(len(data.train_idx) / args.batch_size)
+
+    pending = []
+    for seed, checkpoint_path in zip(seeds, checkpoint_paths):
+        if args.train_new == 0 and os.path.exists(checkpoint_path):
+            print(f'find trained mpvae: {checkpoint_path}...')
+        else:
+            print(f'train a new mpvaeL: {checkpoint_path}...')
+            pending.append((seed, checkpoint_path))
+    if len(pending) == 0:
+        return []
+    seeds, checkpoint_paths = zip(*pending)
+
+    models = []
+    for seed in seeds:
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        models.append(VAE(args).to(args.device))
+
+    params, buffers = stack_module_state(models)
+    trainable = [param for param in params.values() if param.requires_grad]
+    optimizer = torch.optim.Adam(
+        trainable, lr=args.learning_rate, weight_decay=1e-5)
+    scheduler = torch.optim.lr_scheduler.StepLR(
+        optimizer, one_epoch_iter * (args.max_epoch / args.lr_decay_times), args.lr_decay_ratio)
+
+    # stateless copy of the architecture, run with the stacked parameters
+    base_model = copy.deepcopy(models[0]).to('meta')
+    base_model.train()
+
+    def replica_loss(replica_params, replica_buffers, r_sqrt_sigma, input_feat, input_label, fair_state):
+        model_outputs = functional_call(
+            base_model, (replica_params, replica_buffers), (input_label, input_feat))
+        if r_sqrt_sigma is None:
+            r_sqrt_sigma = replica_params['r_sqrt_sigma']
+        return softfair_objective(model_outputs, input_label, r_sqrt_sigma, fair_state, args)[0]
+
+    random_sigma = args.residue_sigma == "random"
+    ensemble_loss = vmap(
+        replica_loss, in_dims=(0, 0, 0 if random_sigma else None, None, None, None),
+        randomness='different')
+
+    if penalize_unfair:
+        target_fair_labels_str = [
+            ''.join(target_fair_label.astype(str)) for target_fair_label in target_fair_labels]
+        fair_weights, sensitive_group, n_sensitive_group = prepare_fair_regularizer(
+            data, target_fair_labels_str, label_distances, args.device)
+    tensors = device_data(data, args.device)
+    # closing the managers waits for their pending writes, also on errors
+    with contextlib.ExitStack() as stack:
+        checkpoints = [stack.enter_context(CheckpointManager(checkpoint_path, args.max_keep))
+                       for checkpoint_path in checkpoint_paths]
+
+        for epoch in range(args.max_epoch):
+            np.random.shuffle(data.train_idx)
+            train_idx = tensors.index(data.train_idx)
+
+            smooth_total_loss = torch.zeros(len(models), device=args.device)
+            succses_updates = torch.zeros(len(models), dtype=torch.long, device=args.device)
+            with tqdm(range(int(len(data.train_idx) / float(data.batch_size)) + 1),
+                      desc=f'Train {len(models)} VAEs, epoch {epoch}') as t:
+                for i in t:
+                    start = i * data.batch_size
+                    end = min(data.batch_size * (i + 1), len(data.train_idx))
+                    batch_idx = train_idx[start:end]
+
+                    input_feat, input_label = tensors.batch(batch_idx)
+                    fair_state = (batch_idx, fair_weights, sensitive_group,
+                                  n_sensitive_group) if penalize_unfair else None
+                    r_sqrt_sigma = random_r_sqrt_sigma(args, (len(models),)) if random_sigma else None
+
+                    optimizer.zero_grad()
+                    total_losses = ensemble_loss(
+                        params, buffers, r_sqrt_sigma, input_feat, input_label, fair_state)
+                    total_losses.sum().backward()
+
+                    # per-replica `clip_grad_norm_(..., 10.)` and `has_finite_grad`
+                    grads = [param.grad for param in trainable if param.grad is not None]
+                    grad_norms = torch.stack(
+                        [grad.flatten(1).norm(dim=1) for grad in grads]).norm(dim=0)
+                    clip_coef = torch.clamp(10. / (grad_norms + 1e-6), max=1.)
+                    for grad in grads:
+                        grad.mul_(clip_coef.view((-1,) + (1,) * (grad.dim() - 1)))
+                    update = torch.isfinite(grad_norms)
+                    if masked_optimizer_step(optimizer, trainable, update):
+                        scheduler.step()
+                    succses_updates += update
+                    smooth_total_loss += total_losses.detach()
+
+                    t.set_postfix({'total_loss': np.round(smooth_total_loss.cpu().numpy() / float(i + 1), 4).tolist(),
+                                   'success_updates': succses_updates.tolist()})
+
+            # copy every replica out of the stack to validate and checkpoint it
+            with torch.no_grad():
+                for k, model in enumerate(models):
+                    for name, param in model.named_parameters():
+                        param.copy_(params[name][k])
+
+            for model, checkpoint in zip(models, checkpoints):
+                eval_total_loss = validate_mpvae_softfair(
+                    data, model,
+                    penalize_unfair=penalize_unfair,
+                    target_fair_labels=target_fair_labels,
+                    label_distances=label_distances,
+                    args=args)
+                checkpoint.save(model, eval_total_loss, epoch)
+
+    return models
+
+
+def train_mpvae_softfair_continuation(
+        data, fair_coeffs, checkpoint_path, penalize_unfair, target_fair_labels, label_distances, args):
+    """Train one `VAE` per `fair_coeff`, in ascending order, each warm-started
+    from the best checkpoint of the previous coefficient.
+
+    The first coefficient starts from `args.continuation_init` if given, from
+    scratch otherwise, and trains for `args.max_epoch` epochs; the following
+    ones fine-tune for `args.continuation_epoch` epochs with a fresh optimizer
+    and learning-rate schedule. `checkpoint_path(seed)` is called once
+    `args.fair_coeff` is set, so every coefficient keeps its own checkpoint.
+    Coefficients already trained are not retrained but still seed the next.
+    """
+    fair_coeff_ = args.fair_coeff
+    continuation_epoch = getattr(args, 'continuation_epoch', None)
+    if continuation_epoch is None:
+        continuation_epoch = max(args.max_epoch // 4, 1)
+    one_epoch_iter = np.ceil(len(data.train_idx) / args.batch_size)
+
+    previous_path = getattr(args, 'continuation_init', None)
+    try:
+        for fair_coeff in sorted(fair_coeffs):
+            args.fair_coeff = fair_coeff
+            fair_vae_checkpoint_path = checkpoint_path(args.seed)
+            if args.train_new == 0 and os.path.exists(fair_vae_checkpoint_path):
+                print(f'find trained mpvae: {fair_vae_checkpoint_path}...')
+                previous_path = fair_vae_checkpoint_path
+                continue
+
+            fair_vae = VAE(args).to(args.device)
+            n_epoch = args.max_epoch
+            if previous_path is not None:
+                print(f'warm-start mpvae from: {previous_path}...')
+                fair_vae.load_state_dict(torch.load(previous_path, map_location=args.device))
+                n_epoch = continuation_epoch
+            fair_vae.train()
+            print(f'train a new mpvaeL: {fair_vae_checkpoint_path}...')
+
+            optimizer = torch.optim.Adam(
+                fair_vae.parameters(), lr=args.learning_rate, weight_decay=1e-5)
+            scheduler = torch.optim.lr_scheduler.StepLR(
+                optimizer, max(one_epoch_iter * (n_epoch / args.lr_decay_times), 1), args.lr_decay_ratio)
+
+            with CheckpointManager(fair_vae_checkpoint_path, args.max_keep) as checkpoints:
+                for epoch in range(n_epoch):
+                    train_mpvae_softfair_one_epoch(
+                        data, fair_vae, optimizer, scheduler,
+                        penalize_unfair=penalize_unfair,
+                        target_fair_labels=target_fair_labels,
+                        label_distances=label_distances,
+                        eval_after_one_epoch=False,
+                        args=args)
+                    eval_total_loss = validate_mpvae_softfair(
+                        data, fair_vae,
+                        penalize_unfair=penalize_unfair,
+                        target_fair_labels=target_fair_labels,
+                        label_distances=label_distances,
+                        args=args)
+                    checkpoints.save(fair_vae, eval_total_loss, epoch)
+            if n_epoch == 0:
+                # `-continuation_epoch 0`: the coefficient keeps the warm-start state
+                atomic_write(fair_vae_checkpoint_path,
+                             lambda f: torch.save(state_dict_snapshot(fair_vae), f))
+            previous_path = fair_vae_checkpoint_path
+    finally:
+        args.fair_coeff = fair_coeff_
+
+
+def validate_mpvae(model, data, args):
     args.device = next(model.parameters()).device
+    valid_idx = data.valid_idx
+    tensors = device_data(data, args.device)
+    valid_idx_t = tensors.index(valid_idx)
     with torch.no_grad():
         model.eval()
         print("performing validation...")
@@ -364,13 +531,7 @@ def validate_mpvae(model, feat, labels, valid_idx, args):
             for i in t:
                 start = real_batch_size * i
                 end = min(real_batch_size * (i + 1), len(valid_idx))
-                input_feat = feat[valid_idx[start:end]]
-                input_label = labels[valid_idx[start:end]]
-
-                input_feat = torch.from_numpy(
-                    input_feat).float().to(args.device)
-                input_label = torch.from_numpy(
-                    input_label).float().to(args.device)
+                input_feat, input_label = tensors.batch(valid_idx_t[start:end])
 
                 label_out, label_mu, label_logvar, feat_out, feat_mu, feat_logvar = model(
                     input_label, input_feat)
@@ -383,9 +544,9 @@ def validate_mpvae(model, feat, labels, valid_idx, args):
                 all_c_loss += c_loss * (end - start)
                 all_total_loss += total_loss * (end - start)
 
-                for j in deepcopy(indiv_prob).cpu().data.numpy():
+                for j in indiv_prob.cpu().numpy():
                     all_indiv_prob.append(j)
-                for j in deepcopy(input_label).cpu().data.numpy():
+                for j in input_label.cpu().numpy():
                     all_label.append(j)
 
         # collect all predictions and ground-truths
@@ -397,23 +558,8 @@ def validate_mpvae(model, feat, labels, valid_idx, args):
         c_loss = all_c_loss / len(valid_idx)
         total_loss = all_total_loss / len(valid_idx)
 
-        best_val_metrics = None
-        for threshold in THRESHOLDS:
-            val_metrics = evals.compute_metrics(
-                all_indiv_prob, all_label, threshold, all_metrics=True)
-
-            if best_val_metrics is None:
-                best_val_metrics = {}
-                for metric in METRICS:
-                    best_val_metrics[metric] = val_metrics[metric]
-            else:
-                for metric in METRICS:
-                    if 'FDR' in metric:
-                        best_val_metrics[metric] = min(
-                            best_val_metrics[metric], val_metrics[metric])
-                    else:
-                        best_val_metrics[metric] = max(
-                            best_val_metrics[metric], val_metrics[metric])
+        best_val_metrics = evals.best_threshold_metrics(
+            all_indiv_prob, all_label, THRESHOLDS, METRICS)
 
         time_str = datetime.datetime.now().isoformat()
         acc, ha, ebf1, maf1, mif1 = best_val_metrics['ACC'], best_val_metrics['HA'], best_val_metrics[
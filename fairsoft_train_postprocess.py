@@ -2,23 +2,26 @@ import sys
 import os
 import pickle
 import types
-from copy import deepcopy
 
 from tqdm import tqdm
 import numpy as np
 import torch.nn as nn
+import torch.nn.functional as F
 import torch
 from torch import optim
 from torch.autograd import Variable
 
 from logger import Logger
 from utils import allexists, build_path, search_files
-from fairsoft_utils import has_finite_grad
+from fairsoft_utils import has_finite_grad, prepare_fair_regularizer, fair_regularizer, \
+    label_distance_weights, sensitive_group_index, group_mean_gaps, device_data
 from mpvae import compute_loss, VAE
 import evals
 from main import THRESHOLDS, METRICS
 from data import load_data, load_data_masked
-from label_distance_obs import jaccard_similarity, constant_similarity, indication_similarity
+from label_distance_obs import jaccard_similarity_table, constant_similarity_table, indication_similarity_table, \
+    as_label_similarity
+from similarity_cache import cached_similarity_table, export_similarity_table
 
 IMPLEMENTED_METHODS = ['baseline', 'unfair', 'jaccard']
 
@@ -65,32 +68,29 @@ def postprocess_threshold_one_epoch(
     np.random.shuffle(data.train_idx)
     args.device = threshold_.device
 
+    fair_weights, sensitive_group, n_sensitive_group = prepare_fair_regularizer(
+        data, target_fair_labels, label_distances, args.device)
+    tensors = device_data(data, args.device)
+    train_idx = tensors.index(data.train_idx)
+
     smooth_total_loss = 0.
     smooth_bce_loss = 0.
     smooth_fair_loss = 0.
 
-    smooth_macro_f1 = 0.  # macro_f1 score
-    smooth_micro_f1 = 0.  # micro_f1 score
+    train_metrics = evals.MetricAccumulator(0.5)  # maF1 / miF1
 
     contributed_reg_fair_sample = 0
     succses_updates = 0
     print(data.batch_size)
 
-    sen_centroids = np.unique(data.sensitive_feat, axis=0)
-    sen_centroids = torch.from_numpy(sen_centroids).to(args.device)
-
     with tqdm(range(int(len(data.train_idx) / float(data.batch_size)) + 1), desc='Train VAE') as t:
         for i in t:
             optimizer.zero_grad()
             start = i * data.batch_size
             end = min(data.batch_size * (i + 1), len(data.train_idx))
-            idx = data.train_idx[start:end]
-
-            input_feat = torch.from_numpy(
-                data.input_feat[idx]).float().to(args.device)
+            batch_idx = train_idx[start:end]
 
-            input_label = torch.from_numpy(
-                data.labels[idx]).float().to(args.device)
+            input_feat, input_label = tensors.batch(batch_idx)
             label_out, label_mu, label_logvar, feat_out, feat_mu, feat_logvar = model(
                 input_label, input_feat)
 
@@ -109,10 +109,8 @@ def postprocess_threshold_one_epoch(
                     input_label, label_out, label_mu, label_logvar, feat_out, feat_mu, feat_logvar,
                     model.r_sqrt_sigma, args)
 
-            sensitive_feat = torch.from_numpy(
-                data.sensitive_feat[idx]).to(args.device)
-            sen_belong = torch.all(
-                torch.eq(sensitive_feat.unsqueeze(1), sen_centroids), dim=2)
+            group = sensitive_group.index_select(0, batch_idx)
+            sen_belong = F.one_hot(group, n_sensitive_group).bool()
 
             threshold = threshold_
             if args.learn_logit:
@@ -125,44 +123,15 @@ def postprocess_threshold_one_epoch(
                          (1 - input_label) * torch.log(1 - cal_prob + 1e-6))
             bce_loss = bce_loss.sum(1).mean()
 
-            sensitive_centroids = torch.unique(sensitive_feat, dim=0)
-            idx_tensor = torch.arange(sensitive_feat.shape[0])
-
-            fair_loss = 0.
-            for target_fair_label in target_fair_labels:
-                target_label_dist = label_distances[target_fair_label]
-                # compute weights of each sample
-                weights = []
-                for label in data.labels[idx]:
-                    label = label.astype(int)
-                    distance = target_label_dist.get(
-                        ''.join(label.astype(str)), 0.)
-                    weights.append(distance)
-                    if distance > 0:
-                        contributed_reg_fair_sample += 1
-                weights = torch.tensor(weights).to(
-                    args.device).reshape(-1, 1)
-
-                # current batch has contributed samples
-                if weights.sum() > 0:
-                    cal_prob_weighted = torch.sum(
-                        cal_prob * weights, axis=0) / weights.sum()
-
-                    for sensitive in sensitive_centroids:
-                        target_sensitive = torch.all(
-                            torch.eq(sensitive_feat, sensitive), dim=1)
-                        cal_prob_sensitive = cal_prob[idx_tensor[target_sensitive]]
-                        weight_sensitive = weights[idx_tensor[target_sensitive]]
-
-                        if weight_sensitive.sum() > 0:
-                            reg_cal_prob_sen = torch.sum(
-                                cal_prob_sensitive * weight_sensitive, 0) / weight_sensitive.sum()
-                            fair_loss += torch.sum(
-                                torch.pow(reg_cal_prob_sen - cal_prob_weighted, 2))
-
-            if not isinstance(fair_loss, float):
-                total_loss = fair_loss * args.fair_coeff + bce_loss
-                smooth_fair_loss += fair_loss.item()
+            weights = fair_weights.index_select(0, batch_idx)
+            contributed_reg_fair_sample += int(
+                torch.count_nonzero(weights > 0).item())
+
+            fair_loss = fair_regularizer(
+                cal_prob, weights, group, n_sensitive_group, 'l2')
+
+            total_loss = fair_loss * args.fair_coeff + bce_loss
+            smooth_fair_loss += fair_loss.item()
 
             total_loss.backward()
             # nn.utils.clip_grad_norm_(threshold_, 10.)
@@ -175,28 +144,26 @@ def postprocess_threshold_one_epoch(
                 succses_updates += 1
 
             # evaluation
-            train_metrics = evals.compute_metrics(
-                cal_prob.cpu().data.numpy(), input_label.cpu().data.numpy(), 0.5,
-                all_metrics=False)
-            macro_f1, micro_f1 = train_metrics['maF1'], train_metrics['miF1']
+            train_metrics.update(cal_prob, input_label)
 
             smooth_bce_loss += bce_loss.item()
-            smooth_macro_f1 += macro_f1.item()
-            smooth_micro_f1 += micro_f1.item()
             smooth_total_loss += total_loss.item()
             # log the labels
 
             running_postfix = {'total_loss': smooth_total_loss / float(i + 1),
                                'smooth_bce_loss': smooth_bce_loss / float(i + 1),
                                'smooth_fair_loss': smooth_fair_loss / float(i + 1),
-                               'maF1': smooth_macro_f1 / float(i + 1),
-                               'miF1': smooth_micro_f1 / float(i + 1),
                                'success_updates': succses_updates,
                                'contributed samples': contributed_reg_fair_sample
                                }
 
             t.set_postfix(running_postfix)
 
+        epoch_metrics = train_metrics.compute()
+        running_postfix['maF1'] = epoch_metrics['maF1']
+        running_postfix['miF1'] = epoch_metrics['miF1']
+        t.set_postfix(running_postfix)
+
 
 def train_fair_through_postprocess(args):
 
@@ -205,32 +172,29 @@ def train_fair_through_postprocess(args):
         hparams = f'jaccard_{args.dist_gamma}'
         label_dist_path = os.path.join(
             args.model_dir, f'label_dist-{hparams}.npy')
-        if args.train_new == 0 and os.path.exists(label_dist_path):
-            label_dist = pickle.load(open(label_dist_path, 'rb'))
-        else:
-            label_dist = jaccard_similarity(args)
-            pickle.dump(label_dist, open(label_dist_path, 'wb'))
+        label_dist = cached_similarity_table(
+            lambda: jaccard_similarity_table(args),
+            dataset=args.dataset, encoding='onehot', metric='jaccard', gamma=args.dist_gamma)
+        export_similarity_table(label_dist, label_dist_path)
 
     elif args.label_dist == 'constant':
         hparams = f'constant'
         label_dist_path = os.path.join(
             args.model_dir, f'label_dist-{hparams}.npy')
-        if args.train_new == 0 and os.path.exists(label_dist_path):
-            label_dist = pickle.load(open(label_dist_path, 'rb'))
-        else:
-            label_dist = constant_similarity(args)
-            pickle.dump(label_dist, open(label_dist_path, 'wb'))
+        label_dist = cached_similarity_table(
+            lambda: constant_similarity_table(args),
+            dataset=args.dataset, encoding='onehot', metric='constant', gamma=None)
+        export_similarity_table(label_dist, label_dist_path)
 
     elif args.label_dist == 'indication':
         hparams = f'indication'
         label_dist_path = os.path.join(
             args.model_dir, f'label_dist-{hparams}.npy')
 
-        if args.train_new == 0 and os.path.exists(label_dist_path):
-            label_dist = pickle.load(open(label_dist_path, 'rb'))
-        else:
-            label_dist = indication_similarity(args)
-            pickle.dump(label_dist, open(label_dist_path, 'wb'))
+        label_dist = cached_similarity_table(
+            lambda: indication_similarity_table(args),
+            dataset=args.dataset, encoding='onehot', metric='indication', gamma=None)
+        export_similarity_table(label_dist, label_dist_path)
     else:
         raise NotImplementedError()
 
@@ -322,8 +286,10 @@ def evaluate_fair_through_postprocess(
         target_fair_labels_str.append(target_fair_label)
     target_fair_labels = target_fair_labels_str
 
-    sen_centroids = np.unique(data.sensitive_feat, axis=0)
-    sen_centroids = torch.from_numpy(sen_centroids).to(args.device)
+    tensors = device_data(data, args.device)
+    sensitive_group, n_sensitive_group = sensitive_group_index(data.sensitive_feat)
+    sensitive_group = torch.from_numpy(sensitive_group).long().to(args.device)
+    subset_idx_t = tensors.index(subset_idx)
 
     with torch.no_grad():
         model.eval()
@@ -339,7 +305,6 @@ def evaluate_fair_through_postprocess(
             calibrated_prob = []
             if eval_fairness:
                 train_feat_z = []
-                train_sensitive = data.sensitive_feat[subset_idx]
             with tqdm(
                     range(int(len(subset_idx) / float(data.batch_size)) + 1),
                     desc=f'Evaluate on {subset} set') as t:
@@ -347,13 +312,9 @@ def evaluate_fair_through_postprocess(
                 for i in t:
                     start = i * data.batch_size
                     end = min(data.batch_size * (i + 1), len(subset_idx))
-                    idx = subset_idx[start:end]
-
-                    input_feat = torch.from_numpy(
-                        data.input_feat[idx]).to(args.device)
+                    batch_idx = subset_idx_t[start:end]
 
-                    input_label = torch.from_numpy(data.labels[idx])
-                    input_label = deepcopy(input_label).float().to(args.device)
+                    input_feat, input_label = tensors.batch(batch_idx)
 
                     label_out, label_mu, label_logvar, feat_out, feat_mu, feat_logvar = model(
                         input_label, input_feat)
@@ -365,46 +326,27 @@ def evaluate_fair_through_postprocess(
                     train_c_loss += c_loss.item() * (end - start)
                     train_total_loss += total_loss.item() * (end - start)
 
-                    for j in deepcopy(indiv_prob).cpu().data.numpy():
-                        train_indiv_prob.append(j)
-                    for j in deepcopy(input_label).cpu().data.numpy():
-                        train_label.append(j)
+                    train_indiv_prob.append(indiv_prob.cpu().numpy())
+                    train_label.append(input_label.cpu().numpy())
 
                     if eval_fairness:
-                        sensitive_feat = torch.from_numpy(
-                            data.sensitive_feat[idx]).to(args.device)
-                        sen_belong = torch.all(
-                            torch.eq(sensitive_feat.unsqueeze(1), sen_centroids), dim=2)
+                        sen_belong = F.one_hot(
+                            sensitive_group.index_select(0, batch_idx), n_sensitive_group).bool()
 
                         cal_prob = calibrate_p(
                             indiv_prob.unsqueeze(-1), threshold_)
                         cal_prob = cal_prob.transpose(1, 2)[sen_belong]
                         calibrated_prob.append(cal_prob.cpu().data.numpy())
 
-                train_indiv_prob = np.array(train_indiv_prob)
-                train_label = np.array(train_label)
+                train_indiv_prob = np.concatenate(train_indiv_prob)
+                train_label = np.concatenate(train_label)
 
                 nll_loss = train_nll_loss / len(subset_idx)
                 c_loss = train_c_loss / len(subset_idx)
                 total_loss = train_total_loss / len(subset_idx)
 
-                best_val_metrics = None
-                for threshold in THRESHOLDS:
-                    val_metrics = evals.compute_metrics(
-                        train_indiv_prob, train_label, threshold, all_metrics=True)
-
-                    if best_val_metrics is None:
-                        best_val_metrics = {}
-                        for metric in METRICS:
-                            best_val_metrics[metric] = val_metrics[metric]
-                    else:
-                        for metric in METRICS:
-                            if 'FDR' in metric:
-                                best_val_metrics[metric] = min(
-                                    best_val_metrics[metric], val_metrics[metric])
-                            else:
-                                best_val_metrics[metric] = max(
-                                    best_val_metrics[metric], val_metrics[metric])
+                best_val_metrics = evals.best_threshold_metrics(
+                    train_indiv_prob, train_label, THRESHOLDS, METRICS)
 
                 acc, ha, ebf1, maf1, mif1 = best_val_metrics['ACC'], best_val_metrics['HA'], \
                     best_val_metrics['ebF1'], best_val_metrics['maF1'], \
@@ -415,33 +357,11 @@ def evaluate_fair_through_postprocess(
                     assert train_feat_z.shape[0] == len(subset_idx) and \
                         train_feat_z.shape[1] == data.labels.shape[1]
 
-                    sensitive_centroid = np.unique(train_sensitive, axis=0)
-                    idxs = np.arange(len(subset_idx))
-
-                    mean_diffs = []
-                    for target_fair_label in target_fair_labels:
-                        target_label_dist = label_distances[target_fair_label]
-                        weights = []
-                        for label in data.labels[idxs]:
-                            label = label.astype(int)
-                            distance = target_label_dist.get(
-                                ''.join(label.astype(str)), 0.)
-                            weights.append(distance)
-                        weights = np.array(weights).reshape(-1, 1)
-                        if weights.sum() > 0:
-                            feat_z_weighted = np.sum(
-                                train_feat_z * weights, axis=0) / weights.sum()
-
-                            for sensitive in sensitive_centroid:
-                                target_sensitive = np.all(
-                                    np.equal(train_sensitive, sensitive), axis=1)
-                                feat_z_sensitive = train_feat_z[idxs[target_sensitive]]
-                                weights_sensitive = weights[idxs[target_sensitive]]
-                                if weights_sensitive.sum() > 0:
-                                    unfair_feat_z_sen = np.sum(
-                                        feat_z_sensitive * weights_sensitive, 0) / weights_sensitive.sum()
-                                    mean_diffs.append(
-                                        np.sum(np.power(unfair_feat_z_sen - feat_z_weighted, 2)))
+                    weights = label_distance_weights(
+                        data.labels[subset_idx], target_fair_labels, label_distances)
+                    group, n_group = sensitive_group_index(data.sensitive_feat)
+                    mean_diffs = group_mean_gaps(
+                        train_feat_z, weights, group[subset_idx], n_group)
 
                     mean_diffs = np.mean(mean_diffs)
                     # mean_diffs = np.max(mean_diffs) / \
@@ -526,7 +446,7 @@ def evaluate_over_labels(target_fair_labels, args, logger=Logger()):
     for dist_metric in label_dist_metric_paths:
         logger.logging(f'Evaluate fairness definition: {dist_metric}...')
         logger.logging('\n' * 3)
-        label_dist = pickle.load(open(dist_metric, 'rb'))
+        label_dist = as_label_similarity(pickle.load(open(dist_metric, 'rb')))
 
         dist_metric = dist_metric.replace(
             '.npy', '').split('/')[-1].split('-')[1]
@@ -2,16 +2,13 @@ import sys
 import os
 import pickle
 
-import torch
-import numpy as np
-
 from utils import allexists, build_path
 from logger import Logger
-from fairsoft_utils import retrieve_target_label_idx
 
 sys.path.append('./')
 
 IMPLEMENTED_METHODS = ['baseline', 'unfair', 'jaccard']
+DIST_GAMMAS = [.01, 1., 5., 10.]
 
 
 def train_fairsoft_arule(args):
@@ -68,7 +65,6 @@ def train_fairsoft_jaccard(args):
 
 def eval_fairsoft_allmodels(args):
     args.mode = 'test'
-    from fairsoft_evaluate import evaluate_target_labels
 
     args.model_dir = f'fair_through_distance/model/{args.dataset}'
     if args.mask_target_label:
@@ -83,10 +79,13 @@ def eval_fairsoft_allmodels(args):
             args.model_dir, f'evaluation-{args.target_label_idx}')
     build_path(eval_results_path)
 
+    model_seed = getattr(args, 'model_seed', None)
+    if model_seed is None:
+        model_seed = args.seed
     fair_results_path = os.path.join(
-        eval_results_path, f'fair_eval_lambda={args.fair_coeff:.2f}_{args.seed:04d}.pkl')
+        eval_results_path, f'fair_eval_lambda={args.fair_coeff:.2f}_{model_seed:04d}.pkl')
     perform_results_path = os.path.join(
-        eval_results_path, f'perform_eval_lambda={args.fair_coeff:.2f}_{args.seed:04d}.pkl')
+        eval_results_path, f'perform_eval_lambda={args.fair_coeff:.2f}_{model_seed:04d}.pkl')
 
     if allexists(fair_results_path, perform_results_path) and bool(args.train_new) is False:
         print(
@@ -96,6 +95,7 @@ def eval_fairsoft_allmodels(args):
     else:
         print(
             f'create new evalution results: {fair_results_path}, {perform_results_path}')
+        from fairsoft_evaluate import evaluate_target_labels
         fair_results, perform_results = evaluate_target_labels(args, logger)
         pickle.dump(fair_results, open(fair_results_path, 'wb'))
         pickle.dump(perform_results, open(perform_results_path, 'wb'))
@@ -143,16 +143,68 @@ def eval_fairsoft_allmodels(args):
     logger.logging('\\bottomrule')
 
 
-if __name__ == '__main__':
+def eval_trial_models(args):
+    # every coefficient of `-continuation_coeffs` and every replica of
+    # `-ensemble_seeds` is evaluated, the replicas on the data split of
+    # `args.seed` they were trained on
+    fair_coeff_ = args.fair_coeff
+    fair_coeffs = sorted(args.continuation_coeffs) if getattr(
+        args, 'continuation_coeffs', None) else [args.fair_coeff]
+    try:
+        for fair_coeff in fair_coeffs:
+            args.fair_coeff = fair_coeff
+            for model_seed in args.ensemble_seeds or [args.seed]:
+                args.model_seed = model_seed
+                eval_fairsoft_allmodels(args)
+    finally:
+        args.fair_coeff = fair_coeff_
+        args.model_seed = None
+
+
+def trial_parser():
     from main import parser
     parser.add_argument('-fairness_loss_norm', type=str, default='l1')
     parser.add_argument('-dist_gamma', type=float, default=None)
     parser.add_argument('-target_label_idx', type=int, default=None)
     parser.add_argument('-target_label', type=str, default=None)
     parser.add_argument('-mask_target_label', type=int, default=0)
+    parser.add_argument('-ensemble_seeds', type=int, nargs='+', default=None,
+                        help='train one model per seed in this process')
     parser.add_argument('-perform_metric', type=str, nargs='+',
                         default=['maF1', 'miF1'])
-    args = parser.parse_args()
+    return parser
+
+
+def preload_trial(args):
+    """Import the trainers and load what every trial on `args.dataset` reads
+    first: the dataset and its jaccard tables. Workers forked afterwards
+    inherit them instead of paying for the imports and loads again."""
+    import fairsoft_jaccard
+    import fairsoft_evaluate
+    from data import preload_data
+    from label_distance_obs import jaccard_similarity_tables
+    from similarity_cache import cached_similarity_table
+
+    preload_data(args.dataset, 'onehot')
+
+    tables = {}
+
+    def build(dist_gamma):
+        # one pairwise pass serves all the gammas that miss the cache
+        if not tables:
+            tables.update(jaccard_similarity_tables(args, DIST_GAMMAS))
+        return tables[dist_gamma]
+
+    for dist_gamma in DIST_GAMMAS:
+        cached_similarity_table(
+            lambda: build(dist_gamma),
+            dataset=args.dataset, encoding='onehot', metric='jaccard', gamma=dist_gamma)
+
+
+def run_trial(args):
+    # torch loads here, after argument parsing, so that `-h` stays fast
+    import torch
+    from fairsoft_utils import retrieve_target_label_idx
 
     args.device = torch.device(
         f"cuda:{args.cuda}" if torch.cuda.is_available() else "cpu")
@@ -164,21 +216,21 @@ if __name__ == '__main__':
         # train_fairsoft_baseline(args)
 
         args.penalize_unfair = 1
-        for dist_gamma in [.01, 1., 5., 10.]:
+        for dist_gamma in DIST_GAMMAS:
             args.dist_gamma = dist_gamma
             train_fairsoft_jaccard(args)
             # train_fairsoft_arule(args)
 
         # train_fairsoft_hamming(args)
         # train_fairsoft_baseline(args)
-        eval_fairsoft_allmodels(args)
+        eval_trial_models(args)
 
     elif args.target_label_idx is not None:
         args.penalize_unfair = 0
         # train_fairsoft_baseline(args)
 
         args.penalize_unfair = 1
-        for dist_gamma in [.01, 1., 5., 10.]:
+        for dist_gamma in DIST_GAMMAS:
             args.dist_gamma = dist_gamma
             train_fairsoft_jaccard(args)
 
@@ -187,7 +239,7 @@ if __name__ == '__main__':
         # train_fairsoft_hamming(args)  # 21587 samples
         # train_fairsoft_jaccard(args)  # 19604 samples
         # train_fairsoft_baseline(args)  # eo: 641 samples, dp: 21587 samples
-        eval_fairsoft_allmodels(args)
+        eval_trial_models(args)
 
     else:
         args.penalize_unfair = 0
@@ -200,14 +252,25 @@ if __name__ == '__main__':
             # train_fairsoft_baseline(args)
 
             args.penalize_unfair = 1
-            for dist_gamma in [.01, 1., 5., 10.]:
+            for dist_gamma in DIST_GAMMAS:
                 args.dist_gamma = dist_gamma
                 train_fairsoft_jaccard(args)
                 # train_fairsoft_arule(args)
 
             # train_fairsoft_hamming(args)
             # train_fairsoft_baseline(args)
-            eval_fairsoft_allmodels(args)
+            eval_trial_models(args)
+
+
+if __name__ == '__main__':
+    args = trial_parser().parse_args()
+    exit_path = os.environ.get('FAIRSOFT_EXIT_PATH')
+    if exit_path is None:
+        run_trial(args)
+    else:
+        # launched by fairsoft_scheduler, which reads the status back
+        from fairsoft_scheduler import run_recording_exit
+        sys.exit(run_recording_exit(lambda: run_trial(args), exit_path))
 
 
 # python fairsoft_trial.py -dataset adult -latent_dim 8 -target_label_idx 0 -mask_target_label 1 -cuda 5
@@ -1,5 +1,6 @@
 
 import torch
+import torch.nn.functional as F
 import numpy as np
 
 
@@ -41,6 +42,159 @@ def has_finite_grad(model):
     return finite_grad
 
 
+class DeviceData:
+    """Arrays of a dataset namespace as contiguous tensors on `device`.
+
+    Features, labels, sensitive attributes and (if present) label clusters
+    are converted and copied once; a batch is then gathered with
+    `index_select` on an index tensor that lives on the same device.
+    """
+
+    def __init__(self, data, device):
+        self.device = device
+        self.input_feat = self._to_tensor(data.input_feat, np.float32)
+        self.labels = self._to_tensor(data.labels, np.float32)
+        self.sensitive_feat = self._to_tensor(
+            getattr(data, 'sensitive_feat', None), np.float32)
+        self.label_clusters = self._to_tensor(
+            getattr(data, 'label_clusters', None), None)
+
+    def _to_tensor(self, array, dtype):
+        if array is None:
+            return None
+        array = np.ascontiguousarray(array, dtype=dtype)
+        return torch.from_numpy(array).to(self.device)
+
+    def index(self, idx):
+        # one host->device copy of (e.g.) an epoch's shuffled indices
+        return torch.from_numpy(np.asarray(idx, dtype=np.int64)).to(self.device)
+
+    def batch(self, batch_idx):
+        return self.input_feat.index_select(0, batch_idx), self.labels.index_select(0, batch_idx)
+
+
+def device_data(data, device):
+    # cache the device copy on `data`, as `prepare_fair_regularizer` does
+    cached = getattr(data, 'device_data', None)
+    if cached is None or cached.device != device:
+        cached = DeviceData(data, device)
+        data.device_data = cached
+    return cached
+
+
+def sensitive_group_index(sensitive_feat):
+    sensitive_type, group = np.unique(
+        sensitive_feat, axis=0, return_inverse=True)
+    return group.reshape(-1), len(sensitive_type)
+
+
+def label_distance_weights(labels, target_fair_labels, label_distances):
+    from label_distance_obs import as_label_similarity
+
+    label_similarity = as_label_similarity(label_distances)
+    labels_id = label_similarity.index(labels)
+    return label_similarity.weights(labels_id, target_fair_labels)
+
+
+def group_mean_gap_matrix(z, weights, group, n_group):
+    """Squared l2 gap of every (target label, sensitive group) pair, shaped
+    (n_target, n_group), and the mask of the pairs with positive weight."""
+    group_onehot = np.eye(n_group, dtype=z.dtype)[group]
+
+    weighted_z = weights.T[:, :, np.newaxis] * z[np.newaxis]
+    total_weight = weights.sum(0)
+    group_weight = np.matmul(group_onehot.T, weights).T
+
+    overall_mean = weighted_z.sum(1) / np.where(
+        total_weight > 0, total_weight, 1.)[:, np.newaxis]
+    group_mean = np.matmul(group_onehot.T, weighted_z) / np.where(
+        group_weight > 0, group_weight, 1.)[:, :, np.newaxis]
+    gap = np.sum(np.power(group_mean - overall_mean[:, np.newaxis], 2), -1)
+
+    valid = np.logical_and(
+        group_weight > 0, total_weight[:, np.newaxis] > 0)
+    return gap, valid
+
+
+def group_mean_gaps(z, weights, group, n_group):
+    """Numpy counterpart of `fair_regularizer`.
+
+    Returns the squared l2 gap of every (target label, sensitive group) pair
+    with positive weight, as a flat array.
+    """
+    gap, valid = group_mean_gap_matrix(z, weights, group, n_group)
+    return gap[valid]
+
+
+def stacked_mean_diffs(z, weights, group, n_group):
+    """`fair_mean_diff` of several fairness definitions from one reduction.
+
+    weights: list with one (n_sample, n_target) weight matrix per definition.
+    The matrices are stacked along the target axis, so `z` is reduced once;
+    returns the mean l2 gap over the valid pairs of every definition.
+    """
+    gap, valid = group_mean_gap_matrix(
+        z, np.concatenate(weights, axis=1), group, n_group)
+    diffs = np.where(valid, np.sqrt(gap), 0.)
+
+    bounds = np.cumsum([0] + [w.shape[1] for w in weights])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.array([diffs[start:end].sum() / valid[start:end].sum()
+                         for start, end in zip(bounds[:-1], bounds[1:])])
+
+
+def prepare_fair_regularizer(data, target_fair_labels, label_distances, device):
+    # cache per-sample fairness weights and sensitive groups on `data`
+    cached = getattr(data, 'fair_regularizer_cache', None)
+    if cached is None or cached[0] is not label_distances or \
+            cached[1] != tuple(target_fair_labels) or cached[2] != device:
+        weights = label_distance_weights(
+            data.labels, target_fair_labels, label_distances)
+        group, n_group = sensitive_group_index(data.sensitive_feat)
+        data.fair_regularizer_cache = (
+            label_distances, tuple(target_fair_labels), device,
+            torch.from_numpy(weights).to(device),
+            torch.from_numpy(group).long().to(device), n_group)
+
+    return data.fair_regularizer_cache[3:]
+
+
+def fair_regularizer(z, weights, group, n_group, norm='l2'):
+    """Gap between group-wise and overall weighted means of `z`.
+
+    z: batch * label_dim, weights: batch * n_target, group: batch (long).
+    For every target label and every sensitive group with positive weight,
+    the l1/l2 distance between the group's weighted mean and the overall
+    weighted mean is summed.
+    """
+    weights = weights.to(z.dtype)
+    group_onehot = F.one_hot(group, n_group).to(z.dtype)
+
+    # n_target * batch * label_dim
+    weighted_z = weights.T.unsqueeze(-1) * z.unsqueeze(0)
+    total_weight = weights.sum(0)
+    group_weight = torch.mm(group_onehot.T, weights).T
+
+    overall_mean = weighted_z.sum(1) / torch.where(
+        total_weight > 0, total_weight, torch.ones_like(total_weight)).unsqueeze(-1)
+    # n_target * n_group * label_dim
+    group_mean = torch.matmul(group_onehot.T, weighted_z) / torch.where(
+        group_weight > 0, group_weight, torch.ones_like(group_weight)).unsqueeze(-1)
+
+    if norm == 'l1':
+        gap = torch.sum(torch.absolute(
+            group_mean - overall_mean.unsqueeze(1)), -1)
+    elif norm == 'l2':
+        gap = torch.sum(torch.pow(
+            group_mean - overall_mean.unsqueeze(1), 2), -1)
+    else:
+        raise ValueError(f'Unrecognized fairness loss norm: {norm}')
+
+    valid = torch.logical_and(
+        group_weight > 0, total_weight.unsqueeze(-1) > 0)
+    return torch.sum(torch.where(valid, gap, torch.zeros_like(gap)))
+
+
 def formal_model_name(name):
     fairness_name = formal_fairness_name(name)
     if fairness_name:
@@ -6,24 +6,19 @@ from scipy.spatial import distance
 
 from tqdm import tqdm 
 
-from sklearn.cluster import KMeans
-
-from kmodes.kprototypes import KPrototypes
-from sklearn.cluster import AgglomerativeClustering
-from mlxtend.frequent_patterns import apriori, association_rules
-from mlxtend.preprocessing import TransactionEncoder
-
 import torch
 import torch.nn as nn
 from torch import optim
 
 from embed import CBOW, CBOWData
-from train import train_mpvae_one_epoch
 from data import preprocess, load_data
+from label_distance import AprioriRuleIndex
 from mpvae import VAE
 
 
 def construct_labels_embed(data, args):
+    from train import train_mpvae_one_epoch
+
     one_epoch_iter = np.ceil(len(data.train_idx) / args.batch_size)
     train_idx = np.arange(int(len(data.labels) * .7))
 
@@ -131,6 +126,9 @@ def construct_labels_embed(data, args):
 
 
 def instance_based_cluster(labels_embed, cluster_method, args, **kwargs):
+    from sklearn.cluster import AgglomerativeClustering, KMeans
+    from kmodes.kprototypes import KPrototypes
+
     # TODO: do we have soft clustering algorithm? For example, can we use gumble softmax?
 
     # TODO: how to properly cluster labels based on JSD or KL average distance?
@@ -211,33 +209,11 @@ def instance_based_cluster(labels_embed, cluster_method, args, **kwargs):
     return labels_cluster
 
 
-def apriori_dist(labelset1, labelset2, apriori_rules):
-    if labelset1 == labelset2:
-        return 0
-
-    samelabels = labelset1.intersection(labelset2)
-    diff1 = labelset1.difference(samelabels)
-    diff2 = labelset2.difference(samelabels)
-
-    if len(samelabels) == 0:
-        return np.inf
-
-    score = np.inf
-    candidates = apriori_rules.loc[apriori_rules['antecedents'] == frozenset(
-        samelabels)]
-    if len(candidates):
-        score1 = candidates.loc[
-            candidates['consequents'] == frozenset(diff1), 'confidence']
-        score2 = candidates.loc[
-            candidates['consequents'] == frozenset(diff2), 'confidence']
-
-        if len(score1) and len(score2):
-            score = np.abs(score1.to_numpy() - score2.to_numpy()).item()
-
-    return score
-
-
 def apriori_cluster(labels, args):
+    from sklearn.cluster import AgglomerativeClustering
+    from mlxtend.frequent_patterns import apriori, association_rules
+    from mlxtend.preprocessing import TransactionEncoder
+
     labels = labels.astype(str)
 
     encoder = TransactionEncoder()
@@ -249,7 +225,8 @@ def apriori_cluster(labels, args):
     min_confidence = args.min_confidence or 0.
     labels_apri = apriori(
         labels_df, min_support=min_support, use_colnames=True, verbose=1)
-    labels_rules = association_rules(labels_apri, min_threshold=min_confidence)
+    labels_rules = AprioriRuleIndex.from_rules(
+        association_rules(labels_apri, min_threshold=min_confidence))
 
     income_level = np.unique(labels[:, 0])
     occupation = np.unique(labels[:, 1])
@@ -261,8 +238,7 @@ def apriori_cluster(labels, args):
             for work in workclass[1:]:
                 labelsets.append(set([income, occu, work]))
 
-    dist_matrix = np.asarray(
-        [[apriori_dist(p1, p2, labels_rules) for p2 in labelsets] for p1 in labelsets])
+    dist_matrix = labels_rules.pairwise_dist(labelsets)
     dist_matrix[np.isinf(dist_matrix)] = dist_matrix[~np.isinf(dist_matrix)].max() * 10
 
     distance_threshold = args.labels_cluster_distance_threshold
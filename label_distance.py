@@ -1,38 +1,78 @@
 import numpy as np
 import pandas as pd
-from mlxtend.frequent_patterns import apriori, association_rules
-from mlxtend.preprocessing import TransactionEncoder
 
 from data import load_data, preprocess
 
 
-def apriori_pair_dist(labelset1, labelset2, apriori_rules):
-    if labelset1 == labelset2:
-        return 0
+class AprioriRuleIndex:
+    """Association rules hashed by (antecedents, consequents).
+
+    Confidences are kept in a flat array and `_rule_ids` maps a pair of
+    frozensets to its position, so a rule lookup is a single dict access
+    instead of a scan over the rules DataFrame.
+    """
+
+    def __init__(self, antecedents, consequents, confidence):
+        self.confidence = np.asarray(confidence, dtype=np.float64)
+        self._rule_ids = {
+            (frozenset(antecedent), frozenset(consequent)): i
+            for i, (antecedent, consequent) in enumerate(zip(antecedents, consequents))}
+
+    @classmethod
+    def from_rules(cls, apriori_rules):
+        return cls(apriori_rules['antecedents'], apriori_rules['consequents'],
+                   apriori_rules['confidence'].to_numpy())
+
+    def __len__(self):
+        return len(self.confidence)
+
+    def get(self, antecedent, consequent, default=None):
+        rule_id = self._rule_ids.get((antecedent, consequent))
+        if rule_id is None:
+            return default
+        return self.confidence[rule_id]
+
+    def pair_dist(self, labelset1, labelset2):
+        if labelset1 == labelset2:
+            return 0
 
-    samelabels = labelset1.intersection(labelset2)
-    diff1 = labelset1.difference(samelabels)
-    diff2 = labelset2.difference(samelabels)
+        samelabels = frozenset(labelset1).intersection(labelset2)
+        if len(samelabels) == 0:
+            return np.inf
 
-    if len(samelabels) == 0:
-        return np.inf
+        score1 = self.get(samelabels, frozenset(labelset1).difference(samelabels))
+        score2 = self.get(samelabels, frozenset(labelset2).difference(samelabels))
+        if score1 is None or score2 is None:
+            return np.inf
 
-    score = np.inf
-    candidates = apriori_rules.loc[apriori_rules['antecedents'] == frozenset(
-        samelabels)]
-    if len(candidates):
-        score1 = candidates.loc[
-            candidates['consequents'] == frozenset(diff1), 'confidence']
-        score2 = candidates.loc[
-            candidates['consequents'] == frozenset(diff2), 'confidence']
+        return np.abs(score1 - score2).item()
 
-        if len(score1) and len(score2):
-            score = np.abs(score1.to_numpy() - score2.to_numpy()).item()
+    def pairwise_dist(self, labelsets):
+        labelsets = [frozenset(labelset) for labelset in labelsets]
+        dist_matrix = np.zeros((len(labelsets), len(labelsets)))
+        # the distance is symmetric, fill the upper triangle and mirror it
+        for i, p1 in enumerate(labelsets):
+            for j in range(i + 1, len(labelsets)):
+                dist_matrix[i, j] = dist_matrix[j, i] = self.pair_dist(
+                    p1, labelsets[j])
 
-    return score
+        return dist_matrix
+
+
+def as_rule_index(apriori_rules):
+    if isinstance(apriori_rules, AprioriRuleIndex):
+        return apriori_rules
+    return AprioriRuleIndex.from_rules(apriori_rules)
+
+
+def apriori_pair_dist(labelset1, labelset2, apriori_rules):
+    return as_rule_index(apriori_rules).pair_dist(labelset1, labelset2)
 
 
 def apriori_similarity(args, gamma=1., minimum_clip=0., maximum_clip=1.):
+    from mlxtend.frequent_patterns import apriori, association_rules
+    from mlxtend.preprocessing import TransactionEncoder
+
     np.random.seed(args.seed)
     _, _, labels, _, _, _ = load_data(
         args.dataset, args.mode, True, None)
@@ -58,7 +98,8 @@ def apriori_similarity(args, gamma=1., minimum_clip=0., maximum_clip=1.):
     min_confidence = args.min_confidence or 0.
     labels_apri = apriori(
         labels_df, min_support=min_support, use_colnames=True, verbose=1)
-    labels_rules = association_rules(labels_apri, min_threshold=min_confidence)
+    labels_rules = AprioriRuleIndex.from_rules(
+        association_rules(labels_apri, min_threshold=min_confidence))
 
     income_level = np.unique(labels[:, 0])
     occupation = np.unique(labels[:, 1])
@@ -69,20 +110,15 @@ def apriori_similarity(args, gamma=1., minimum_clip=0., maximum_clip=1.):
             for work in workclass[1:]:
                 labelsets.append(set([income, occu, work]))
 
+    labelsets_oh = [labels_express.get(frozenset(p), None) for p in labelsets]
+    observed = [i for i, p_oh in enumerate(labelsets_oh) if p_oh is not None]
+    dist_matrix = labels_rules.pairwise_dist([labelsets[i] for i in observed])
+    weights = np.clip(np.exp(-gamma * dist_matrix), minimum_clip, maximum_clip)
+
+    labs = [''.join(labelsets_oh[i].astype(str)) for i in observed]
     dist_dict = {}
-    for p1 in labelsets:
-        p1_oh = labels_express.get(frozenset(p1), None)
-        if p1_oh is not None:
-            lab1 = ''.join(p1_oh.astype(str))
-            dist_dict[lab1] = {}
-            for p2 in labelsets:
-                p2_oh = labels_express.get(frozenset(p2), None)
-                if p2_oh is not None:
-                    lab2 = ''.join(p2_oh.astype(str))
-                    dist = apriori_pair_dist(p1, p2, labels_rules)
-                    weight = np.exp(-gamma * dist)
-                    dist_dict[lab1][lab2] = np.clip(
-                        weight, minimum_clip, maximum_clip)
+    for lab1, weight in zip(labs, weights):
+        dist_dict[lab1] = dict(zip(labs, weight))
 
     return dist_dict
 
@@ -1,168 +1,168 @@
 import numpy as np
-import pandas as pd
-from mlxtend.frequent_patterns import apriori, association_rules
-from mlxtend.preprocessing import TransactionEncoder
 
 from data import load_data, preprocess
 
 
-def indication_similarity(args):
+class LabelSimilarity:
+    """Similarity table over the unique one-hot label patterns of a dataset.
+
+    Each unique pattern (a row of `patterns`) is identified by its row
+    position, and `matrix[i, j]` is the similarity between patterns `i` and
+    `j`. Patterns are sorted lexicographically, so ids are stable for a given
+    set of patterns.
+    """
+
+    def __init__(self, patterns, matrix):
+        self.patterns = np.asarray(patterns).astype(np.int8)
+        self.matrix = np.asarray(matrix, dtype=np.float32)
+        self._pattern_ids = {
+            pattern.tobytes(): i for i, pattern in enumerate(self.patterns)}
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def index(self, labels):
+        """Pattern id of every row in `labels`, -1 for unseen patterns."""
+        labels = np.asarray(labels)
+        if labels.dtype.kind in 'US':
+            labels = np.array([list(lab) for lab in labels.reshape(-1)])
+        labels = labels.astype(np.int8).reshape(-1, self.patterns.shape[1])
+        label_type, label_inverse = np.unique(
+            labels, axis=0, return_inverse=True)
+        type_ids = np.array([
+            self._pattern_ids.get(lab.tobytes(), -1) for lab in label_type],
+            dtype=np.int64)
+        return type_ids[label_inverse.reshape(-1)]
+
+    def weights(self, labels_id, target_fair_labels):
+        """n_sample * n_target similarities of `labels_id` to the targets.
+
+        Samples or targets whose pattern is not in the table get weight 0.
+        """
+        labels_id = np.asarray(labels_id)
+        target_ids = self.index(target_fair_labels)
+        seen = labels_id >= 0
+        weights = np.zeros(
+            (len(labels_id), len(target_ids)), dtype=np.float32)
+        for j, target_id in enumerate(target_ids):
+            if target_id >= 0:
+                weights[seen, j] = self.matrix[target_id, labels_id[seen]]
+
+        return weights
+
+    def to_dict(self):
+        """Export to the nested `dict[str][str] -> float` format."""
+        patterns_str = [''.join(lab.astype(str)) for lab in self.patterns]
+        dist_dict = {}
+        for i, lab1 in enumerate(patterns_str):
+            dist_dict[lab1] = {}
+            for j, lab2 in enumerate(patterns_str):
+                dist_dict[lab1][lab2] = self.matrix[i, j]
+
+        return dist_dict
+
+    @classmethod
+    def from_dict(cls, dist_dict):
+        patterns_str = sorted(set(dist_dict.keys()).union(
+            *[row.keys() for row in dist_dict.values()]))
+        patterns_idx = {lab: i for i, lab in enumerate(patterns_str)}
+        matrix = np.zeros(
+            (len(patterns_str), len(patterns_str)), dtype=np.float32)
+        for lab1, row in dist_dict.items():
+            for lab2, sim in row.items():
+                matrix[patterns_idx[lab1], patterns_idx[lab2]] = sim
+        patterns = np.array([list(lab) for lab in patterns_str]).astype(int)
+
+        return cls(patterns, matrix)
+
+
+def as_label_similarity(label_distances):
+    if isinstance(label_distances, LabelSimilarity):
+        return label_distances
+    return LabelSimilarity.from_dict(label_distances)
+
+
+def label_patterns(args):
     np.random.seed(args.seed)
     _, _, labels, _, _, _ = load_data(
         args.dataset, args.mode, True, None)
     labels_oh = preprocess(labels, 'onehot').astype(int)
-    labels_oh_str = labels_oh.astype(str)
-    label_oh_sets = np.unique(labels_oh_str, axis=0)
-
-    dist_dict = {}
-    for lab1 in label_oh_sets:
-        lab1 = ''.join(lab1)
-        dist_dict[lab1] = {}
-        for lab2 in label_oh_sets:
-            lab2 = ''.join(lab2)
-            dist_dict[lab1][lab2] = 1.0 if lab1 == lab2 else 0.
+    return np.unique(labels_oh, axis=0)
 
-    return dist_dict
 
-
-def constant_similarity(args):
-    np.random.seed(args.seed)
-    _, _, labels, _, _, _ = load_data(
-        args.dataset, args.mode, True, None)
-    labels_oh = preprocess(labels, 'onehot').astype(int)
-    labels_oh_str = labels_oh.astype(str)
-    label_oh_sets = np.unique(labels_oh_str, axis=0)
-
-    dist_dict = {}
-    for lab1 in label_oh_sets:
-        lab1 = ''.join(lab1)
-        dist_dict[lab1] = {}
-        for lab2 in label_oh_sets:
-            lab2 = ''.join(lab2)
-            dist_dict[lab1][lab2] = 1.0
-
-    return dist_dict
+def indication_similarity(args):
+    return indication_similarity_table(args).to_dict()
 
 
-def jaccard_similarity(args):
-    if args.dist_gamma is None:
-        return _jaccard_similarity(args)
-    else:
-        return _jaccard_nonlinear_similarity(args)
+def indication_similarity_table(args):
+    patterns = label_patterns(args)
+    return LabelSimilarity(patterns, np.eye(len(patterns)))
 
 
-def str_jac_similarity(str1, str2):
-    if len(str1) != len(str2):
-        raise ValueError('Incompatible string pairs: have different lengths.')
-    same = 0
-    total = 0
+def constant_similarity(args):
+    return constant_similarity_table(args).to_dict()
 
-    if str1 == str2:
-        return 1.
 
-    for idx, char in enumerate(str1):
-        if char == '1':
-            same += (char == str2[idx])
-        if char == '1' or str2[idx] == '1':
-            total += 1
+def constant_similarity_table(args):
+    patterns = label_patterns(args)
+    return LabelSimilarity(patterns, np.ones((len(patterns), len(patterns))))
 
-    return same / total
 
+def jaccard_similarity(args):
+    return jaccard_similarity_table(args).to_dict()
 
-def _jaccard_similarity(args):
-    np.random.seed(args.seed)
-    _, _, labels, _, _, _ = load_data(
-        args.dataset, args.mode, True, None)
-    labels_oh = preprocess(labels, 'onehot').astype(int)
-    labels_oh_str = labels_oh.astype(str)
-    label_oh_sets = np.unique(labels_oh_str, axis=0)
 
-    dist_dict = {}
-    for lab1 in label_oh_sets:
-        lab1 = ''.join(lab1)
-        dist_dict[lab1] = {}
-        for lab2 in label_oh_sets:
-            lab2 = ''.join(lab2)
-            dist_dict[lab1][lab2] = str_jac_similarity(lab1, lab2)
+def jaccard_similarity_table(args):
+    return jaccard_similarity_tables(args, [args.dist_gamma])[args.dist_gamma]
 
-    return dist_dict
 
+def jaccard_similarity_tables(args, dist_gammas):
+    """Jaccard tables for several `dist_gamma` values from one pairwise pass."""
+    patterns = label_patterns(args)
+    sim = pairwise_jaccard_similarity(patterns)
+    return {dist_gamma: LabelSimilarity(patterns, nonlinear_similarity(sim, dist_gamma))
+            for dist_gamma in dist_gammas}
 
-def _jaccard_nonlinear_similarity(args, minimum_clip=0., maximum_clip=1.):
-    np.random.seed(args.seed)
-    _, _, labels, _, _, _ = load_data(
-        args.dataset, args.mode, True, None)
-    labels_oh = preprocess(labels, 'onehot').astype(int)
-    labels_oh_str = labels_oh.astype(str)
-    label_oh_sets = np.unique(labels_oh_str, axis=0)
 
-    dist_dict = {}
-    for lab1 in label_oh_sets:
-        lab1 = ''.join(lab1)
-        dist_dict[lab1] = {}
-        for lab2 in label_oh_sets:
-            lab2 = ''.join(lab2)
-            sim = str_jac_similarity(lab1, lab2)
-            weight = np.exp(args.dist_gamma * (sim - 1))
-            dist_dict[lab1][lab2] = np.clip(
-                weight, minimum_clip, maximum_clip)
+def pairwise_jaccard_similarity(patterns):
+    patterns = np.asarray(patterns, dtype=np.float64)
+    intersection = np.matmul(patterns, patterns.T)
+    size = patterns.sum(1)
+    union = size[:, np.newaxis] + size[np.newaxis] - intersection
 
-    return dist_dict
+    # two empty label sets are identical
+    return np.where(
+        union > 0, intersection / np.where(union > 0, union, 1.), 1.)
 
 
 def hamming_similarity(args):
-    if args.dist_gamma is None:
-        return _hamming_similarity(args)
-    else:
-        return _hamming_nonlinear_similarity(args)
+    return hamming_similarity_table(args).to_dict()
 
 
-def str_ham_similarity(str1, str2):
-    if len(str1) != len(str2):
-        raise ValueError('Incompatible string pairs: have different lengths.')
-    same = 0
-    for idx, char in enumerate(str1):
-        same += (char == str2[idx])
+def hamming_similarity_table(args):
+    return hamming_similarity_tables(args, [args.dist_gamma])[args.dist_gamma]
 
-    return same / len(str1)
 
+def hamming_similarity_tables(args, dist_gammas):
+    """Hamming tables for several `dist_gamma` values from one pairwise pass."""
+    patterns = label_patterns(args)
+    sim = pairwise_hamming_similarity(patterns)
+    return {dist_gamma: LabelSimilarity(patterns, nonlinear_similarity(sim, dist_gamma))
+            for dist_gamma in dist_gammas}
 
-def _hamming_similarity(args):
-    np.random.seed(args.seed)
-    _, _, labels, _, _, _ = load_data(
-        args.dataset, args.mode, True, None)
-    labels_oh = preprocess(labels, 'onehot').astype(int)
-    labels_oh_str = labels_oh.astype(str)
-    label_oh_sets = np.unique(labels_oh_str, axis=0)
 
-    dist_dict = {}
-    for lab1 in label_oh_sets:
-        lab1 = ''.join(lab1)
-        dist_dict[lab1] = {}
-        for lab2 in label_oh_sets:
-            lab2 = ''.join(lab2)
-            dist_dict[lab1][lab2] = str_ham_similarity()(lab1, lab2)
+def pairwise_hamming_similarity(patterns):
+    patterns = np.asarray(patterns, dtype=np.float64)
+    intersection = np.matmul(patterns, patterns.T)
+    size = patterns.sum(1)
+    mismatch = size[:, np.newaxis] + size[np.newaxis] - 2 * intersection
 
-    return dist_dict
+    return 1. - mismatch / patterns.shape[1]
 
 
-def _hamming_nonlinear_similarity(args, minimum_clip=0., maximum_clip=1.):
-    np.random.seed(args.seed)
-    _, _, labels, _, _, _ = load_data(
-        args.dataset, args.mode, True, None)
-    labels_oh = preprocess(labels, 'onehot').astype(int)
-    labels_oh_str = labels_oh.astype(str)
-    label_oh_sets = np.unique(labels_oh_str, axis=0)
-
-    dist_dict = {}
-    for lab1 in label_oh_sets:
-        lab1 = ''.join(lab1)
-        dist_dict[lab1] = {}
-        for lab2 in label_oh_sets:
-            lab2 = ''.join(lab2)
-            sim = str_ham_similarity(lab1, lab2)
-            weight = np.exp(args.dist_gamma * (sim - 1))
-            dist_dict[lab1][lab2] = np.clip(
-                weight, minimum_clip, maximum_clip)
-
-    return dist_dict
+def nonlinear_similarity(sim, dist_gamma, minimum_clip=0., maximum_clip=1.):
+    # `dist_gamma=None` keeps the raw similarity
+    if dist_gamma is None:
+        return sim
+    weight = np.exp(dist_gamma * (sim - 1))
+    return np.clip(weight, minimum_clip, maximum_clip)
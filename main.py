@@ -1,6 +1,4 @@
 import argparse
-from train import train
-from test import test
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-dataset', "--dataset", type=str, help='dataset name')
@@ -32,6 +30,10 @@ parser.add_argument('-lrdt', "--lr_decay_times", default=3.0,
                     type=float, help='The number of times learning rate decays')
 parser.add_argument('-ntest', "--n_test_sample", default=10000,
                     type=int, help='The sampling times for the testing')
+parser.add_argument('-nchunk', "--n_sample_chunk", default=0,
+                    type=int, help='The number of testing samples evaluated at once (0: all at once)')
+parser.add_argument('-prob', "--predict_prob", default='analytic', choices=['analytic', 'mc'],
+                    type=str, help='per-label probabilities at prediction: closed-form marginals or Monte-Carlo')
 parser.add_argument('-ntrain', "--n_train_sample", default=100,
                     type=int, help='The sampling times for the training')
 parser.add_argument('-z', "--z_dim", default=10, type=int,
@@ -55,6 +57,12 @@ parser.add_argument('-check_freq', "--check_freq",
 
 parser.add_argument('-fair_coeff', "--fair_coeff", default=10.,
                     type=float, help='nll_loss coefficient')
+parser.add_argument('-continuation_coeffs', "--continuation_coeffs", type=float, nargs='+', default=None,
+                    help='train these fair_coeff in ascending order, each warm-started from the previous one')
+parser.add_argument('-continuation_epoch', "--continuation_epoch", type=int, default=None,
+                    help='fine-tuning epochs of a warm-started fair_coeff, a quarter of -epoch by default')
+parser.add_argument('-continuation_init', "--continuation_init", type=str, default=None,
+                    help='checkpoint to warm-start the smallest fair_coeff from, e.g. the unfair model')
 parser.add_argument('-nll_coeff', "--nll_coeff", default=0.1,
                     type=float, help='nll_loss coefficient')
 parser.add_argument('-l2_coeff', "--l2_coeff", default=1.0,
@@ -92,9 +100,13 @@ METRICS = ['ACC', 'HA', 'ebF1', 'miF1', 'maF1', 'meanAUC', 'medianAUC', 'meanAUP
 if __name__ == "__main__":
     args = parser.parse_args()
 
+    # the trainers pull in torch and tensorboard; scripts that only need
+    # `parser` should not pay for them
     if args.mode == 'train':
+        from train import train
         train(args)
     elif args.mode == 'test':
+        from test import test
         test(args)
     else:
         raise ValueError("mode %s is not supported." % args.mode)
@@ -48,6 +48,11 @@ class VAE(nn.Module):
                 args.label_dim+args.z_dim)), np.sqrt(6.0/(args.label_dim+args.z_dim)), (args.label_dim, args.z_dim))))
         self.register_parameter("r_sqrt_sigma", r_sqrt_sigma)
 
+        # settings of `predict`
+        self.predict_prob = getattr(args, 'predict_prob', 'analytic')
+        self.n_test_sample = args.n_test_sample
+        self.n_sample_chunk = getattr(args, 'n_sample_chunk', 0)
+
     def label_encode(self, x):
         h1 = self.dropout(F.relu(self.fe1(x)))
         h2 = self.dropout(F.relu(self.fe2(h1)))
@@ -94,6 +99,25 @@ class VAE(nn.Module):
         z = self.feat_reparameterize(mu, logvar)
         return self.feat_decode(torch.cat((x, z), 1)), mu, logvar
 
+    def predict(self, feature, n_sample=None, return_latent=False):
+        """Per-label probabilities from the feature branch alone.
+
+        Runs `feat_encode` -> `feat_decode` only, so no labels are needed.
+        With `predict_prob == 'analytic'` the probit marginals are computed in
+        closed form, otherwise they are the Monte-Carlo `indiv_prob` of
+        `compute_loss` over `n_sample` draws. With `return_latent`, `feat_mu`
+        and `feat_out` are returned as well.
+        """
+        feat_out, feat_mu, _ = self.feat_forward(feature)
+        if self.predict_prob == 'analytic':
+            indiv_prob = analytic_probability(feat_out, self.r_sqrt_sigma)
+        else:
+            indiv_prob = probit_probability(
+                feat_out, self.r_sqrt_sigma, n_sample or self.n_test_sample, self.n_sample_chunk)
+        if return_latent:
+            return indiv_prob, feat_mu, feat_out
+        return indiv_prob
+
     def forward(self, label, feature):
         label_out, label_mu, label_logvar = self.label_forward(label, feature)
         feat_out, feat_mu, feat_logvar = self.feat_forward(feature)
@@ -101,40 +125,34 @@ class VAE(nn.Module):
 
 
 def build_multi_classification_loss(predictions, labels):
+    loss = build_multi_classification_loss_per_sample(predictions, labels)
+    loss = torch.mean(loss)
+    return loss
+
+
+def build_multi_classification_loss_per_sample(predictions, labels):
     device = labels.device
     shape = tuple(labels.shape)
     labels = labels.float()
-    y_i = torch.eq(labels, torch.ones(shape).to(device))
-    y_not_i = torch.eq(labels, torch.zeros(shape).to(device))
-
-    truth_matrix = pairwise_and(y_i, y_not_i).float()
-    sub_matrix = pairwise_sub(predictions, predictions)
-    exp_matrix = torch.exp(-5*sub_matrix)
-    sparse_matrix = exp_matrix * truth_matrix
-    sums = torch.sum(sparse_matrix, dim=[2, 3])
-    y_i_sizes = torch.sum(y_i.float(), dim=1)
-    y_i_bar_sizes = torch.sum(y_not_i.float(), dim=1)
+    y_i = torch.eq(labels, torch.ones(shape).to(device)).float()
+    y_not_i = torch.eq(labels, torch.zeros(shape).to(device)).float()
+
+    # sum_{i in pos, j in neg} exp(-5 * (p_i - p_j))
+    #   = (sum_{i in pos} exp(-5 * p_i)) * (sum_{j in neg} exp(5 * p_j)),
+    # which avoids the n_sample*n_batch*label_dim*label_dim pairwise tensors
+    pos_sums = torch.sum(torch.exp(-5*predictions) * y_i, dim=2)
+    neg_sums = torch.sum(torch.exp(5*predictions) * y_not_i, dim=2)
+    sums = pos_sums * neg_sums
+    y_i_sizes = torch.sum(y_i, dim=1)
+    y_i_bar_sizes = torch.sum(y_not_i, dim=1)
     normalizers = y_i_sizes * y_i_bar_sizes
     loss = torch.div(sums, 5*normalizers)  # 100*128  divide  128
     zero = torch.zeros_like(loss)  # 100*128 zeros
     loss = torch.where(torch.logical_or(
         torch.isinf(loss), torch.isnan(loss)), zero, loss)
-    loss = torch.mean(loss)
     return loss
 
 
-def pairwise_and(a, b):
-    column = torch.unsqueeze(a, 2)
-    row = torch.unsqueeze(b, 1)
-    return torch.logical_and(column, row)
-
-
-def pairwise_sub(a, b):
-    column = torch.unsqueeze(a, 3)
-    row = torch.unsqueeze(b, 2)
-    return column - row
-
-
 def cross_entropy_loss(logits, labels, n_sample):
     labels = torch.tile(torch.unsqueeze(labels, 0), [n_sample, 1, 1])
     ce_loss = nn.BCEWithLogitsLoss(labels=labels, logits=logits)
@@ -158,31 +176,39 @@ def compute_loss(input_label, fe_out, fe_mu, fe_logvar, fx_out, fx_mu, fx_logvar
     n_sample = args.n_train_sample if args.mode == "train" else args.n_test_sample
     n_batch = fe_out.shape[0]
 
-    # standard Gaussian samples
-    noise = torch.normal(0, 1, size=(n_sample, n_batch, args.z_dim)).to(device)
+    # evaluation with many samples streams them in chunks of `n_sample_chunk`
+    n_chunk = getattr(args, 'n_sample_chunk', 0)
+    streamed = args.mode != "train" and 0 < n_chunk < n_sample
+
+    # standard Gaussian samples, drawn at once so that the random stream
+    # (and hence the result under a fixed seed) does not depend on chunking
+    noise = torch.normal(0, 1, size=(n_sample, n_batch, args.z_dim))
+    if not streamed:
+        noise = noise.to(device)
 
     # see equation (3) in the paper for this block
     B = r_sqrt_sigma.T.float().to(device)
 
-    # tensor: n_sample*n_batch*label_dim
-    sample_r = torch.tensordot(noise, B, dims=1) + fe_out
-    # tensor: n_sample*n_batch*label_dim
-    sample_r_x = torch.tensordot(noise, B, dims=1) + fx_out
     norm = torch.distributions.normal.Normal(
         torch.tensor([0.0]).to(device), torch.tensor([1.0]).to(device))
 
-    # the probabilities w.r.t. every label in each sample from the batch
-    # size: n_sample * n_batch * label_dim
-    # eps1: to ensure the probability is non-zero
-    E = norm.cdf(sample_r) * (1-eps1) + eps1 * 0.5
+    if not streamed:
+        # tensor: n_sample*n_batch*label_dim
+        sample_r = torch.tensordot(noise, B, dims=1) + fe_out
+        # tensor: n_sample*n_batch*label_dim
+        sample_r_x = torch.tensordot(noise, B, dims=1) + fx_out
+
+        # the probabilities w.r.t. every label in each sample from the batch
+        # size: n_sample * n_batch * label_dim
+        # eps1: to ensure the probability is non-zero
+        E = norm.cdf(sample_r) * (1-eps1) + eps1 * 0.5
 
-    # similar for the feature branch
-    E_x = norm.cdf(sample_r_x) * (1-eps1) + eps1 * 0.5
+        # similar for the feature branch
+        E_x = norm.cdf(sample_r_x) * (1-eps1) + eps1 * 0.5
 
     def compute_BCE_and_RL_loss(E):
         # compute negative log likelihood (BCE loss) for each sample point
-        sample_nll = -(torch.log(E)*input_label+torch.log(1-E)*(1-input_label))
-        logprob = -torch.sum(sample_nll, dim=2)
+        logprob = sample_log_likelihood(E, input_label)
 
         # the following computation is designed to avoid the float overflow (log_sum_exp trick)
         maxlogprob = torch.max(logprob, dim=0)[0]
@@ -193,18 +219,114 @@ def compute_loss(input_label, fe_out, fe_mu, fe_logvar, fx_out, fx_mu, fx_logvar
         c_loss = build_multi_classification_loss(E, input_label)
         return nll_loss, c_loss
 
-    # BCE and RL losses for label branch
-    nll_loss, c_loss = compute_BCE_and_RL_loss(E)
+    if streamed:
+        # BCE and RL losses for label and feature branches, chunk by chunk
+        nll_loss, c_loss, indiv_prob_label = compute_BCE_and_RL_loss_chunked(
+            noise, B, fe_out, input_label, eps1, norm, n_chunk)
+        nll_loss_x, c_loss_x, indiv_prob = compute_BCE_and_RL_loss_chunked(
+            noise, B, fx_out, input_label, eps1, norm, n_chunk)
+    else:
+        # BCE and RL losses for label branch
+        nll_loss, c_loss = compute_BCE_and_RL_loss(E)
 
-    # BCE and RL losses for feature branch
-    nll_loss_x, c_loss_x = compute_BCE_and_RL_loss(E_x)
+        # BCE and RL losses for feature branch
+        nll_loss_x, c_loss_x = compute_BCE_and_RL_loss(E_x)
 
-    # if in the training phase, the prediction
-    indiv_prob = torch.mean(E_x, axis=0)
-    indiv_prob_label = torch.mean(E, axis=0)
+        # if in the training phase, the prediction
+        indiv_prob = torch.mean(E_x, axis=0)
+        indiv_prob_label = torch.mean(E, axis=0)
 
     # total loss: refer to equation (5)
     total_loss = (nll_loss + nll_loss_x) * args.nll_coeff + \
         (c_loss + c_loss_x) * args.c_coeff + kl_loss * 1.1
 
     return total_loss, nll_loss, nll_loss_x, c_loss, c_loss_x, kl_loss, indiv_prob, indiv_prob_label
+
+
+def sample_log_likelihood(E, input_label):
+    # negative log likelihood (BCE loss) for each sample point
+    sample_nll = -(torch.log(E)*input_label+torch.log(1-E)*(1-input_label))
+    return -torch.sum(sample_nll, dim=2)
+
+
+def compute_BCE_and_RL_loss_chunked(noise, B, out, input_label, eps1, norm, n_chunk):
+    """Stream the Monte-Carlo samples of `compute_loss` in chunks of `n_chunk`.
+
+    Keeps a running log-sum-exp for the NLL and running sums for the ranking
+    loss and the marginal probabilities, so peak memory scales with `n_chunk`
+    rather than with the number of samples in `noise`.
+    """
+    device = out.device
+    n_sample, n_batch = noise.shape[0], noise.shape[1]
+
+    maxlogprob = None
+    sum_exp = None
+    sum_c_loss = 0.
+    sum_prob = torch.zeros_like(out)
+    for start in range(0, n_sample, n_chunk):
+        noise_chunk = noise[start:start + n_chunk].to(device)
+        sample_r = torch.tensordot(noise_chunk, B, dims=1) + out
+        E = norm.cdf(sample_r) * (1-eps1) + eps1 * 0.5
+
+        logprob = sample_log_likelihood(E, input_label)
+        chunk_max = torch.max(logprob, dim=0)[0]
+        if maxlogprob is None:
+            maxlogprob = chunk_max
+            sum_exp = torch.sum(torch.exp(logprob-maxlogprob), dim=0)
+        else:
+            new_max = torch.maximum(maxlogprob, chunk_max)
+            sum_exp = sum_exp * torch.exp(maxlogprob-new_max) + \
+                torch.sum(torch.exp(logprob-new_max), dim=0)
+            maxlogprob = new_max
+
+        sum_c_loss += torch.sum(
+            build_multi_classification_loss_per_sample(E, input_label))
+        sum_prob += torch.sum(E, dim=0)
+
+    Eprob = sum_exp / n_sample
+    nll_loss = torch.mean(-torch.log(Eprob)-maxlogprob)
+    c_loss = sum_c_loss / (n_sample * n_batch)
+    indiv_prob = sum_prob / n_sample
+    return nll_loss, c_loss, indiv_prob
+
+
+def probit_probability(out, r_sqrt_sigma, n_sample, n_chunk=0):
+    """Per-label probabilities of `out`, as `indiv_prob` in `compute_loss`.
+
+    Only the Monte-Carlo mean of the probit samples is computed, without the
+    NLL or ranking losses; samples are streamed in chunks of `n_chunk`.
+    """
+    device = out.device
+    if not 0 < n_chunk < n_sample:
+        n_chunk = n_sample
+
+    eps1 = torch.tensor([1e-6]).float().to(device)
+    B = r_sqrt_sigma.T.float().to(device)
+    norm = torch.distributions.normal.Normal(
+        torch.tensor([0.0]).to(device), torch.tensor([1.0]).to(device))
+
+    noise = torch.normal(0, 1, size=(n_sample, out.shape[0], B.shape[0]))
+    sum_prob = torch.zeros_like(out)
+    for start in range(0, n_sample, n_chunk):
+        noise_chunk = noise[start:start + n_chunk].to(device)
+        sample_r = torch.tensordot(noise_chunk, B, dims=1) + out
+        E = norm.cdf(sample_r) * (1-eps1) + eps1 * 0.5
+        sum_prob += torch.sum(E, dim=0)
+
+    return sum_prob / n_sample
+
+
+def analytic_probability(out, r_sqrt_sigma):
+    """Closed-form limit of `probit_probability` as `n_sample` grows.
+
+    With noise ~ N(0, I), the i-th marginal of Phi(noise @ B + out) has mean
+    Phi(out_i / sqrt(1 + ||B_i||^2)), B_i being the i-th row of `r_sqrt_sigma`.
+    """
+    device = out.device
+    eps1 = torch.tensor([1e-6]).float().to(device)
+    norm = torch.distributions.normal.Normal(
+        torch.tensor([0.0]).to(device), torch.tensor([1.0]).to(device))
+
+    scale = torch.sqrt(
+        1 + torch.sum(torch.square(r_sqrt_sigma.float().to(device)), dim=1))
+    return norm.cdf(out / scale) * (1-eps1) + eps1 * 0.5
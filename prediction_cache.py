@@ -0,0 +1,122 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+
+from utils import atomic_write, file_lock
+from fairsoft_utils import sensitive_group_index
+from fairsoft_inference import MODEL_OUTPUTS, run_inference, subset_indices
+
+PREDICTION_CACHE_DIR = 'fair_through_distance/prediction_cache'
+
+# arrays kept per (checkpoint, split): the model outputs and the group ids
+CACHED_OUTPUTS = MODEL_OUTPUTS + ('group',)
+
+# (path, mtime, size) -> content hash of checkpoints already read
+_HASHES = {}
+
+
+def checkpoint_hash(path):
+    stat = os.stat(path)
+    stamp = (os.path.realpath(path), stat.st_mtime_ns, stat.st_size)
+    if stamp not in _HASHES:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        _HASHES[stamp] = digest.hexdigest()
+    return _HASHES[stamp]
+
+
+def prediction_key(checkpoint_path, data, args, subset):
+    # the split indices depend on the seed of `load_data`, so they are hashed too
+    subset_idx = np.ascontiguousarray(subset_indices(data, subset), dtype=np.int64)
+    params = {'checkpoint': checkpoint_hash(checkpoint_path),
+              'dataset': args.dataset,
+              'subset': subset,
+              'split': hashlib.sha256(subset_idx.tobytes()).hexdigest(),
+              'predict_prob': getattr(args, 'predict_prob', 'analytic')}
+    # only Monte-Carlo `y_probs` depend on the number of draws; `latent_sample`
+    # is the feature decoder output and does not
+    if params['predict_prob'] == 'mc':
+        params['n_sample'] = args.n_train_sample if args.mode == "train" else args.n_test_sample
+    content = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()[:20], params
+
+
+def _prediction_paths(key, cache_dir):
+    prefix = os.path.join(cache_dir, key)
+    return {name: f'{prefix}-{name}.npy' for name in CACHED_OUTPUTS}, prefix + '.json'
+
+
+def load_predictions(key, cache_dir=PREDICTION_CACHE_DIR):
+    array_paths, manifest_path = _prediction_paths(key, cache_dir)
+    # the manifest is written last and marks a complete entry
+    if not os.path.exists(manifest_path):
+        return None
+    return {name: np.load(path, mmap_mode='r') for name, path in array_paths.items()}
+
+
+def save_predictions(key, predictions, params, cache_dir=PREDICTION_CACHE_DIR):
+    os.makedirs(cache_dir, exist_ok=True)
+    array_paths, manifest_path = _prediction_paths(key, cache_dir)
+
+    for name, path in array_paths.items():
+        atomic_write(path, lambda f: np.save(f, np.ascontiguousarray(predictions[name])))
+
+    manifest = {'params': params,
+                'n_rows': int(predictions['y_probs'].shape[0])}
+    atomic_write(manifest_path, lambda f: f.write(
+        json.dumps(manifest, sort_keys=True, default=str).encode('utf-8')))
+
+
+def checkpoint_loader(checkpoint_path, args):
+    """Callable that builds the `VAE` stored at `checkpoint_path` on its first
+    call only, so checkpoints whose predictions are cached are never loaded."""
+    model = []
+
+    def load_model():
+        if not model:
+            import torch
+            from mpvae import VAE
+
+            vae = VAE(args).to(args.device)
+            vae.load_state_dict(torch.load(checkpoint_path))
+            model.append(vae)
+        return model[0]
+    return load_model
+
+
+def cached_inference(checkpoint_path, load_model, data, args, subset='train',
+                     outputs=('y_probs', 'y_reals'), cache_dir=PREDICTION_CACHE_DIR, **kwargs):
+    """`run_inference` backed by a persistent store of model outputs.
+
+    The model outputs and group ids of a split are kept as memory-mapped
+    arrays keyed by the checkpoint's content hash, the dataset, the split and
+    the `predict_prob` estimator (with its number of draws when Monte-Carlo).
+    `load_model` is called without arguments, and only on a miss; the other
+    `outputs` are derived from `data` as in `run_inference`, to which
+    `kwargs` are passed.
+    """
+    if not any(name in CACHED_OUTPUTS for name in outputs):
+        return run_inference(None, data, args, subset, outputs, **kwargs)
+
+    key, params = prediction_key(checkpoint_path, data, args, subset)
+    predictions = load_predictions(key, cache_dir)
+    if predictions is None:
+        os.makedirs(cache_dir, exist_ok=True)
+        with file_lock(os.path.join(cache_dir, f'{key}.lock')):
+            predictions = load_predictions(key, cache_dir)
+            if predictions is None:
+                predictions = run_inference(load_model(), data, args, subset, MODEL_OUTPUTS)
+                group, _ = sensitive_group_index(data.sensitive_feat)
+                predictions['group'] = group[subset_indices(data, subset)]
+                save_predictions(key, predictions, params, cache_dir)
+                predictions = load_predictions(key, cache_dir)
+
+    results = run_inference(
+        None, data, args, subset,
+        [name for name in outputs if name not in CACHED_OUTPUTS], **kwargs)
+    results.update({name: predictions[name] for name in outputs if name in CACHED_OUTPUTS})
+    return results
@@ -0,0 +1,87 @@
+import os
+import json
+import hashlib
+import pickle
+
+import numpy as np
+
+from utils import atomic_write, file_lock
+from label_distance_obs import LabelSimilarity
+
+SIMILARITY_CACHE_DIR = 'fair_through_distance/similarity_cache'
+
+# (cache_dir, key) -> tables already opened by this process
+_LOADED = {}
+
+
+def similarity_key(**params):
+    # params: dataset, encoding, metric, gamma and metric-specific settings
+    content = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()[:20]
+
+
+def _table_paths(key, cache_dir):
+    prefix = os.path.join(cache_dir, key)
+    return prefix + '-patterns.npy', prefix + '-matrix.npy', prefix + '.json'
+
+
+def load_similarity_table(key, cache_dir=SIMILARITY_CACHE_DIR):
+    patterns_path, matrix_path, manifest_path = _table_paths(key, cache_dir)
+    # the manifest is written last and marks a complete entry
+    if not os.path.exists(manifest_path):
+        return None
+
+    patterns = np.load(patterns_path, mmap_mode='r')
+    matrix = np.load(matrix_path, mmap_mode='r')
+    return LabelSimilarity(patterns, matrix)
+
+
+def save_similarity_table(key, table, params, cache_dir=SIMILARITY_CACHE_DIR):
+    os.makedirs(cache_dir, exist_ok=True)
+    patterns_path, matrix_path, manifest_path = _table_paths(key, cache_dir)
+
+    atomic_write(patterns_path, lambda f: np.save(
+        f, np.ascontiguousarray(table.patterns, dtype=np.int8)))
+    atomic_write(matrix_path, lambda f: np.save(
+        f, np.ascontiguousarray(table.matrix, dtype=np.float32)))
+
+    manifest = {'params': params,
+                'n_pattern': int(table.patterns.shape[0]),
+                'label_dim': int(table.patterns.shape[1])}
+    atomic_write(manifest_path, lambda f: f.write(
+        json.dumps(manifest, sort_keys=True, default=str).encode('utf-8')))
+
+
+def cached_similarity_table(build, cache_dir=SIMILARITY_CACHE_DIR, **params):
+    """Load the similarity table described by `params`, building it on a miss.
+
+    `build` is called without arguments and must return a `LabelSimilarity`.
+    Concurrent processes asking for the same table wait on a file lock, so
+    the table is built once and the others read the memory-mapped result.
+    Opened tables are also kept per process, and forked workers inherit them.
+    """
+    key = similarity_key(**params)
+    if (cache_dir, key) in _LOADED:
+        return _LOADED[cache_dir, key]
+    table = load_similarity_table(key, cache_dir)
+    if table is not None:
+        _LOADED[cache_dir, key] = table
+        return table
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with file_lock(os.path.join(cache_dir, f'{key}.lock')):
+        table = load_similarity_table(key, cache_dir)
+        if table is None:
+            print(f'build similarity table: {params}...')
+            save_similarity_table(key, build(), params, cache_dir)
+            table = load_similarity_table(key, cache_dir)
+
+    _LOADED[cache_dir, key] = table
+    return table
+
+
+def export_similarity_table(table, path):
+    # per-run copy that evaluators discover under `model_dir`, in the nested
+    # dict format earlier runs wrote; rewritten so it never goes stale
+    dist_dict = table.to_dict()
+    atomic_write(path, lambda f: pickle.dump(dist_dict, f))
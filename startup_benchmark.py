@@ -0,0 +1,59 @@
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+my_dir = os.path.dirname(os.path.abspath(__file__))
+
+# must not be imported before a trial actually trains or evaluates
+HEAVY_MODULES = ['torch', 'sklearn', 'pandas', 'mlxtend', 'kmodes', 'joblib',
+                 'scipy', 'tensorboard']
+
+
+def cold_start(command):
+    """Wall time of `command` under `python -X importtime`, and the
+    per-module import times (cumulative, seconds) it reported."""
+    start = time.time()
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime'] + command, cwd=my_dir,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+    elapsed = time.time() - start
+
+    imports = {}
+    for line in result.stderr.decode('utf-8').splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, module = line.split('|')
+        if cumulative.strip().isdigit():
+            imports[module.strip()] = int(cumulative) / 1e6
+    return elapsed, imports
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-budget', type=float, default=1.,
+                        help='seconds allowed for a cold `fairsoft_trial.py -h`')
+    parser.add_argument('-repeat', type=int, default=5)
+    parser.add_argument('-top', type=int, default=10)
+    args = parser.parse_args()
+
+    runs = [cold_start(['fairsoft_trial.py', '-h']) for _ in range(args.repeat)]
+    elapsed = statistics.median([run[0] for run in runs])
+    imports = runs[-1][1]
+
+    print(f'fairsoft_trial.py -h: median {elapsed:.3f}s over {args.repeat} runs '
+          f'(budget {args.budget:.3f}s)')
+    for module, seconds in sorted(imports.items(), key=lambda item: -item[1])[:args.top]:
+        print(f'  {seconds:.3f}s {module}')
+
+    failures = []
+    heavy = sorted({module.split('.')[0] for module in imports} & set(HEAVY_MODULES))
+    if heavy:
+        failures.append(f'heavy modules imported at startup: {", ".join(heavy)}')
+    if elapsed > args.budget:
+        failures.append(f'startup {elapsed:.3f}s is over the {args.budget:.3f}s budget')
+    if failures:
+        print('\n'.join(failures))
+        sys.exit(1)
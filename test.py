@@ -86,19 +86,8 @@ def test(args):
     indiv_prob, input_label = test_step(test_idx)
     n_label = indiv_prob.shape[1]
 
-    best_test_metrics = None
-    for threshold in THRESHOLDS:
-        test_metrics = evals.compute_metrics(indiv_prob, input_label, threshold, all_metrics=True)
-        if best_test_metrics == None:
-            best_test_metrics = {}
-            for metric in METRICS:
-                best_test_metrics[metric] = test_metrics[metric]
-        else:
-            for metric in METRICS:
-                if 'FDR' in metric:
-                    best_test_metrics[metric] = min(best_test_metrics[metric], test_metrics[metric])
-                else:
-                    best_test_metrics[metric] = max(best_test_metrics[metric], test_metrics[metric])
+    best_test_metrics = evals.best_threshold_metrics(
+        indiv_prob, input_label, THRESHOLDS, METRICS)
     if 'ebird' in args.dataset:
         ecology = ulti.compute_all(indiv_prob, input_label)
         best_test_metrics = {**best_test_metrics, **ecology}
@@ -1,7 +1,6 @@
 import torch
 import torch.nn as nn
 from torch import optim
-from torch.utils.tensorboard import SummaryWriter
 
 from tqdm import tqdm
 
@@ -9,12 +8,14 @@ import numpy as np
 
 import sys
 import os
+import types
 import datetime
-from copy import deepcopy
 
 import evals
 from utils import build_path, get_label, get_feat
 from mpvae import VAE, compute_loss
+from checkpoint import CheckpointManager
+from fairsoft_utils import device_data
 from data import load_data
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
@@ -29,6 +30,7 @@ def train(args):
     print('prepare npy...')
     np.random.seed(4) # set the random seed of numpy
     feat, labels = load_data(args.dataset, args.mode)
+    data = types.SimpleNamespace(input_feat=feat, labels=labels)
     train_cnt, valid_cnt = int(len(feat) * 0.7), int(len(feat) * .2)
     train_idx = np.arange(train_cnt)
     valid_idx = np.arange(train_cnt, valid_cnt + train_cnt)
@@ -50,6 +52,7 @@ def train(args):
     print("showing the parameters...")
     print(args)
 
+    from torch.utils.tensorboard import SummaryWriter
     writer = SummaryWriter(log_dir=summary_dir)
 
     print('building network...')
@@ -79,13 +82,11 @@ def train(args):
     smooth_c_loss_x=0.0 # feature encoder decoder ranking loss
     smooth_kl_loss = 0.0 # kl divergence
     smooth_total_loss=0.0 # total loss
-    smooth_macro_f1 = 0.0 # macro_f1 score
-    smooth_micro_f1 = 0.0 # micro_f1 score
+    train_metrics = evals.MetricAccumulator(0.5) # macro_f1 / micro_f1 over check_freq steps
     #smooth_l2_loss = 0.0
 
     best_loss = 1e10
     best_iter = 0
-    best_macro_f1 = 0.0 # best macro f1 for ckpt selection in validation
     best_micro_f1 = 0.0 # best micro f1 for ckpt selection in validation
     best_acc = 0.0 # best subset acc for ckpt selction in validation
 
@@ -93,142 +94,138 @@ def train(args):
     temp_indiv_prob=[]
 
     best_test_metrics = None
+    # training the model; leaving the manager waits for the pending writes
+    with CheckpointManager(step_path=model_dir + '/vae-{step}', max_keep=args.max_keep,
+                           mode='max') as checkpoints:
+        for one_epoch in range(args.max_epoch):
+            print('epoch '+str(one_epoch+1)+' starts!')
+            np.random.shuffle(train_idx) # random shuffle the training indices
+            tensors = device_data(data, device)
+            train_idx_t = tensors.index(train_idx)
+
+            for i in range(int(len(train_idx)/float(args.batch_size))+1):
+                optimizer.zero_grad()
+                start = i*args.batch_size
+                end = min(args.batch_size*(i+1), len(train_idx))
+                # input_feat = get_feat(data, train_idx[start:end], args.meta_offset, args.label_dim, args.feature_dim) # get the NLCD features
+                # input_label = get_label(data, train_idx[start:end], args.meta_offset, args.label_dim) # get the prediction labels
+                input_feat, input_label = tensors.batch(train_idx_t[start:end])
+                label_out, label_mu, label_logvar, feat_out, feat_mu, feat_logvar = vae(input_label, input_feat)
+
+                # print('input_feat: ', input_feat.min(0), input_feat.max(0))
+                # print('input_label: ', input_label.min(0), input_label.max(0))
+                # print('label_out: ', label_out.min(0), label_out.max(0))
+                # print('feat_out: ', feat_out.min(0), feat_out.max(0))
+
+                #train the model for one step and log the training loss
+                if args.residue_sigma == "random":
+                    r_sqrt_sigma = torch.from_numpy(np.random.uniform(-np.sqrt(6.0/(args.label_dim+args.z_dim)), np.sqrt(6.0/(args.label_dim+args.z_dim)), (args.label_dim, args.z_dim))).to(device)
+                    total_loss, nll_loss, nll_loss_x, c_loss, c_loss_x, kl_loss, indiv_prob = compute_loss(input_label, label_out, label_mu, label_logvar, feat_out, feat_mu, feat_logvar, r_sqrt_sigma, args)
+                else:
+                    total_loss, nll_loss, nll_loss_x, c_loss, c_loss_x, kl_loss, indiv_prob = compute_loss(input_label, label_out, label_mu, label_logvar, feat_out, feat_mu, feat_logvar, vae.r_sqrt_sigma, args)
+                total_loss.backward()
+                grad_norm = nn.utils.clip_grad_norm_(vae.parameters(), 100)
 
-    # training the model
-    for one_epoch in range(args.max_epoch):
-        print('epoch '+str(one_epoch+1)+' starts!')
-        np.random.shuffle(train_idx) # random shuffle the training indices
+                optimizer.step()
+                scheduler.step()
 
-        for i in range(int(len(train_idx)/float(args.batch_size))+1):
-            optimizer.zero_grad()
-            start = i*args.batch_size
-            end = min(args.batch_size*(i+1), len(train_idx))
-            input_feat = feat[train_idx[start:end]]
-            input_label = labels[train_idx[start:end]]
-            # input_feat = get_feat(data, train_idx[start:end], args.meta_offset, args.label_dim, args.feature_dim) # get the NLCD features
-            # input_label = get_label(data, train_idx[start:end], args.meta_offset, args.label_dim) # get the prediction labels
-            input_feat, input_label = torch.from_numpy(input_feat).to(device), torch.from_numpy(input_label)
-            input_label = deepcopy(input_label).float().to(device)
-            label_out, label_mu, label_logvar, feat_out, feat_mu, feat_logvar = vae(input_label, input_feat)
-
-            # print('input_feat: ', input_feat.min(0), input_feat.max(0))
-            # print('input_label: ', input_label.min(0), input_label.max(0))
-            # print('label_out: ', label_out.min(0), label_out.max(0))
-            # print('feat_out: ', feat_out.min(0), feat_out.max(0))
-
-            #train the model for one step and log the training loss
-            if args.residue_sigma == "random":
-                r_sqrt_sigma = torch.from_numpy(np.random.uniform(-np.sqrt(6.0/(args.label_dim+args.z_dim)), np.sqrt(6.0/(args.label_dim+args.z_dim)), (args.label_dim, args.z_dim))).to(device)
-                total_loss, nll_loss, nll_loss_x, c_loss, c_loss_x, kl_loss, indiv_prob = compute_loss(input_label, label_out, label_mu, label_logvar, feat_out, feat_mu, feat_logvar, r_sqrt_sigma, args)
-            else:
-                total_loss, nll_loss, nll_loss_x, c_loss, c_loss_x, kl_loss, indiv_prob = compute_loss(input_label, label_out, label_mu, label_logvar, feat_out, feat_mu, feat_logvar, vae.r_sqrt_sigma, args)
-            total_loss.backward()
-            grad_norm = nn.utils.clip_grad_norm_(vae.parameters(), 100)
+                train_metrics.update(indiv_prob, input_label)
 
-            optimizer.step()
-            scheduler.step()
-
-            train_metrics = evals.compute_metrics(indiv_prob.cpu().data.numpy(), input_label.cpu().data.numpy(), 0.5, all_metrics=False)
-            macro_f1, micro_f1 = train_metrics['maF1'], train_metrics['miF1']
-
-            smooth_nll_loss += nll_loss
-            smooth_nll_loss_x += nll_loss_x
-            #smooth_l2_loss += l2_loss
-            smooth_c_loss += c_loss
-            smooth_c_loss_x += c_loss_x
-            smooth_kl_loss += kl_loss
-            smooth_total_loss += total_loss
-            smooth_macro_f1 += macro_f1
-            smooth_micro_f1 += micro_f1
+                smooth_nll_loss += nll_loss
+                smooth_nll_loss_x += nll_loss_x
+                #smooth_l2_loss += l2_loss
+                smooth_c_loss += c_loss
+                smooth_c_loss_x += c_loss_x
+                smooth_kl_loss += kl_loss
+                smooth_total_loss += total_loss
             
-            temp_label.append(input_label.cpu().data.numpy()) #log the labels
-            temp_indiv_prob.append(indiv_prob.detach().data.cpu().numpy()) #log the individual prediction of the probability on each label
-
-            current_step += 1
-            lr = optimizer.param_groups[0]['lr']
-            writer.add_scalar('learning_rate', lr, current_step)
-
-            if current_step % args.check_freq==0: #summarize the current training status and print them out
-                nll_loss = smooth_nll_loss / float(args.check_freq)
-                nll_loss_x = smooth_nll_loss_x / float(args.check_freq)
-                #l2_loss = smooth_l2_loss / float(args.check_freq)
-                c_loss = smooth_c_loss / float(args.check_freq)
-                c_loss_x = smooth_c_loss_x / float(args.check_freq)
-                kl_loss = smooth_kl_loss / float(args.check_freq)
-                total_loss = smooth_total_loss / float(args.check_freq)
-                macro_f1 = smooth_macro_f1 / float(args.check_freq)
-                micro_f1 = smooth_micro_f1 / float(args.check_freq)
+                temp_label.append(input_label.cpu().data.numpy()) #log the labels
+                temp_indiv_prob.append(indiv_prob.detach().data.cpu().numpy()) #log the individual prediction of the probability on each label
+
+                current_step += 1
+                lr = optimizer.param_groups[0]['lr']
+                writer.add_scalar('learning_rate', lr, current_step)
+
+                if current_step % args.check_freq==0: #summarize the current training status and print them out
+                    nll_loss = smooth_nll_loss / float(args.check_freq)
+                    nll_loss_x = smooth_nll_loss_x / float(args.check_freq)
+                    #l2_loss = smooth_l2_loss / float(args.check_freq)
+                    c_loss = smooth_c_loss / float(args.check_freq)
+                    c_loss_x = smooth_c_loss_x / float(args.check_freq)
+                    kl_loss = smooth_kl_loss / float(args.check_freq)
+                    total_loss = smooth_total_loss / float(args.check_freq)
+                    check_metrics = train_metrics.compute()
+                    macro_f1, micro_f1 = check_metrics['maF1'], check_metrics['miF1']
                 
-                temp_indiv_prob = np.reshape(np.array(temp_indiv_prob), (-1))
-                temp_label = np.reshape(np.array(temp_label), (-1))
+                    temp_indiv_prob = np.reshape(np.array(temp_indiv_prob), (-1))
+                    temp_label = np.reshape(np.array(temp_label), (-1))
                 
-                #temp_indiv_prob = np.reshape(temp_indiv_prob,(-1, args.label_dim))
-                #temp_label = np.reshape(temp_label,(-1, args.label_dim))
-
-                time_str = datetime.datetime.now().isoformat()
-                print("step=%d  %s\nlr=%.6f\nmacro_f1=%.6f, micro_f1=%.6f\nnll_loss=%.6f\tnll_loss_x=%.6f\nc_loss=%.6f\tc_loss_x=%.6f\tkl_loss=%.6f\ntotal_loss=%.6f\n" % (current_step, time_str, lr, macro_f1, micro_f1, nll_loss*args.nll_coeff, nll_loss_x*args.nll_coeff, c_loss*args.c_coeff, c_loss_x*args.c_coeff, kl_loss, total_loss))
-                #print("step=%d  %s\nlr=%.6f\nmacro_f1=%.6f, micro_f1=%.6f\nnll_loss=%.6f\tnll_loss_x=%.6f\tl2_loss=%.6f\nc_loss=%.6f\tc_loss_x=%.6f\tkl_loss=%.6f\ntotal_loss=%.6f\n" % (current_step, time_str, lr, macro_f1, micro_f1, nll_loss*args.nll_coeff, nll_loss_x*args.nll_coeff, l2_loss*args.l2_coeff, c_loss*args.c_coeff, c_loss_x*args.c_coeff, kl_loss, total_loss))
-                temp_indiv_prob=[]
-                temp_label=[]
-
-                smooth_nll_loss = 0
-                smooth_nll_loss_x = 0
-                #smooth_l2_loss = 0
-                smooth_c_loss = 0
-                smooth_c_loss_x = 0
-                smooth_kl_loss = 0
-                smooth_total_loss = 0
-                smooth_macro_f1 = 0
-                smooth_micro_f1 = 0
-
-            if current_step % int(one_epoch_iter*args.save_epoch)==0: #exam the model on validation set
-                print("--------------------------------")
-                # exam the model on validation set
-                current_loss, val_metrics = valid(feat, labels, vae, writer, valid_idx, current_step, args)
-                macro_f1, micro_f1 = val_metrics['maF1'], val_metrics['miF1']
-
-                # select the best checkpoint based on some metric on the validation set
-                # here we use macro F1 as the selection metric but one can use others
-                if val_metrics['maF1'] > best_macro_f1:
-                    print('macro_f1:%.6f, micro_f1:%.6f, nll_loss:%.6f, which is better than the previous best one!!!'%(macro_f1, micro_f1, current_loss))
-
-                    best_loss = current_loss
-                    best_iter = current_step
-
-                    print('saving model')
-                    torch.save(vae.state_dict(), model_dir+'/vae-'+str(current_step))
-                    print('have saved model to ', model_dir)
-                    print()
-
-                    if args.write_to_test_sh:
-                        test_sh_path = "script/run_test_%s.sh" % args.dataset
-                        if os.path.exists(test_sh_path):
-                            ckptFile = open(test_sh_path, "r")
-                            command = []
-                            for line in ckptFile:
-                                arg_lst = line.strip().split(' ')
-                                for arg in arg_lst:
-                                    if 'model/model_{}/lr-'.format(args.dataset) in arg:
-                                        command.append('model/model_{}/{}/vae-{}'.format(args.dataset, param_setting, best_iter))
-                                    else:
-                                        command.append(arg)
-                            ckptFile.close()
-                        else:
-                            command = ("python main.py --data_dir %s --test_idx %s --label_dim %d --z_dim %d --feature_dim %d --nll_coeff %s --c_coeff %s --batch_size 64 --mode test -cp %s" % (args.data_dir, args.test_idx, args.label_dim, args.z_dim, args.feature_dim, args.nll_coeff, args.c_coeff, 'model/model_{}/{}/vae-{}'.format(args.dataset, param_setting, best_iter))).strip().split(' ')
+                    #temp_indiv_prob = np.reshape(temp_indiv_prob,(-1, args.label_dim))
+                    #temp_label = np.reshape(temp_label,(-1, args.label_dim))
+
+                    time_str = datetime.datetime.now().isoformat()
+                    print("step=%d  %s\nlr=%.6f\nmacro_f1=%.6f, micro_f1=%.6f\nnll_loss=%.6f\tnll_loss_x=%.6f\nc_loss=%.6f\tc_loss_x=%.6f\tkl_loss=%.6f\ntotal_loss=%.6f\n" % (current_step, time_str, lr, macro_f1, micro_f1, nll_loss*args.nll_coeff, nll_loss_x*args.nll_coeff, c_loss*args.c_coeff, c_loss_x*args.c_coeff, kl_loss, total_loss))
+                    #print("step=%d  %s\nlr=%.6f\nmacro_f1=%.6f, micro_f1=%.6f\nnll_loss=%.6f\tnll_loss_x=%.6f\tl2_loss=%.6f\nc_loss=%.6f\tc_loss_x=%.6f\tkl_loss=%.6f\ntotal_loss=%.6f\n" % (current_step, time_str, lr, macro_f1, micro_f1, nll_loss*args.nll_coeff, nll_loss_x*args.nll_coeff, l2_loss*args.l2_coeff, c_loss*args.c_coeff, c_loss_x*args.c_coeff, kl_loss, total_loss))
+                    temp_indiv_prob=[]
+                    temp_label=[]
+
+                    smooth_nll_loss = 0
+                    smooth_nll_loss_x = 0
+                    #smooth_l2_loss = 0
+                    smooth_c_loss = 0
+                    smooth_c_loss_x = 0
+                    smooth_kl_loss = 0
+                    smooth_total_loss = 0
+                    train_metrics.reset()
+
+                if current_step % int(one_epoch_iter*args.save_epoch)==0: #exam the model on validation set
+                    print("--------------------------------")
+                    # exam the model on validation set
+                    current_loss, val_metrics = valid(data, vae, writer, valid_idx, current_step, args)
+                    macro_f1, micro_f1 = val_metrics['maF1'], val_metrics['miF1']
+
+                    # select the best checkpoint based on some metric on the validation set
+                    # here we use macro F1 as the selection metric but one can use others
+                    # the best max_keep checkpoints are kept, written in the background
+                    if checkpoints.save(vae, val_metrics['maF1'], current_step):
+                        print('macro_f1:%.6f, micro_f1:%.6f, nll_loss:%.6f, which is better than the previous best one!!!'%(macro_f1, micro_f1, current_loss))
+
+                        best_loss = current_loss
+                        best_iter = current_step
+
+                        print('saving model to ', model_dir)
+                        print()
+
+                        if args.write_to_test_sh:
+                            test_sh_path = "script/run_test_%s.sh" % args.dataset
+                            if os.path.exists(test_sh_path):
+                                ckptFile = open(test_sh_path, "r")
+                                command = []
+                                for line in ckptFile:
+                                    arg_lst = line.strip().split(' ')
+                                    for arg in arg_lst:
+                                        if 'model/model_{}/lr-'.format(args.dataset) in arg:
+                                            command.append('model/model_{}/{}/vae-{}'.format(args.dataset, param_setting, best_iter))
+                                        else:
+                                            command.append(arg)
+                                ckptFile.close()
+                            else:
+                                command = ("python main.py --data_dir %s --test_idx %s --label_dim %d --z_dim %d --feature_dim %d --nll_coeff %s --c_coeff %s --batch_size 64 --mode test -cp %s" % (args.data_dir, args.test_idx, args.label_dim, args.z_dim, args.feature_dim, args.nll_coeff, args.c_coeff, 'model/model_{}/{}/vae-{}'.format(args.dataset, param_setting, best_iter))).strip().split(' ')
                         
-                        ckptFile = open(test_sh_path, "w")
-                        ckptFile.write(" ".join(command)+"\n")
-                        ckptFile.close()
-                best_macro_f1 = max(best_macro_f1, val_metrics['maF1'])
-                best_micro_f1 = max(best_micro_f1, val_metrics['miF1'])
-                best_acc = max(best_acc, val_metrics['ACC'])
+                            ckptFile = open(test_sh_path, "w")
+                            ckptFile.write(" ".join(command)+"\n")
+                            ckptFile.close()
+                    best_micro_f1 = max(best_micro_f1, val_metrics['miF1'])
+                    best_acc = max(best_acc, val_metrics['ACC'])
                 
-                print("--------------------------------")
+                    print("--------------------------------")
 
 
-def valid(feat, labels, vae, summary_writer, valid_idx, current_step, args):
+def valid(data, vae, summary_writer, valid_idx, current_step, args):
     vae.eval()
     print("performing validation...")
+    tensors = device_data(data, device)
+    valid_idx_t = tensors.index(valid_idx)
 
     all_nll_loss = 0
     all_l2_loss = 0
@@ -242,12 +239,9 @@ def valid(feat, labels, vae, summary_writer, valid_idx, current_step, args):
     for i in range(int((len(valid_idx)-1)/real_batch_size)+1):
         start = real_batch_size*i
         end = min(real_batch_size*(i+1), len(valid_idx))
-        input_feat = feat[valid_idx[start:end]]
-        input_label = labels[valid_idx[start:end]]
         # input_feat = get_feat(data,valid_idx[start:end], args.meta_offset, args.label_dim, args.feature_dim)
         # input_label = get_label(data,valid_idx[start:end], args.meta_offset, args.label_dim)
-        input_feat, input_label = torch.from_numpy(input_feat).to(device), torch.from_numpy(input_label)
-        input_label = deepcopy(input_label).float().to(device)
+        input_feat, input_label = tensors.batch(valid_idx_t[start:end])
 
         with torch.no_grad():
             vae.eval()
@@ -259,9 +253,9 @@ def valid(feat, labels, vae, summary_writer, valid_idx, current_step, args):
         all_c_loss += c_loss*(end-start)
         all_total_loss += total_loss*(end-start)
 
-        for j in deepcopy(indiv_prob).cpu().data.numpy():
+        for j in indiv_prob.cpu().numpy():
             all_indiv_prob.append(j)
-        for j in deepcopy(input_label).cpu().data.numpy():
+        for j in input_label.cpu().numpy():
             all_label.append(j)
 
     # collect all predictions and ground-truths
@@ -273,20 +267,8 @@ def valid(feat, labels, vae, summary_writer, valid_idx, current_step, args):
     c_loss = all_c_loss/len(valid_idx)
     total_loss = all_total_loss/len(valid_idx)
 
-    best_val_metrics = None
-    for threshold in THRESHOLDS:
-        val_metrics = evals.compute_metrics(all_indiv_prob, all_label, threshold, all_metrics=True)
-
-        if best_val_metrics == None:
-            best_val_metrics = {}
-            for metric in METRICS:
-                best_val_metrics[metric] = val_metrics[metric]
-        else:
-            for metric in METRICS:
-                if 'FDR' in metric:
-                    best_val_metrics[metric] = min(best_val_metrics[metric], val_metrics[metric])
-                else:
-                    best_val_metrics[metric] = max(best_val_metrics[metric], val_metrics[metric])
+    best_val_metrics = evals.best_threshold_metrics(
+        all_indiv_prob, all_label, THRESHOLDS, METRICS)
 
     time_str = datetime.datetime.now().isoformat()
     acc, ha, ebf1, maf1, mif1 = best_val_metrics['ACC'], best_val_metrics['HA'], best_val_metrics['ebF1'], best_val_metrics['maF1'], best_val_metrics['miF1']
@@ -318,6 +300,8 @@ def train_mpvae_one_epoch(
 
     np.random.shuffle(data.train_idx)
     args.device = next(model.parameters()).device
+    tensors = device_data(data, args.device)
+    train_idx = tensors.index(data.train_idx)
 
     smooth_nll_loss = 0.0  # label encoder decoder cross entropy loss
     smooth_nll_loss_x = 0.0  # feature encoder decoder cross entropy loss
@@ -325,8 +309,7 @@ def train_mpvae_one_epoch(
     smooth_c_loss_x = 0.0  # feature encoder decoder ranking loss
     smooth_kl_loss = 0.0  # kl divergence
     smooth_total_loss = 0.0  # total loss
-    smooth_macro_f1 = 0.0  # macro_f1 score
-    smooth_micro_f1 = 0.0  # micro_f1 score
+    train_metrics = evals.MetricAccumulator(0.5)  # maF1 / miF1
     smooth_reg_fair = 0.
     # smooth_l2_loss = 0.0
 
@@ -338,13 +321,9 @@ def train_mpvae_one_epoch(
             optimizer.zero_grad()
             start = i * data.batch_size
             end = min(data.batch_size * (i + 1), len(data.train_idx))
-            idx = data.train_idx[start:end]
-
-            input_feat = torch.from_numpy(
-                data.input_feat[idx]).float().to(args.device)
+            batch_idx = train_idx[start:end]
 
-            input_label = torch.from_numpy(
-                data.labels[idx]).float().to(args.device)
+            input_feat, input_label = tensors.batch(batch_idx)
             label_out, label_mu, label_logvar, feat_out, feat_mu, feat_logvar = model(
                 input_label, input_feat)
 
@@ -367,10 +346,8 @@ def train_mpvae_one_epoch(
                 label_z = model.label_reparameterize(label_mu, label_logvar)
                 feat_z = model.feat_reparameterize(feat_mu, feat_logvar)
 
-                clusters = torch.from_numpy(
-                    data.label_clusters[idx]).to(args.device)
-                sensitive_feat = torch.from_numpy(
-                    data.sensitive_feat[idx]).to(args.device)
+                clusters = tensors.label_clusters.index_select(0, batch_idx)
+                sensitive_feat = tensors.sensitive_feat.index_select(0, batch_idx)
 
                 reg_labels_z_unfair = 0.
                 reg_feats_z_unfair = 0.
@@ -421,10 +398,7 @@ def train_mpvae_one_epoch(
                 scheduler.step()
 
             # evaluation
-            train_metrics = evals.compute_metrics(
-                indiv_prob.cpu().data.numpy(), input_label.cpu().data.numpy(), 0.5,
-                all_metrics=False)
-            macro_f1, micro_f1 = train_metrics['maF1'], train_metrics['miF1']
+            train_metrics.update(indiv_prob, input_label)
 
             smooth_nll_loss += nll_loss.item()
             smooth_nll_loss_x += nll_loss_x.item()
@@ -433,8 +407,6 @@ def train_mpvae_one_epoch(
             smooth_c_loss_x += c_loss_x.item()
             smooth_kl_loss += kl_loss.item()
             smooth_total_loss += total_loss.item()
-            smooth_macro_f1 += macro_f1.item()
-            smooth_micro_f1 += micro_f1.item()
 
             # log the labels
             # temp_label.append(input_label.cpu().data.numpy())
@@ -456,8 +428,8 @@ def train_mpvae_one_epoch(
         c_loss_x = smooth_c_loss_x / float(i + 1)
         kl_loss = smooth_kl_loss / float(i + 1)
         total_loss = smooth_total_loss / float(i + 1)
-        macro_f1 = smooth_macro_f1 / float(i + 1)
-        micro_f1 = smooth_micro_f1 / float(i + 1)
+        epoch_metrics = train_metrics.compute()
+        macro_f1, micro_f1 = epoch_metrics['maF1'], epoch_metrics['miF1']
 
         # temp_indiv_prob = np.array(temp_indiv_prob).reshape(-1)
         # temp_label = np.array(temp_label).reshape(-1)
@@ -468,12 +440,14 @@ def train_mpvae_one_epoch(
                 macro_f1, micro_f1, nll_loss * args.nll_coeff, nll_loss_x * args.nll_coeff,
                 c_loss * args.c_coeff, c_loss_x * args.c_coeff, kl_loss, total_loss))
 
-        current_loss, val_metrics = validate_mpvae(
-            model, data.input_feat, data.labels, data.valid_idx, args)
+        current_loss, val_metrics = validate_mpvae(model, data, args)
 
 
-def validate_mpvae(model, feat, labels, valid_idx, args):
+def validate_mpvae(model, data, args):
     args.device = next(model.parameters()).device
+    valid_idx = data.valid_idx
+    tensors = device_data(data, args.device)
+    valid_idx_t = tensors.index(valid_idx)
     with torch.no_grad():
         model.eval()
         print("performing validation...")
@@ -491,11 +465,7 @@ def validate_mpvae(model, feat, labels, valid_idx, args):
             for i in t:
                 start = real_batch_size * i
                 end = min(real_batch_size * (i + 1), len(valid_idx))
-                input_feat = feat[valid_idx[start:end]]
-                input_label = labels[valid_idx[start:end]]
-
-                input_feat = torch.from_numpy(input_feat).float().to(args.device)
-                input_label = torch.from_numpy(input_label).float().to(args.device)
+                input_feat, input_label = tensors.batch(valid_idx_t[start:end])
 
                 label_out, label_mu, label_logvar, feat_out, feat_mu, feat_logvar = model(
                     input_label, input_feat)
@@ -508,9 +478,9 @@ def validate_mpvae(model, feat, labels, valid_idx, args):
                 all_c_loss += c_loss * (end - start)
                 all_total_loss += total_loss * (end - start)
 
-                for j in deepcopy(indiv_prob).cpu().data.numpy():
+                for j in indiv_prob.cpu().numpy():
                     all_indiv_prob.append(j)
-                for j in deepcopy(input_label).cpu().data.numpy():
+                for j in input_label.cpu().numpy():
                     all_label.append(j)
 
         # collect all predictions and ground-truths
@@ -522,23 +492,8 @@ def validate_mpvae(model, feat, labels, valid_idx, args):
         c_loss = all_c_loss / len(valid_idx)
         total_loss = all_total_loss / len(valid_idx)
 
-        best_val_metrics = None
-        for threshold in THRESHOLDS:
-            val_metrics = evals.compute_metrics(
-                all_indiv_prob, all_label, threshold, all_metrics=True)
-
-            if best_val_metrics is None:
-                best_val_metrics = {}
-                for metric in METRICS:
-                    best_val_metrics[metric] = val_metrics[metric]
-            else:
-                for metric in METRICS:
-                    if 'FDR' in metric:
-                        best_val_metrics[metric] = min(
-                            best_val_metrics[metric], val_metrics[metric])
-                    else:
-                        best_val_metrics[metric] = max(
-                            best_val_metrics[metric], val_metrics[metric])
+        best_val_metrics = evals.best_threshold_metrics(
+            all_indiv_prob, all_label, THRESHOLDS, METRICS)
 
         time_str = datetime.datetime.now().isoformat()
         acc, ha, ebf1, maf1, mif1 = best_val_metrics['ACC'], best_val_metrics['HA'], best_val_metrics[
@@ -1,4 +1,8 @@
 import os
+import fcntl
+import tempfile
+from contextlib import contextmanager
+
 import numpy as np
 
 
@@ -52,3 +56,28 @@ def search_files(path, prefix=None, postfix=None):
 			files.append(file)
 			
 	return files
+
+
+def atomic_write(path, write):
+	fd, tmp_path = tempfile.mkstemp(
+		dir=os.path.dirname(path) or '.', suffix='.tmp')
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			write(f)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp_path, path)
+	except BaseException:
+		if os.path.exists(tmp_path):
+			os.remove(tmp_path)
+		raise
+
+
+@contextmanager
+def file_lock(path):
+	with open(path, 'a+') as f:
+		fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+		try:
+			yield
+		finally:
+			fcntl.flock(f.fileno(), fcntl.LOCK_UN)